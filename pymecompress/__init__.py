@@ -1,2 +1,47 @@
+"""
+Submodules (`bcl`, `codecs`, `chunked`, ...) and the top level functions are loaded on first use, so that
+`import pymecompress` is cheap and doesn't pull in the compiled `bcl` module, NumPy or numcodecs until they are needed
+(which matters for short lived worker processes and command line tools).
+"""
+import importlib
+import sys
+
 from . import version
-from .bcl import HuffmanCompress, HuffmanCompressQuant, HuffmanDecompress
\ No newline at end of file
+
+_SUBMODULES = ('bcl', 'cache', 'chunked', 'cli', 'codecs', 'procpool', 'stream')
+
+# top level attribute -> submodule it comes from
+_LAZY_ATTRS = {
+    'HuffmanCompress': 'bcl',
+    'HuffmanCompressQuant': 'bcl',
+    'HuffmanDecompress': 'bcl',
+    'compress_array': 'chunked',
+    'decompress_array': 'chunked',
+}
+
+__all__ = ['version'] + list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        # importing a submodule also sets it as an attribute of the package, so this only happens once
+        return importlib.import_module('.' + name, __name__)
+
+    try:
+        module = _LAZY_ATTRS[name]
+    except KeyError:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name)) from None
+
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | set(_LAZY_ATTRS))
+
+
+if sys.version_info < (3, 7):
+    # no module __getattr__ (PEP 562) - import eagerly
+    from .bcl import HuffmanCompress, HuffmanCompressQuant, HuffmanDecompress
+    from .chunked import compress_array, decompress_array
@@ -1,19 +1,474 @@
 import numpy as np
+import struct
 #import six
 from cython.view cimport array as cvarray
 cimport cython
-from libc.stdint cimport uint16_t, uint8_t, uint32_t
-from cpython cimport PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, Py_buffer, PyObject, PyBUF_SIMPLE, PyBUF_C_CONTIGUOUS, PyBUF_F_CONTIGUOUS, PyBuffer_IsContiguous
+from libc.stdint cimport uint16_t, uint8_t, uint32_t, uint64_t, int64_t
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+from cpython cimport PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, Py_buffer, PyObject, PyBUF_SIMPLE, PyBUF_C_CONTIGUOUS, PyBUF_F_CONTIGUOUS, PyBUF_ANY_CONTIGUOUS, PyBUF_STRIDES, PyBUF_WRITABLE, PyBuffer_IsContiguous
 
 cdef extern from "bcl/huffman.h":
     int Huffman_Compress( unsigned char *inp, unsigned char *out, unsigned int insize ) nogil
     int Huffman_Compress_( unsigned char *inp, unsigned char *out, unsigned int insize ) nogil
     void Huffman_Uncompress( unsigned char *inp, unsigned char *out, unsigned int insize, unsigned int outsize ) nogil
+    void Huffman_Uncompress_Strided( unsigned char *inp, unsigned char *out, unsigned int insize, unsigned int outsize,
+                                     int ndim, const int64_t *shape, const int64_t *strides, unsigned int itemsize,
+                                     const unsigned char *lut ) nogil
+    int Huffman_Compress_Counts( unsigned char *inp, unsigned char *out, unsigned int insize,
+                                 const unsigned int *counts ) nogil
+    int Huffman_Compress_MS( unsigned char *inp, unsigned char *out, unsigned int insize, unsigned int nstreams,
+                             const unsigned int *counts ) nogil
+    int Huffman_Uncompress_MS( unsigned char *inp, unsigned char *out, unsigned int insize, unsigned int outsize ) nogil
+    void Huffman_Histogram( const unsigned char *inp, unsigned int size, unsigned int *hist ) nogil
+    void Huffman_Scatter( const unsigned char *inp, unsigned char *out, unsigned int outsize, int ndim,
+                          const int64_t *shape, const int64_t *strides, unsigned int itemsize,
+                          const unsigned char *lut ) nogil
+
+cdef extern from "bcl/rle.h":
+    int RLE_Compress( unsigned char *inp, unsigned char *out, unsigned int insize ) nogil
+    void RLE_Uncompress( unsigned char *inp, unsigned char *out, unsigned int insize ) nogil
+    int RLE_Uncompress_Checked( unsigned char *inp, unsigned char *out, unsigned int insize,
+                                unsigned int outsize ) nogil
+
+cdef extern from "labelrle.h":
+    int64_t LabelRLE_Bound( unsigned int itemsize, uint64_t n_slices, uint64_t n_rows, uint64_t row_len ) nogil
+    int64_t LabelRLE_Compress( const unsigned char *inp, unsigned char *out, unsigned int itemsize, uint64_t n_slices,
+                               uint64_t n_rows, uint64_t row_len, int entropy ) nogil
+    int LabelRLE_Uncompress( const unsigned char *inp, unsigned char *out, uint64_t insize, uint64_t outsize ) nogil
+    int LabelRLE_UncompressSlices( const unsigned char *inp, unsigned char *out, uint64_t insize, uint64_t first,
+                                   uint64_t count ) nogil
+
+cdef extern from "rans.h":
+    enum:
+        RANS_NSTATES
+    int Rans_Compress( const unsigned char *inp, unsigned char *out, unsigned int insize, unsigned int outsize,
+                       const unsigned int *counts ) nogil
+    int Rans_Uncompress( const unsigned char *inp, unsigned char *out, unsigned int insize, unsigned int outsize ) nogil
 
 cdef extern from "quantize.h":
     void quantize_u16(uint16_t *data, uint8_t * out, int size, float offset, float scale) nogil
+    void dequantize_u16_table(float offset, float scale, uint16_t * lut) nogil
+    void quantize_u16_channels(const uint16_t *data, uint8_t * out, int n_pixels, int n_channels, const float *offsets,
+                               const float *scales) nogil
+    void quantize_f32(float *data, uint8_t * out, int size, int mode, int bits, float offset, float scale) nogil
+    void dequantize_f32_table(int mode, float offset, float scale, float * lut) nogil
     #void quantize_u16_avx( uint16_t * data, uint8_t * out, int size, float offset, float scale) nogil
+
+cdef extern from "summary.h":
+    ctypedef struct pyme_summary_t:
+        uint64_t count
+        double min
+        double max
+        double mean
+    int summary_stats(const void *data, uint64_t size, char kind, unsigned int itemsize, pyme_summary_t *summary,
+                      uint32_t *hist, unsigned int n_bins) nogil
+
+cdef extern from "instrument.h":
+    enum:
+        PYME_STAGE_ALLOC
+        PYME_NUM_STAGES
+    ctypedef struct pyme_stage_stats_t:
+        uint64_t calls
+        uint64_t cycles
+        uint64_t bytes_in
+        uint64_t bytes_out
+    int pyme_stats_enabled
+    unsigned long long pyme_stats_now() nogil
+    void pyme_stats_record(int stage, uint64_t cycles, uint64_t bytes_in, uint64_t bytes_out) nogil
+    void pyme_stats_get(pyme_stage_stats_t *out) nogil
+    void pyme_stats_reset() nogil
+
+# order matches the PYME_STAGE_* enum in instrument.h
+STAGE_NAMES = ('alloc', 'quantize', 'histogram', 'tree', 'encode', 'decode_tree', 'decode')
+
+_stats_hook = None
+
+def enable_stats(enabled=True):
+    """
+    Turn the per-stage counters in the native layer on or off. Counters are off by default, in which case the
+    instrumentation costs a single flag check per stage.
+    """
+    global pyme_stats_enabled
+    pyme_stats_enabled = 1 if enabled else 0
+
+def stats_enabled():
+    return bool(pyme_stats_enabled)
+
+def get_stats():
+    """
+    Return cumulative (process wide) counters for each stage of the compression pipeline.
+
+    Returns
+    -------
+    dict mapping stage name to a dict with keys 'calls', 'cycles', 'bytes_in' and 'bytes_out'. Cycles are raw
+    timestamp counter ticks (rdtsc on x86, the virtual counter on aarch64, microseconds elsewhere).
+    """
+    cdef pyme_stage_stats_t s[PYME_NUM_STAGES]
+    pyme_stats_get(s)
+
+    return {name : {'calls': s[i].calls, 'cycles': s[i].cycles, 'bytes_in': s[i].bytes_in,
+                    'bytes_out': s[i].bytes_out} for i, name in enumerate(STAGE_NAMES)}
+
+def reset_stats():
+    pyme_stats_reset()
+
+def set_stats_hook(hook):
+    """
+    Register a callable to forward stats to e.g. a metrics system. When stats are enabled, `hook(op, stats)` is
+    called after each compression / decompression call, with `op` the name of the function called and `stats` the
+    cumulative counters as returned by `get_stats()`. Pass `None` to remove the hook.
+    """
+    global _stats_hook
+    _stats_hook = hook
+
+cdef inline unsigned long long _alloc_start():
+    return pyme_stats_now() if pyme_stats_enabled else 0
+
+cdef inline void _alloc_stop(unsigned long long t0, uint64_t nbytes):
+    if pyme_stats_enabled:
+        pyme_stats_record(PYME_STAGE_ALLOC, pyme_stats_now() - t0, 0, nbytes)
+
+cdef inline _report(op):
+    if pyme_stats_enabled and (_stats_hook is not None):
+        _stats_hook(op, get_stats())
+    
+# Frame format
+# ------------
+# The *_buffer functions produce self-contained frames. The length of the decoded symbol stream is stored in the
+# last 4 bytes. If the top bit of this word is set the frame is "extended" and carries a set of tagged sections
+# (array metadata, quantization parameters, ...) between the payload and the trailer:
+#
+#   [entropy coded payload][sections][uint32 sections length][uint32 n_symbols | FRAME_EXTENDED]
+#
+# with each section stored as [uint32 tag][uint32 length][data]. Legacy frames are [payload][uint32 n_symbols].
+# All values are little endian.
+#
+# Every frame written by the *_buffer functions (and so the codecs) is extended, whatever options are used. Readers
+# which predate the extended format only understand legacy frames, so can't decode them. Legacy frames are still read.
+
+FRAME_EXTENDED = 0x80000000
+
+SECTION_META = 1  # dtype, order and shape of the original data
+SECTION_QUANT = 2  # quantization mode and parameters
+SECTION_CODER = 3  # entropy coder used for the payload (Huffman, single stream, if absent)
+SECTION_STATS = 4  # summary statistics, and optionally a histogram, of the data (see `frame_stats`)
+SECTION_PREVIEW = 5  # [uint8 binning][3 reserved][frame of the binned data] (see `decode_preview`)
+SECTION_CHANNELS = 6  # per channel quantization and payloads of interleaved multi-channel data (see below)
+
+QUANT_SQRT = 0
+QUANT_LINEAR = 1
+
+_QUANT_MODES = {'sqrt': QUANT_SQRT, 'linear': QUANT_LINEAR}
+
+cdef enum:
+    _HUFFMAN = 0
+    _HUFFMAN_MS = 1
+    _RANS = 2
+    _LABEL_RLE = 3
+
+CODER_HUFFMAN = _HUFFMAN
+CODER_HUFFMAN_MS = _HUFFMAN_MS  # multi-stream (interleaved) Huffman
+CODER_RANS = _RANS
+CODER_LABEL_RLE = _LABEL_RLE  # row-wise run length coding of label images
+
+_CODER_IDS = {'huffman': CODER_HUFFMAN, 'rans': CODER_RANS}
+
+MAX_STREAMS = 8
+
+# Stats sections are [uint8 kind][3 reserved][uint32 n_bins][uint64 count][double min][double max][double mean]
+# followed by n_bins uint32 counts (n_bins is 0 for summary only stats). STATS_SYMBOLS histograms count the 256 coded
+# symbols (for quantized and single byte data) and STATS_LINEAR histograms have equal width bins spanning [min, max].
+STATS_SYMBOLS = 1
+STATS_LINEAR = 2
+
+cdef enum:
+    _STATS_BINS = 256
+
+STATS_BINS = _STATS_BINS
+
+_STATS_HEADER = '<BxxxIQddd'
+
+# Channels sections are [uint16 n_channels][2 reserved] followed by, for each channel, [double offset][double scale]
+# [uint32 payload offset][uint32 payload size][uint8 coder][uint8 streams][2 reserved]. The frame payload is the
+# concatenation of the independently coded (each with its own Huffman tree) channel payloads.
+MAX_CHANNELS = 256
+
+_CHANNEL_ENTRY = '<ddIIBBxx'
+
+def _dtype_str(data, itemsize):
+    try:
+        return np.dtype(data.dtype).str
+    except AttributeError:
+        pass
+    
+    try:
+        return np.dtype(memoryview(data).format).str
+    except (TypeError, ValueError):
+        return '|V%d' % itemsize
+
+def _section(tag, data):
+    return struct.pack('<II', tag, len(data)) + data
+
+def _meta_section(dtype, shape, order):
+    dt = dtype.encode('ascii')
+    return _section(SECTION_META, struct.pack('<cBB', order.encode('ascii'), len(shape), len(dt)) + dt +
+                    struct.pack('<%dq' % len(shape), *shape))
+
+def _quant_section(mode, bits, offset, scale):
+    return _section(SECTION_QUANT, struct.pack('<BBdd', mode, bits, offset, scale))
+
+def _coder_section(coder, streams):
+    return _section(SECTION_CODER, struct.pack('<BB', coder, streams))
+
+def _check_stats(stats):
+    if stats not in (None, 'summary', 'histogram'):
+        raise ValueError("stats should be None, 'summary' or 'histogram', not %r" % (stats,))
+
+def _stats_reserve(stats):
+    """ space needed in the output for a stats section """
+    if stats is None:
+        return 0
+    return 8 + struct.calcsize(_STATS_HEADER) + (4*STATS_BINS if stats == 'histogram' else 0)
+
+def _stats_section(kind, count, vmin, vmax, mean, hist=None):
+    n_bins = 0 if hist is None else len(hist)
+    s = struct.pack(_STATS_HEADER, kind, n_bins, count, vmin, vmax, mean)
+    if hist is not None:
+        s += np.asarray(hist, '<u4').tobytes()
+    return _section(SECTION_STATS, s)
+
+def _symbol_values(dtype):
+    """ values of the symbols in a lossless frame of single byte data """
+    if dtype is not None and dtype.kind in 'ui' and dtype.itemsize == 1:
+        return np.arange(256, dtype='u1').view(dtype)
+    return np.arange(256, dtype='u1')
+
+def _symbol_stats_section(stats, hist, values):
+    """ stats section from the histogram of the coded symbols, given the value each symbol decodes to """
+    count = int(hist.sum())
+    vmin = vmax = mean = 0
+    if count:
+        nz = hist > 0
+        v = values[nz].astype('f8')
+        vmin, vmax, mean = v.min(), v.max(), np.dot(v, hist[nz])/count
+    return _stats_section(STATS_SYMBOLS, count, vmin, vmax, mean, hist if stats == 'histogram' else None)
+
+def _check_preview(preview):
+    if preview is not None and not (2 <= preview <= 255):
+        raise ValueError('preview binning should be between 2 and 255')
+
+def _binned(data, int binning):
+    """
+    mean of binning x binning blocks over the last two axes (the only axis for 1D data), in the dtype of the data.
+    Blocks at the edges can be partial.
+    """
+    a = np.asarray(memoryview(data))
+    dtype = a.dtype
+    if dtype.kind not in 'uif':
+        raise ValueError('previews are only supported for integer and float data')
+    
+    for axis in range(max(a.ndim - 2, 0), a.ndim):
+        n = a.shape[axis]
+        if n == 0:
+            continue
+        starts = np.arange(0, n, binning)
+        counts = np.diff(np.append(starts, n)).reshape([-1 if i == axis else 1 for i in range(a.ndim)])
+        a = np.add.reduceat(a, starts, axis=axis, dtype='f8')/counts
+    
+    if dtype.kind in 'ui':
+        a = np.rint(a)
+    return np.ascontiguousarray(a.astype(dtype))
+
+def _preview_section(binning, frame):
+    return _section(SECTION_PREVIEW, struct.pack('<Bxxx', binning) + frame.tobytes())
+
+def _channels_section(offsets, scales, starts, sizes, coders, streams):
+    s = struct.pack('<Hxx', len(offsets))
+    for c in range(len(offsets)):
+        s += struct.pack(_CHANNEL_ENTRY, offsets[c], scales[c], starts[c], sizes[c], coders[c],
+                         {CODER_RANS: RANS_NSTATES, CODER_HUFFMAN_MS: streams}.get(coders[c], 1))
+    return _section(SECTION_CHANNELS, s)
+
+def _coder_id(coder):
+    try:
+        return _CODER_IDS[coder]
+    except KeyError:
+        raise ValueError('Unknown coder %r, expected one of %s' % (coder, sorted(_CODER_IDS.keys())))
+
+def _check_streams(streams):
+    if not (1 <= streams <= MAX_STREAMS):
+        raise ValueError('streams should be between 1 and %d' % MAX_STREAMS)
+
+def _frame_trailer(n_symbols, sections):
+    s = b''.join(sections)
+    return s + struct.pack('<II', len(s), n_symbols | FRAME_EXTENDED)
+
+def compress_bound(Py_ssize_t nbytes, int ndim=1, stats=None, preview=None):
+    """
+    Upper bound on the size of a frame produced by `huffman_compress_buffer` / `huffman_compress_quant_buffer` for
+    `nbytes` bytes (or, for quantized data, pixels) of input with `ndim` dimensions, compressed with the given `stats`
+    and `preview` options. Useful for preallocating output.
+    """
+    bound = int(nbytes*1.01 + 320) + 192 + 8*ndim + _stats_reserve(stats)
+    if preview is not None:
+        # binned data is never larger than the data (but can be close to it for thin arrays)
+        bound += 12 + compress_bound(nbytes, ndim)
+    return bound
+
+cdef _buffer_meta(data, Py_buffer *view):
+    """ metadata section for a buffer acquired with PyBUF_ANY_CONTIGUOUS"""
+    order = 'F' if (view.ndim > 1 and not PyBuffer_IsContiguous(view, b'C'[0])) else 'C'
+    shape = tuple(view.shape[i] for i in range(view.ndim))
+    return _meta_section(_dtype_str(data, view.itemsize), shape, order)
+
+def frame_info(data):
+    """
+    Read the header information from a compressed frame (as produced by the *_buffer functions) without decoding
+    the payload.
+
+    Returns
+    -------
+    dict with keys 'n_symbols' (length of the decoded symbol stream), 'payload_size', 'dtype', 'shape', 'order',
+    'quant' (a dict of quantization parameters, or None for lossless frames), 'coder' and 'streams' (the entropy coder
+    and number of interleaved streams), 'preview' (the binning of the embedded preview, or None), 'channels' (a list
+    of per-channel dicts of quantization parameters, coder and payload location for multi-channel frames, else None)
+    and 'sections' (raw sections, keyed by tag). 'dtype' and 'shape' are None for legacy frames which don't record them.
+    """
+    mv = memoryview(data).cast('B')
+    n = len(mv)
+    if n < 4:
+        raise ValueError('Buffer is too short to be a compressed frame')
+    
+    word, = struct.unpack_from('<I', mv, n - 4)
+    info = {'n_symbols': word & ~FRAME_EXTENDED, 'payload_size': n - 4, 'dtype': None, 'shape': None, 'order': 'C',
+            'quant': None, 'coder': CODER_HUFFMAN, 'streams': 1, 'preview': None, 'channels': None, 'sections': {}}
+    
+    if not (word & FRAME_EXTENDED):
+        return info
+    
+    sections_len, = struct.unpack_from('<I', mv, n - 8)
+    pos = n - 8 - sections_len
+    if pos < 0:
+        raise ValueError('Corrupt frame trailer')
+    info['payload_size'] = pos
+    
+    while pos < (n - 8):
+        tag, length = struct.unpack_from('<II', mv, pos)
+        info['sections'][tag] = mv[(pos + 8):(pos + 8 + length)]
+        pos += 8 + length
+    
+    meta = info['sections'].get(SECTION_META, None)
+    if meta is not None:
+        order, ndim, dt_len = struct.unpack_from('<cBB', meta, 0)
+        info['order'] = order.decode('ascii')
+        info['dtype'] = np.dtype(bytes(meta[3:(3 + dt_len)]).decode('ascii'))
+        info['shape'] = struct.unpack_from('<%dq' % ndim, meta, 3 + dt_len)
+    
+    quant = info['sections'].get(SECTION_QUANT, None)
+    if quant is not None:
+        mode, bits, offset, scale = struct.unpack_from('<BBdd', quant, 0)
+        info['quant'] = {'mode': mode, 'bits': bits, 'offset': offset, 'scale': scale}
+    
+    coder = info['sections'].get(SECTION_CODER, None)
+    if coder is not None:
+        info['coder'], info['streams'] = struct.unpack_from('<BB', coder, 0)
     
+    preview = info['sections'].get(SECTION_PREVIEW, None)
+    if preview is not None:
+        info['preview'] = preview[0]
+    
+    channels = info['sections'].get(SECTION_CHANNELS, None)
+    if channels is not None:
+        n_channels, = struct.unpack_from('<H', channels, 0)
+        info['channels'] = []
+        for c in range(n_channels):
+            offset, scale, start, size, coder, streams = struct.unpack_from(_CHANNEL_ENTRY, channels,
+                                                                            4 + c*struct.calcsize(_CHANNEL_ENTRY))
+            info['channels'].append({'offset': offset, 'scale': scale, 'payload_offset': start, 'payload_size': size,
+                                     'coder': coder, 'streams': streams})
+    
+    return info
+
+def decode_preview(data, out=None):
+    """
+    Decode the low resolution preview embedded in a frame compressed with `preview=binning`, without decoding the
+    main payload. The preview is the mean of binning x binning blocks over the last two axes (the only axis for 1D
+    data), and is dequantized for quantized frames. `out` is as for `huffman_decompress_buffer`.
+    """
+    preview = frame_info(data)['sections'].get(SECTION_PREVIEW, None)
+    if preview is None:
+        raise ValueError('Frame has no preview')
+    
+    return huffman_decompress_buffer(preview[4:], out)
+
+def frame_stats(data):
+    """
+    Read the statistics stored in a frame compressed with `stats='summary'` or `stats='histogram'`, without decoding
+    the payload.
+    
+    Returns
+    -------
+    dict with keys 'count' (number of values, excluding NaN / inf), 'min', 'max' and 'mean', and, for frames with a
+    histogram, 'hist' (counts) and 'bin_values' (the value of each bin - the decoded value of each symbol for
+    quantized / single byte data, or the bin centre otherwise), else None for both. Returns None if the frame has no
+    stats. For quantized frames the stats are of the quantized (i.e. decoded) data.
+    """
+    info = frame_info(data)
+    s = info['sections'].get(SECTION_STATS, None)
+    if s is None:
+        return None
+    
+    kind, n_bins, count, vmin, vmax, mean = struct.unpack_from(_STATS_HEADER, s, 0)
+    stats = {'count': count, 'min': vmin, 'max': vmax, 'mean': mean, 'hist': None, 'bin_values': None}
+    if n_bins:
+        stats['hist'] = np.frombuffer(s, '<u4', n_bins, struct.calcsize(_STATS_HEADER)).astype('uint32')
+        if kind == STATS_SYMBOLS:
+            lut = _frame_lut(info)
+            stats['bin_values'] = lut if lut is not None else _symbol_values(info['dtype'])
+        elif kind == STATS_LINEAR:
+            stats['bin_values'] = vmin + (vmax - vmin)*(np.arange(n_bins) + 0.5)/n_bins
+        else:
+            raise ValueError('Unknown stats kind: %d' % kind)
+    
+    return stats
+
+def frame_percentiles(frames, q):
+    """
+    Estimate percentiles (`q`, 0 - 100, scalar or sequence) of the data in one or more frames (e.g. all the chunks of
+    an image) from their stored histograms, without decoding. Exact for quantized and single byte data, and to within
+    a bin width (`(max - min)/256`) otherwise. All frames need to have been compressed with `stats='histogram'`.
+    """
+    if not isinstance(frames, (list, tuple)):
+        frames = [frames]
+    
+    values, weights = [], []
+    for f in frames:
+        stats = frame_stats(f)
+        if stats is None or stats['hist'] is None:
+            raise ValueError('Frame has no stored histogram')
+        nz = stats['hist'] > 0
+        values.append(np.asarray(stats['bin_values'], 'f8')[nz])
+        weights.append(stats['hist'][nz])
+    
+    values = np.concatenate(values)
+    weights = np.concatenate(weights).astype('u8')
+    if len(values) == 0:
+        raise ValueError('Frames are empty')
+    
+    idx = np.argsort(values, kind='stable')
+    values = values[idx]
+    cum = np.cumsum(weights[idx])
+    
+    qs = np.asarray(q, 'f8')
+    if np.any(qs < 0) or np.any(qs > 100):
+        raise ValueError('Percentiles should be between 0 and 100')
+    
+    # smallest value with at least q% of the data at or below it
+    pos = np.searchsorted(cum, np.maximum(qs*cum[-1]/100., 1), side='left')
+    return values[np.minimum(pos, len(values) - 1)]
+
+
 @cython.boundscheck(False)
 def HuffmanCompress(data):
     cdef Py_buffer view
@@ -33,7 +488,9 @@ def HuffmanCompress(data):
     
     cdef int dsize = view.len
     
-    out = np.zeros(int(dsize*1.01 + 320),'uint8')
+    cdef unsigned long long t0 = _alloc_start()
+    out = np.empty(int(dsize*1.01 + 320),'uint8')
+    _alloc_stop(t0, out.nbytes)
     cdef unsigned char [:] ov = out
     
     with nogil:
@@ -41,52 +498,529 @@ def HuffmanCompress(data):
         nb = Huffman_Compress(<uint8_t *>view.buf, &ov[0], dsize)
         
     PyBuffer_Release(&view)
+    _report('HuffmanCompress')
     return out[:nb]
 
+def _compress_output(out, Py_ssize_t size):
+    """ allocate an output buffer for compressed data, or check that a user supplied one is large enough """
+    cdef unsigned long long t0
+    if out is None:
+        t0 = _alloc_start()
+        out = np.empty(size, 'uint8')
+        _alloc_stop(t0, size)
+    elif memoryview(out).nbytes < size:
+        raise ValueError('Output buffer too small, need at least %d bytes' % size)
+    
+    return out
+
 @cython.boundscheck(False)
-def huffman_compress_buffer(data):
-    cdef Py_buffer buffer
-    PyObject_GetBuffer(data, &buffer, PyBUF_C_CONTIGUOUS)
-    #assert(PyBuffer_IsContiguous(buffer, 'C'))
+cdef int _entropy_encode(uint8_t *src, unsigned char *dst, unsigned int n, int coder, unsigned int streams,
+                         unsigned int cap, int *used, unsigned int *hist) nogil:
+    """
+    Entropy code `n` bytes from `src` into `dst` and return the compressed size. The coder actually used is returned
+    in `used` - rANS falls back to Huffman if its output would be larger than `cap` (incompressible data). If `hist`
+    is not NULL, it receives the symbol histogram (which the coders then use rather than computing their own).
+    """
     cdef int nb
+    if hist != NULL:
+        Huffman_Histogram(src, n, hist)
+    
+    if coder == _RANS:
+        nb = Rans_Compress(src, dst, n, cap, hist)
+        if nb >= 0:
+            used[0] = _RANS
+            return nb
+    
+    if streams > 1:
+        used[0] = _HUFFMAN_MS
+        return Huffman_Compress_MS(src, dst, n, streams, hist)
+    
+    used[0] = _HUFFMAN
+    if hist != NULL:
+        return Huffman_Compress_Counts(src, dst, n, hist)
+    return Huffman_Compress(src, dst, n)
+
+@cython.boundscheck(False)
+def _finish_frame(out, int nb, int used, unsigned int streams, unsigned int n_symbols, sections):
+    """ append the sections (plus a coder section if needed) and trailer after the payload """
+    if used == CODER_HUFFMAN_MS:
+        sections.append(_coder_section(used, streams))
+    elif used == CODER_RANS:
+        sections.append(_coder_section(used, RANS_NSTATES))
+    elif used == CODER_LABEL_RLE:
+        sections.append(_coder_section(used, 1))
+    
+    trailer = _frame_trailer(n_symbols, sections)
+    cdef const unsigned char *tr = trailer
+    cdef int ntr = len(trailer)
+    cdef unsigned char [::1] ov = out
+    memcpy(&ov[nb], tr, ntr)
+    
+    return out[:(nb + ntr)]
+
+@cython.boundscheck(False)
+def huffman_compress_buffer(data, out=None, unsigned int streams=1, coder='huffman', stats=None, preview=None):
+    """
+    Compress a (C or Fortran) contiguous buffer. The dtype, shape and memory order of the data are recorded in the
+    frame so that `huffman_decompress_buffer` can reconstruct the array (or decode into a strided destination).
+    
+    If `out` (a contiguous uint8 buffer) is given, the frame is written into it rather than a newly allocated array.
+    It needs to be somewhat larger than the input (see `compress_bound`). Returns a view of the output holding the
+    frame.
+    
+    With `streams` > 1 (max 8) the data is coded as several Huffman streams sharing one tree, which decode
+    substantially faster (the streams are decoded interleaved) at the cost of a few bytes per stream. 4 or 8 streams
+    are the best choices.
+    
+    `coder` selects the entropy coder - 'huffman' or 'rans'. rANS gets closer to the entropy than Huffman for skewed
+    distributions (e.g. quantized low signal data), and always uses 4 interleaved states (`streams` is ignored).
+    Frames are always decoded by `huffman_decompress_buffer`, whichever coder was used.
+    
+    `stats='summary'` stores the count, min, max and mean of the data in the frame, and `stats='histogram'` also
+    stores a 256 bin histogram, for reading with `frame_stats` / `frame_percentiles` without decoding. For single byte
+    data these come for free from the coder's histogram; other (integer or float32/64) data needs an extra pass.
+    
+    `preview=binning` (2-255) embeds a separately compressed copy of the data, binned (block mean) by `binning` along
+    the last two axes, which `decode_preview` can read without decoding the full frame (e.g. for overviews of large
+    tiled acquisitions).
+    """
+    _check_streams(streams)
+    _check_stats(stats)
+    _check_preview(preview)
+    cdef int icoder = _coder_id(coder)
+    
+    cdef Py_buffer buffer
+    PyObject_GetBuffer(data, &buffer, PyBUF_ANY_CONTIGUOUS)
+    cdef int nb, used
     cdef int dsize = buffer.len
-    cdef int orig_size = int(buffer.len/buffer.itemsize)
+    cdef unsigned int itemsize = buffer.itemsize
+    cdef unsigned int bound = int(dsize*1.01 + 320)
     
-    out = np.zeros(int(dsize*1.01 + 320),'uint8')
-    cdef unsigned char [:] ov = out
+    cdef unsigned char [::1] ov
+    cdef uint32_t [::1] hv
+    cdef unsigned int *symbol_hist = NULL
+    cdef uint32_t *value_hist = NULL
+    cdef char value_kind = 0
+    cdef pyme_summary_t summary
+    try:
+        sections = [_buffer_meta(data, &buffer)]
+        if preview is not None:
+            sections.append(_preview_section(preview, huffman_compress_buffer(_binned(data, preview), streams=streams,
+                                                                              coder=coder)))
+        dtype = np.dtype(_dtype_str(data, itemsize))
+        if stats is not None:
+            hist = np.zeros(STATS_BINS, 'uint32')
+            hv = hist
+            if itemsize == 1:
+                symbol_hist = <unsigned int *>&hv[0]
+            elif dtype.isnative and (dtype.kind in 'ui' or (dtype.kind == 'f' and itemsize in (4, 8))):
+                value_kind = ord(dtype.kind)
+                if stats == 'histogram':
+                    value_hist = &hv[0]
+            else:
+                raise ValueError('stats are only supported for integer and float32/64 data in native byte order')
+        
+        out = _compress_output(out, bound + 64 + len(_frame_trailer(dsize, sections)) + _stats_reserve(stats) + 16)
+        ov = out
+    except:
+        PyBuffer_Release(&buffer)
+        raise
     
     with nogil:
+        if value_kind:
+            summary_stats(buffer.buf, dsize//itemsize, value_kind, itemsize, &summary, value_hist, _STATS_BINS)
+        nb = _entropy_encode(<uint8_t *>buffer.buf, &ov[0], dsize, icoder, streams, bound, &used, symbol_hist)
         
-        nb = Huffman_Compress(<uint8_t *>buffer.buf, &ov[0], dsize)
+    PyBuffer_Release(&buffer)
+    if symbol_hist != NULL:
+        sections.append(_symbol_stats_section(stats, hist, _symbol_values(dtype)))
+    elif value_kind:
+        sections.append(_stats_section(STATS_LINEAR, summary.count, summary.min, summary.max, summary.mean,
+                                       hist if value_hist != NULL else None))
+    out = _finish_frame(out, nb, used, streams, dsize, sections)
+    _report('huffman_compress_buffer')
+    return out
+
+@cython.boundscheck(False)
+def huffman_compress_quant_buffer(data, float offset, float scale, out=None, unsigned int streams=1,
+                                  coder='huffman', stats=None, preview=None):
+    """
+    Square root quantize (`q = round(sqrt(data - offset)/scale)`, with values below `offset` quantized to 0 and `q`
+    clamped to 255) and then compress a contiguous uint16 buffer.
+    `out`, `streams`, `coder`, `stats` and `preview` are as for `huffman_compress_buffer` (stats are of the quantized
+    data, and cost nothing extra to compute; the preview is quantized in the same way as the data).
+    """
+    _check_streams(streams)
+    _check_stats(stats)
+    _check_preview(preview)
+    cdef int icoder = _coder_id(coder)
+    
+    cdef Py_buffer buffer
+    PyObject_GetBuffer(data, &buffer, PyBUF_ANY_CONTIGUOUS)
+    
+    if buffer.itemsize != 2:
+        PyBuffer_Release(&buffer)
+        raise RuntimeError('Expected unsigned short input data')
+    
+    cdef int nb, used
+    cdef int orig_size = int(buffer.len/buffer.itemsize)
+    cdef unsigned int bound = int(orig_size*1.01 + 320)
+    
+    cdef unsigned char [::1] ov
+    cdef uint32_t [::1] hv
+    cdef unsigned int *symbol_hist = NULL
+    try:
+        sections = [_buffer_meta(data, &buffer), _quant_section(QUANT_SQRT, 8, offset, scale)]
+        if preview is not None:
+            sections.append(_preview_section(preview, huffman_compress_quant_buffer(_binned(data, preview), offset,
+                                                                                    scale, streams=streams,
+                                                                                    coder=coder)))
+        out = _compress_output(out, bound + 64 + len(_frame_trailer(orig_size, sections)) + _stats_reserve(stats) +
+                               16)
+        ov = out
+        if stats is not None:
+            hist = np.zeros(STATS_BINS, 'uint32')
+            hv = hist
+            symbol_hist = <unsigned int *>&hv[0]
+    except:
+        PyBuffer_Release(&buffer)
+        raise
+    cdef uint8_t *quant
+    
+    with nogil:
+        # quantized data goes in a scratch buffer which we own, so we don't need the GIL to allocate it
+        quant = <uint8_t *>malloc(orig_size + 1)
+        if quant != NULL:
+            quantize_u16(<uint16_t *>buffer.buf, quant, orig_size, offset, scale)
+            nb = _entropy_encode(quant, &ov[0], orig_size, icoder, streams, bound, &used, symbol_hist)
+            free(quant)
         
     PyBuffer_Release(&buffer)
-    # store length in last 4 bytes
-    (<uint32_t *>(&ov[nb]))[0] = orig_size
-    return out[:(nb + 4)]
+    if quant == NULL:
+        raise MemoryError()
+    
+    if stats is not None:
+        sections.append(_symbol_stats_section(stats, hist, _dequant_lut(offset, scale)))
+    out = _finish_frame(out, nb, used, streams, orig_size, sections)
+    _report('huffman_compress_quant_buffer')
+    return out
 
 @cython.boundscheck(False)
-def huffman_compress_quant_buffer(data, float offset, float scale):
-    #assert(PyBuffer_IsContiguous(buffer, 'C'))
+def huffman_compress_quant_f32_buffer(data, float offset, float scale, mode='sqrt', int bits=8, out=None,
+                                      unsigned int streams=1, coder='huffman', stats=None, preview=None):
+    """
+    Quantize a contiguous float32 buffer to `bits` (1-8) bits per pixel and then compress it. With `mode='linear'`,
+    `q = round((data - offset)/scale)`, and with `mode='sqrt'` (for Poisson-like data, where the quantization step then
+    tracks the noise), `q = round(sqrt(data - offset)/scale)`. q is clipped to [0, 2**bits - 1]. The quantization
+    parameters are stored in the frame, and `huffman_decompress_buffer` returns dequantized float32 data.
+    
+    `out`, `streams`, `coder`, `stats` and `preview` are as for `huffman_compress_buffer` (stats are of the
+    dequantized data).
+    """
+    _check_streams(streams)
+    _check_stats(stats)
+    _check_preview(preview)
+    cdef int icoder = _coder_id(coder)
+    
+    if mode not in _QUANT_MODES:
+        raise ValueError('Unknown quantization mode %r, expected one of %s' % (mode, sorted(_QUANT_MODES.keys())))
+    cdef int imode = _QUANT_MODES[mode]
+    
+    if not (1 <= bits <= 8):
+        raise ValueError('bits should be between 1 and 8')
+    
     cdef Py_buffer buffer
-    PyObject_GetBuffer(data, &buffer, PyBUF_C_CONTIGUOUS)
+    PyObject_GetBuffer(data, &buffer, PyBUF_ANY_CONTIGUOUS)
     
-    cdef int nb
-    cdef int dsize = buffer.len
+    if buffer.itemsize != 4 or _dtype_str(data, 4) != '<f4':
+        PyBuffer_Release(&buffer)
+        raise RuntimeError('Expected float32 input data')
+    
+    cdef int nb, used
     cdef int orig_size = int(buffer.len/buffer.itemsize)
+    cdef unsigned int bound = int(orig_size*1.01 + 320)
     
-    out = np.zeros(int(dsize*1.01 + 320),'uint8')
-    quant = np.zeros(dsize, 'uint8')
-    cdef unsigned char [:] ov = out
-    cdef unsigned char [:] qv = quant
+    cdef unsigned char [::1] ov
+    cdef uint32_t [::1] hv
+    cdef unsigned int *symbol_hist = NULL
+    try:
+        sections = [_buffer_meta(data, &buffer), _quant_section(imode, bits, offset, scale)]
+        if preview is not None:
+            sections.append(_preview_section(preview, huffman_compress_quant_f32_buffer(_binned(data, preview), offset,
+                                                                                        scale, mode, bits,
+                                                                                        streams=streams, coder=coder)))
+        out = _compress_output(out, bound + 64 + len(_frame_trailer(orig_size, sections)) + _stats_reserve(stats) +
+                               16)
+        ov = out
+        if stats is not None:
+            hist = np.zeros(STATS_BINS, 'uint32')
+            hv = hist
+            symbol_hist = <unsigned int *>&hv[0]
+    except:
+        PyBuffer_Release(&buffer)
+        raise
+    cdef uint8_t *quant
+    
+    with nogil:
+        quant = <uint8_t *>malloc(orig_size + 1)
+        if quant != NULL:
+            quantize_f32(<float *>buffer.buf, quant, orig_size, imode, bits, offset, scale)
+            nb = _entropy_encode(quant, &ov[0], orig_size, icoder, streams, bound, &used, symbol_hist)
+            free(quant)
+        
+    PyBuffer_Release(&buffer)
+    if quant == NULL:
+        raise MemoryError()
+    
+    if stats is not None:
+        sections.append(_symbol_stats_section(stats, hist, _dequant_lut_f32(imode, offset, scale)))
+    out = _finish_frame(out, nb, used, streams, orig_size, sections)
+    _report('huffman_compress_quant_f32_buffer')
+    return out
+
+def _channel_params(v, int n_channels, name):
+    if np.ndim(v) == 0:
+        return np.full(n_channels, v, 'float32')
+    
+    v = np.array(v, 'float32')
+    if v.shape != (n_channels,):
+        raise ValueError('%s should be a scalar or have one value per channel (%d)' % (name, n_channels))
+    return v
+
+@cython.boundscheck(False)
+def huffman_compress_quant_channels_buffer(data, offset, scale, out=None, unsigned int streams=1, coder='huffman'):
+    """
+    Square root quantize and compress interleaved multi-channel uint16 data - an array with the channels along the
+    last axis, e.g. (y, x, c) camera frames. Arrays which are not C contiguous (e.g. Fortran ordered, where the
+    channels are not interleaved in memory) are copied to C order first. Each channel is quantized with its own
+    `offset` and `scale` (scalars, or one value per channel), exactly as `huffman_compress_quant_buffer` would quantize
+    it, and coded with its own Huffman table, so that channels with very different statistics don't share a code. The
+    data is deinterleaved in the same (vectorized) pass as the quantization.
+    
+    `out`, `streams` and `coder` are as for `huffman_compress_buffer`. Frames are decoded (and the channels
+    re-interleaved straight into the output) by `huffman_decompress_buffer`.
+    """
+    _check_streams(streams)
+    cdef int icoder = _coder_id(coder)
+    
+    if not memoryview(data).c_contiguous:
+        data = np.ascontiguousarray(data)
+    
+    cdef Py_buffer buffer
+    PyObject_GetBuffer(data, &buffer, PyBUF_C_CONTIGUOUS)
+    
+    cdef int n_channels, n_pixels, c
+    cdef unsigned int bound
+    cdef float [::1] offv, scalev
+    cdef int [::1] nbv, usedv
+    cdef unsigned char [::1] ov
+    try:
+        if buffer.itemsize != 2:
+            raise RuntimeError('Expected unsigned short input data')
+        if buffer.ndim < 2:
+            raise ValueError('Expected data with at least 2 dimensions, with the channels along the last axis')
+        
+        n_channels = buffer.shape[buffer.ndim - 1]
+        if not (1 <= n_channels <= MAX_CHANNELS):
+            raise ValueError('Number of channels should be between 1 and %d' % MAX_CHANNELS)
+        n_pixels = int(buffer.len/buffer.itemsize)//n_channels
+        bound = int(n_pixels*1.01 + 320)
+        
+        offsets = _channel_params(offset, n_channels, 'offset')
+        scales = _channel_params(scale, n_channels, 'scale')
+        offv, scalev = offsets, scales
+        nb, used = np.zeros(n_channels, 'intc'), np.zeros(n_channels, 'intc')
+        nbv, usedv = nb, used
+        
+        sections = [_buffer_meta(data, &buffer)]
+        reserve = len(_channels_section(offsets, scales, nb, nb, used, streams))
+        out = _compress_output(out, n_channels*(bound + 64) + len(_frame_trailer(n_pixels, sections)) + reserve + 16)
+        ov = out
+    except:
+        PyBuffer_Release(&buffer)
+        raise
+    cdef uint8_t *quant
+    cdef unsigned int pos = 0
     
     with nogil:
-        quantize_u16(<uint16_t *>buffer.buf, &qv[0], orig_size, offset, scale)
-        nb = Huffman_Compress(&qv[0], &ov[0], orig_size)
+        quant = <uint8_t *>malloc(<size_t>n_pixels*n_channels + 1)
+        if quant != NULL:
+            quantize_u16_channels(<uint16_t *>buffer.buf, quant, n_pixels, n_channels, &offv[0], &scalev[0])
+            for c in range(n_channels):
+                nbv[c] = _entropy_encode(quant + <size_t>c*n_pixels, &ov[pos], n_pixels, icoder, streams, bound,
+                                         &usedv[c], NULL)
+                pos += nbv[c]
+            free(quant)
         
     PyBuffer_Release(&buffer)
-    # store length in last 4 bytes
-    (<uint32_t *>(&ov[nb]))[0] = orig_size
-    return out[:(nb + 4)]
+    if quant == NULL:
+        raise MemoryError()
+    
+    starts = np.concatenate([[0], np.cumsum(nb)[:-1]])
+    sections.append(_channels_section(offsets, scales, starts, nb, used, streams))
+    out = _finish_frame(out, pos, CODER_HUFFMAN, streams, n_pixels*n_channels, sections)
+    _report('huffman_compress_quant_channels_buffer')
+    return out
+
+
+# Size estimation
+# ---------------
+# Huffman and rANS are order-0 coders, so the coded size only depends on the symbol histogram - which we can estimate
+# from a sample of the data for a fraction of the cost of compressing it. We histogram evenly spaced blocks (rather
+# than individual symbols, which would be cache unfriendly) and use the spread between blocks for the error bound.
+
+cdef enum:
+    _ESTIMATE_BLOCK = 4096  # symbols per sampled block
+
+def _huffman_code_lengths(hist):
+    """ code lengths (in bits) which Huffman coding assigns each symbol, given the symbol histogram """
+    import heapq
+    lengths = np.zeros(len(hist), 'f8')
+    symbols = np.flatnonzero(hist)
+    if len(symbols) == 1:
+        lengths[symbols] = 1
+        return lengths
+    
+    heap = [(int(hist[k]), i, [k]) for i, k in enumerate(symbols)]
+    heapq.heapify(heap)
+    i = len(heap)
+    while len(heap) > 1:
+        c1, _, s1 = heapq.heappop(heap)
+        c2, _, s2 = heapq.heappop(heap)
+        lengths[s1 + s2] += 1
+        heapq.heappush(heap, (c1 + c2, i, s1 + s2))
+        i += 1
+    
+    return lengths
+
+def _rans_code_lengths(hist):
+    """ (fractional) code lengths for rANS, from the frequencies it would use """
+    freq = np.where(hist > 0, np.maximum(np.round(4096.*hist/hist.sum()), 1), 0)
+    freq = freq*(4096./freq.sum())
+    with np.errstate(divide='ignore'):
+        return np.where(freq > 0, 12 - np.log2(np.maximum(freq, 1e-9)), 0)
+
+@cython.boundscheck(False)
+def estimate_compressed_size(data, mode='lossless', float offset=0, float scale=1, int bits=8, coder='huffman',
+                             unsigned int streams=1, double sample=1./16):
+    """
+    Estimate the size of the frame which compressing `data` would give, from the histogram of an evenly spaced
+    (strided) sample of about `sample` of the data, without compressing it.
+    
+    Parameters
+    ----------
+    data : contiguous buffer
+    mode : str
+        'lossless' (as for `huffman_compress_buffer`), 'sqrt' (as for `huffman_compress_quant_buffer` for uint16 data,
+        or `huffman_compress_quant_f32_buffer` for float32 data) or 'linear' (float32 only).
+    offset, scale, bits, coder, streams : 
+        As for the corresponding compression function.
+    sample : float
+        Fraction of the data to sample (at least 64 blocks of 4096 symbols are used, or all the data if it is smaller).
+    
+    Returns
+    -------
+    dict with keys 'size' (the estimated frame size in bytes), 'error' (an approximate 3 sigma bound on the error
+    of the estimate), 'bits_per_symbol' (of the coded payload), 'n_symbols' and 'sampled' (number of symbols
+    sampled). Sampling all the data gives the size to within the rounding of the rANS frequencies.
+    """
+    _check_streams(streams)
+    cdef int icoder = _coder_id(coder)
+    if mode not in ('lossless', 'sqrt', 'linear'):
+        raise ValueError("mode should be 'lossless', 'sqrt' or 'linear', not %r" % (mode,))
+    if not (1 <= bits <= 8):
+        raise ValueError('bits should be between 1 and 8')
+    
+    cdef Py_buffer buffer
+    PyObject_GetBuffer(data, &buffer, PyBUF_ANY_CONTIGUOUS)
+    
+    # 0 - bytes, 1 - uint16 sqrt quantization, 2 - float32 quantization
+    cdef int kind = 0, imode = QUANT_SQRT
+    cdef unsigned int itemsize = 1
+    try:
+        sections = [_buffer_meta(data, &buffer)]
+        if mode != 'lossless':
+            dt = _dtype_str(data, buffer.itemsize)
+            if dt == '<f4':
+                kind, itemsize, imode = 2, 4, _QUANT_MODES[mode]
+            elif buffer.itemsize == 2 and mode == 'sqrt':
+                kind, itemsize, bits = 1, 2, 8
+            else:
+                raise ValueError('%s quantization needs %s data' % (mode, 'uint16 or float32' if mode == 'sqrt'
+                                                                          else 'float32'))
+            sections.append(_quant_section(imode, bits, offset, scale))
+    except:
+        PyBuffer_Release(&buffer)
+        raise
+    
+    cdef uint64_t n = buffer.len//itemsize
+    cdef uint64_t n_blocks = (n + _ESTIMATE_BLOCK - 1)//_ESTIMATE_BLOCK
+    cdef uint64_t n_sampled = min(n_blocks, max(64, int(np.ceil(n_blocks*sample))))
+    
+    block_hists = np.zeros((max(n_sampled, 1), 256), 'uint32')
+    block_sizes = np.zeros(max(n_sampled, 1), 'f8')
+    cdef uint32_t [:, ::1] hv = block_hists
+    cdef double [::1] sv = block_sizes
+    cdef uint64_t i, start, length
+    cdef uint8_t *block
+    cdef uint8_t *scratch = NULL
+    
+    with nogil:
+        scratch = <uint8_t *>malloc(_ESTIMATE_BLOCK)
+        if scratch != NULL:
+            for i in range(n_sampled):
+                start = ((i*n_blocks)//n_sampled)*_ESTIMATE_BLOCK
+                length = min(<uint64_t>_ESTIMATE_BLOCK, n - start)
+                block = (<uint8_t *>buffer.buf) + start*itemsize
+                if kind == 1:
+                    quantize_u16(<uint16_t *>block, scratch, length, offset, scale)
+                    block = scratch
+                elif kind == 2:
+                    quantize_f32(<float *>block, scratch, length, imode, bits, offset, scale)
+                    block = scratch
+                
+                Huffman_Histogram(block, length, <unsigned int *>&hv[i, 0])
+                sv[i] = length
+            free(scratch)
+    
+    PyBuffer_Release(&buffer)
+    if scratch == NULL:
+        raise MemoryError()
+    
+    hist = block_hists.sum(0)
+    n_symbols = int((hist > 0).sum())
+    sampled = block_sizes.sum()
+    
+    # header_bits are coded in the same bit stream as the payload, header bytes are separate
+    header_bits, header = 0, 0
+    if n_symbols == 0:
+        rate, sampling_error = 0., 0.
+    else:
+        lengths = _rans_code_lengths(hist) if icoder == CODER_RANS else _huffman_code_lengths(hist)
+        block_bits = block_hists.dot(lengths)
+        rate = block_bits.sum()/sampled
+        
+        sampling_error = 0.
+        if n_sampled < n_blocks:
+            # standard error of a ratio estimator, with the finite population correction
+            resid = block_bits - rate*block_sizes
+            se = resid.std(ddof=1)/block_sizes.mean()/np.sqrt(n_sampled)*np.sqrt(1. - float(n_sampled)/n_blocks)
+            # symbols we didn't see would also need codes / table entries
+            sampling_error = 3*se*n/8. + (256 - n_symbols)*(10 if icoder == CODER_HUFFMAN else 2)/8.
+        
+        if icoder == CODER_RANS:
+            header = 1 + 32 + (hist > 0).dot(np.where(hist > 0.03*hist.sum(), 2, 1)) + 4*RANS_NSTATES
+            sections.append(_coder_section(CODER_RANS, RANS_NSTATES))
+        elif streams > 1:
+            # the streams start byte aligned after the tree, and are each padded to a whole byte (~1/2 byte on average)
+            header = (10*n_symbols - 1 + 7)//8 + 1 + 4*streams + streams//2
+            sections.append(_coder_section(CODER_HUFFMAN_MS, streams))
+        else:
+            header_bits = 10*n_symbols - 1
+    
+    size = int(np.ceil((rate*n + header_bits)/8.)) + header + len(_frame_trailer(n, sections))
+    return {'size': size, 'error': int(np.ceil(sampling_error + 0.005*rate*n/8. + 4*streams)),
+            'bits_per_symbol': float(rate), 'n_symbols': n, 'sampled': int(sampled)}
 
 @cython.boundscheck(False)
 def HuffmanCompressQuant(data, float offset, float scale):
@@ -104,16 +1038,23 @@ def HuffmanCompressQuant(data, float offset, float scale):
     
     cdef int dsize = data.size
     
-    out = np.zeros(int(dsize*1.01 + 320),'uint8')
-    quant = np.zeros(dsize, 'uint8')
+    cdef unsigned long long t0 = _alloc_start()
+    out = np.empty(int(dsize*1.01 + 320),'uint8')
+    _alloc_stop(t0, out.nbytes)
     cdef unsigned char [:] ov = out
-    cdef unsigned char [:] qv = quant
+    cdef uint8_t *quant
     
     with nogil:
-        quantize_u16(<uint16_t *>view.buf, &qv[0], dsize, offset, scale)
-        nb = Huffman_Compress(&qv[0], &ov[0], dsize)
+        quant = <uint8_t *>malloc(dsize + 1)
+        if quant != NULL:
+            quantize_u16(<uint16_t *>view.buf, quant, dsize, offset, scale)
+            nb = Huffman_Compress(quant, &ov[0], dsize)
+            free(quant)
         
     PyBuffer_Release(&view)
+    if quant == NULL:
+        raise MemoryError()
+    _report('HuffmanCompressQuant')
     return out[:nb]
 
 @cython.boundscheck(False)    
@@ -128,35 +1069,359 @@ def HuffmanCompressOrig(unsigned char[:] data):
 
 @cython.boundscheck(False)   
 def HuffmanDecompress(unsigned char[:] data, unsigned int outsize):
-    out = np.zeros(outsize,'uint8')
+    cdef unsigned long long t0 = _alloc_start()
+    out = np.empty(outsize,'uint8')
+    _alloc_stop(t0, outsize)
     cdef unsigned char [:] ov = out
     cdef int insize = data.shape[0]
     #cdef int outsize = outsize
     with nogil:
         
         Huffman_Uncompress(&data[0], &ov[0], insize, outsize)
+    _report('HuffmanDecompress')
     return out
     
+cdef enum:
+    MAX_DIMS = 32
+
+cdef inline int _decode_whole(int coder, uint8_t *src, uint8_t *dst, unsigned int insize, unsigned int outsize) nogil:
+    if coder == _RANS:
+        return Rans_Uncompress(src, dst, insize, outsize)
+    elif coder == _LABEL_RLE:
+        return LabelRLE_Uncompress(src, dst, insize, outsize)
+    
+    return Huffman_Uncompress_MS(src, dst, insize, outsize)
+
 @cython.boundscheck(False)
-def huffman_decompress_buffer(data,  out):
-    cdef Py_buffer buffer
-    PyObject_GetBuffer(data, &buffer, PyBUF_C_CONTIGUOUS)
-    cdef Py_buffer outb
-    #assert(PyBuffer_IsContiguous(data, 'C'))
-    cdef int outlen = (<uint32_t *>(&(<uint8_t *>buffer.buf)[buffer.len-4]))[0]
-    #print('outlen:', outlen)
+cdef _decode_into(data, unsigned int payload_size, unsigned int n_symbols, out, order, lut, int coder=CODER_HUFFMAN):
+    """
+    Decode the payload of `data` into `out`, which can be any writable buffer (including non-contiguous ones). If
+    `lut` is given, each decoded symbol is replaced by `lut[symbol]` (used for dequantization), otherwise the decoded
+    bytes are the raw bytes of the output elements. The elements of `out` are filled in `order` order.
+    """
+    cdef Py_buffer buffer, outb
+    cdef int64_t shape[MAX_DIMS]
+    cdef int64_t strides[MAX_DIMS]
+    cdef int ndim, i, j
+    cdef int64_t n_items = 1
+    cdef bint contiguous
+    cdef const unsigned char *lutp = NULL
+    cdef unsigned char [:] lv
+    cdef uint8_t *tmp = NULL
+    cdef int err = 0
+    
+    if lut is not None:
+        lv = lut.view('uint8')
+        lutp = &lv[0]
+    
+    PyObject_GetBuffer(out, &outb, PyBUF_STRIDES | PyBUF_WRITABLE)
+    try:
+        ndim = outb.ndim
+        if ndim > MAX_DIMS:
+            raise ValueError('Output has too many dimensions')
+        
+        if ndim == 0:
+            ndim = 1
+            shape[0] = 1
+            strides[0] = outb.itemsize
+        else:
+            for i in range(ndim):
+                # fill in the destination in the order the data was encoded
+                j = (ndim - 1 - i) if order == 'F' else i
+                shape[i] = outb.shape[j]
+                strides[i] = outb.strides[j]
+        
+        for i in range(ndim):
+            n_items *= shape[i]
+        
+        if lut is not None and lut.itemsize != outb.itemsize:
+            raise ValueError('Output dtype does not match the dtype of the compressed data')
+        
+        if (n_items if lut is not None else n_items*outb.itemsize) != n_symbols:
+            raise ValueError('Output buffer size does not match decoded size (%d symbols)' % n_symbols)
+        
+        contiguous = (lut is None) and PyBuffer_IsContiguous(&outb, b'F'[0] if order == 'F' else b'C'[0])
+        
+        if coder not in (CODER_HUFFMAN, CODER_HUFFMAN_MS, CODER_RANS, CODER_LABEL_RLE):
+            raise ValueError('Unsupported entropy coder: %d' % coder)
+        
+        PyObject_GetBuffer(data, &buffer, PyBUF_C_CONTIGUOUS)
+        with nogil:
+            if coder != _HUFFMAN:
+                # the other coders can't be decoded block by block, so strided output goes through a scratch buffer
+                if contiguous:
+                    err = _decode_whole(coder, <uint8_t *>buffer.buf, <uint8_t *>outb.buf, payload_size, n_symbols)
+                else:
+                    tmp = <uint8_t *>malloc(n_symbols + 1)
+                    if tmp == NULL:
+                        err = -2
+                    else:
+                        err = _decode_whole(coder, <uint8_t *>buffer.buf, tmp, payload_size, n_symbols)
+                        if err == 0:
+                            Huffman_Scatter(tmp, <uint8_t *>outb.buf, n_symbols, ndim, shape, strides, outb.itemsize,
+                                            lutp)
+                        free(tmp)
+            elif contiguous:
+                Huffman_Uncompress(<uint8_t *>buffer.buf, <uint8_t *>outb.buf, payload_size, n_symbols)
+            else:
+                Huffman_Uncompress_Strided(<uint8_t *>buffer.buf, <uint8_t *>outb.buf, payload_size, n_symbols,
+                                           ndim, shape, strides, outb.itemsize, lutp)
+        PyBuffer_Release(&buffer)
+        
+        if err == -2:
+            raise MemoryError()
+        elif err != 0:
+            raise ValueError('Corrupt payload')
+    finally:
+        PyBuffer_Release(&outb)
+
+def _dequant_lut(float offset, float scale):
+    lut = np.empty(256, 'uint16')
+    cdef uint16_t [:] lv = lut
+    dequantize_u16_table(offset, scale, &lv[0])
+    return lut
+
+def _dequant_lut_f32(int mode, float offset, float scale):
+    lut = np.empty(256, 'float32')
+    cdef float [:] lv = lut
+    dequantize_f32_table(mode, offset, scale, &lv[0])
+    return lut
+
+def _frame_lut(info):
+    """ dequantization table for a frame (None for lossless frames) """
+    quant = info['quant']
+    if quant is None:
+        return None
+    
+    if info['dtype'] is not None and info['dtype'].kind == 'f':
+        if quant['mode'] in (QUANT_SQRT, QUANT_LINEAR):
+            return _dequant_lut_f32(quant['mode'], quant['offset'], quant['scale'])
+    elif quant['mode'] == QUANT_SQRT:
+        return _dequant_lut(quant['offset'], quant['scale'])
+    
+    raise ValueError('Unsupported quantization mode: %d' % quant['mode'])
+
+def _output_for(info, dtype=None):
+    cdef unsigned long long t0 = _alloc_start()
+    if info['shape'] is not None:
+        out = np.empty(info['shape'], dtype if dtype is not None else info['dtype'], order=info['order'])
+    else:
+        out = np.empty(info['n_symbols'], dtype if dtype is not None else 'uint8')
+    _alloc_stop(t0, out.nbytes)
+    return out
+
+@cython.boundscheck(False)
+def huffman_decompress_buffer(data, out=None):
+    """
+    Decompress a frame produced by `huffman_compress_buffer` (or `huffman_compress_quant_buffer` /
+    `huffman_compress_quant_f32_buffer`, in which case the data is also dequantized).
+
+    Parameters
+    ----------
+    data : buffer
+        The compressed frame
+    out : writable buffer, optional
+        Destination. Can be non-contiguous (e.g. a slice of a larger array), in which case the data is decoded
+        straight into place. If None, an array with the dtype, shape and memory order recorded in the frame is
+        allocated (a flat uint8 array for legacy frames).
+    """
+    info = frame_info(data)
+    
+    if info['channels'] is not None:
+        out = _decode_channels(data, info, out)
+        _report('huffman_decompress_buffer')
+        return out
+    
+    lut = _frame_lut(info)
     
     if out is None:
-        out = np.zeros(outlen, 'uint8')
+        out = _output_for(info)
+    
+    _decode_into(data, info['payload_size'], info['n_symbols'], out, info['order'], lut, info['coder'])
+    
+    _report('huffman_decompress_buffer')
+    return out
+
+def _decode_channels(data, info, out):
+    """
+    Decode a multi-channel frame. Each channel is decoded (and dequantized) straight into its strided view of the
+    output, `out[..., c]`, so the channels are re-interleaved without any intermediate buffers.
+    """
+    channels = info['channels']
+    if out is None:
+        out = _output_for(info)
+    
+    a = np.asarray(out)
+    if a.ndim == 0 or a.shape[-1] != len(channels):
+        raise ValueError('Output should have the %d channels along its last axis' % len(channels))
+    
+    mv = memoryview(data).cast('B')
+    n_pixels = info['n_symbols']//len(channels)
+    for c, ch in enumerate(channels):
+        start, size = ch['payload_offset'], ch['payload_size']
+        if start + size > info['payload_size']:
+            raise ValueError('Corrupt channels section')
+        _decode_into(mv[start:(start + size)], size, n_pixels, a[..., c], 'C', _dequant_lut(ch['offset'], ch['scale']),
+                     ch['coder'])
+    
+    return out
+
+@cython.boundscheck(False)
+def huffman_decompress_quant_buffer(data, float offset, float scale, out=None):
+    """
+    Decompress a buffer produced by `huffman_compress_quant_buffer` and undo the square root quantization, i.e.
+    `out = (q*scale)**2 + offset`, using the offset and scale given rather than those stored in the frame (needed for
+    legacy frames). Decoding and dequantization happen in a single pass without the GIL, and `out` (uint16) may be
+    non-contiguous.
+    """
+    info = frame_info(data)
+    if info['channels'] is not None:
+        raise ValueError('Multi-channel frames store per-channel quantization, decode with huffman_decompress_buffer')
+    
+    if out is None:
+        out = _output_for(info, 'uint16')
+    
+    _decode_into(data, info['payload_size'], info['n_symbols'], out, info['order'], _dequant_lut(offset, scale),
+                 info['coder'])
+    
+    _report('huffman_decompress_quant_buffer')
+    return out
+
+
+# Label images
+# ------------
+# Segmentation masks / label volumes are mostly long runs of the same value, which Huffman coding handles poorly.
+# They get their own run length coder (coder id CODER_LABEL_RLE), but use the same frame format, so the frames are
+# decoded by `huffman_decompress_buffer` like any other.
+
+def _label_geometry(shape):
+    """ (n_slices, n_rows, row_len) - slices are the last two dimensions """
+    shape = tuple(shape)
+    if len(shape) == 0:
+        return 1, 1, 1
+    elif len(shape) == 1:
+        return 1, 1, shape[0]
+    
+    return int(np.prod(shape[:-2])), shape[-2], shape[-1]
+
+@cython.boundscheck(False)
+def label_compress_buffer(data, out=None, bint entropy=True):
+    """
+    Run length code a label image / mask (any array with 1, 2, 4 or 8 byte items, typically uint8 - uint64 labels).
+    Runs are found along rows, and each 2D slice (the last two dimensions) is coded separately so that it can be
+    decoded on its own with `label_decompress_slice`. If `entropy` is True, the run values and lengths are rANS coded
+    if that makes them smaller.
+    
+    The frame is decoded with `huffman_decompress_buffer`. `out` is as for `huffman_compress_buffer`, but needs to be
+    larger (up to (itemsize + 1) bytes per pixel for pathological data).
+    """
+    data = np.asarray(data)
+    if not data.flags['C_CONTIGUOUS']:
+        data = np.ascontiguousarray(data)
+    if data.itemsize not in (1, 2, 4, 8):
+        raise ValueError('Label data should have 1, 2, 4 or 8 byte items')
+    if data.nbytes >= FRAME_EXTENDED:
+        raise ValueError('Frames are limited to 2GB of data')
     
-    PyObject_GetBuffer(out, &outb, PyBUF_C_CONTIGUOUS)
-    assert(outb.len == outlen)
+    cdef uint64_t n_slices, n_rows, row_len
+    n_slices, n_rows, row_len = _label_geometry(data.shape)
+    cdef unsigned int itemsize = data.itemsize
+    cdef int64_t nb
     
+    sections = [_meta_section(data.dtype.str, data.shape, 'C')]
+    out = _compress_output(out, LabelRLE_Bound(itemsize, n_slices, n_rows, row_len) +
+                           len(_frame_trailer(data.nbytes, sections)) + 16)
+    
+    cdef unsigned char [::1] ov = out
+    cdef const unsigned char [::1] dv = data.reshape(-1).view('uint8')
+    cdef const unsigned char *dp = &dv[0] if data.nbytes > 0 else NULL
     with nogil:
-        Huffman_Uncompress(<uint8_t *>buffer.buf, <uint8_t *>outb.buf, buffer.len-4, outb.len)
+        nb = LabelRLE_Compress(dp, &ov[0], itemsize, n_slices, n_rows, row_len, entropy)
     
-    PyBuffer_Release(&buffer)
-    PyBuffer_Release(&outb)
+    if nb < 0:
+        raise MemoryError()
     
+    out = _finish_frame(out, nb, CODER_LABEL_RLE, 1, data.nbytes, sections)
+    _report('label_compress_buffer')
+    return out
+
+@cython.boundscheck(False)
+def label_decompress_slice(data, index, out=None):
+    """
+    Decode a single 2D slice from a frame produced by `label_compress_buffer`, without decoding the rest of the
+    volume. `index` is the index of the slice in the leading dimensions (an int, or a tuple for > 3D data) and
+    negative indices count from the end.
+    """
+    info = frame_info(data)
+    if info['coder'] != CODER_LABEL_RLE:
+        raise ValueError('Not a label frame')
+    
+    shape = info['shape']
+    n_slices, n_rows, row_len = _label_geometry(shape)
+    lead = shape[:-2]
+    
+    if isinstance(index, tuple):
+        index = int(np.ravel_multi_index(index, lead)) if len(lead) else 0
+    index = int(index)
+    if not (-n_slices <= index < n_slices):
+        raise IndexError('Slice index %d out of range for %d slices' % (index, n_slices))
+    cdef uint64_t idx = index % n_slices
+    
+    slice_shape = shape[-2:] if len(shape) >= 2 else shape
+    if out is None:
+        out = np.empty(slice_shape, info['dtype'])
+        target = out
+    elif isinstance(out, np.ndarray) and out.flags['C_CONTIGUOUS'] and out.nbytes == n_rows*row_len*info['dtype'].itemsize:
+        target = out
+    else:
+        # strided (or otherwise awkward) output - decode into a temporary and copy
+        target = np.empty(slice_shape, info['dtype'])
+    
+    cdef const unsigned char [::1] dv = np.frombuffer(data, 'uint8')
+    cdef unsigned char [::1] tv = target.reshape(-1).view('uint8')
+    cdef uint64_t payload_size = info['payload_size']
+    cdef int err
+    with nogil:
+        err = LabelRLE_UncompressSlices(&dv[0], &tv[0] if tv.shape[0] > 0 else NULL, payload_size, idx, 1)
+    
+    if err == -2:
+        raise MemoryError()
+    elif err != 0:
+        raise ValueError('Corrupt label frame')
+    
+    if target is not out:
+        out[...] = target
+    
+    _report('label_decompress_slice')
+    return out
+
+
+@cython.boundscheck(False)
+def RLECompress(unsigned char[:] data):
+    """ Compress bytes with the (byte-wise) bcl RLE coder """
+    out = np.empty(int(data.shape[0]*1.004 + 1) + 1, 'uint8')
+    cdef unsigned char [:] ov = out
+    cdef int dsize = data.shape[0]
+    cdef int nb = 0
+    if dsize > 0:
+        with nogil:
+            nb = RLE_Compress(&data[0], &ov[0], dsize)
+    return out[:nb]
+
+@cython.boundscheck(False)
+def RLEDecompress(unsigned char[:] data, unsigned int outsize):
+    """
+    Decompress data produced by `RLECompress`. `outsize` must be the size of the original data - a ValueError is
+    raised if it doesn't match, or the data is corrupt.
+    """
+    out = np.empty(outsize, 'uint8')
+    cdef unsigned char [:] ov = out
+    cdef unsigned int insize = data.shape[0]
+    cdef int err = 0
+    if insize > 0 or outsize > 0:
+        with nogil:
+            err = RLE_Uncompress_Checked(&data[0] if insize > 0 else NULL, &ov[0] if outsize > 0 else NULL, insize,
+                                         outsize)
+    if err != 0:
+        raise ValueError('Corrupt RLE data, or outsize does not match the size of the decompressed data')
     return out
-       
\ No newline at end of file
@@ -60,6 +60,10 @@
 *************************************************************************/
 
 #include <stdint.h>
+#include <string.h>
+
+#include "huffman.h"
+#include "../instrument.h"
 
 typedef struct {
     unsigned char *BytePtr;
@@ -367,28 +371,65 @@ static void _Huffman_WriteBits( huff_bitstream_t *stream, unsigned int x,
 
 
 /*************************************************************************
-* _Huffman_Hist() - Calculate (sorted) histogram for a block of data.
+* Huffman_Histogram() - Count the occurrences of each byte value in a block
+* of data. Also used by the rANS coder, so both coders share one pass.
+*************************************************************************/
+
+void Huffman_Histogram( const unsigned char *in, unsigned int size,
+  unsigned int *hist )
+{
+  unsigned int k;
+  unsigned int counts[4][256];
+
+  memset( counts, 0, sizeof(counts) );
+
+  /* Build histogram. Runs of the same symbol (common in image data) make
+     consecutive increments of a single counter wait on each other
+     (store-to-load forwarding), so we spread them over 4 sub-histograms. */
+  for( k = 0; k + 4 <= size; k += 4 )
+  {
+    counts[0][in[k]] ++;
+    counts[1][in[k+1]] ++;
+    counts[2][in[k+2]] ++;
+    counts[3][in[k+3]] ++;
+  }
+  for( ; k < size; ++ k )
+  {
+    counts[0][in[k]] ++;
+  }
+
+  for( k = 0; k < 256; ++ k )
+  {
+    hist[k] = counts[0][k] + counts[1][k] + counts[2][k] + counts[3][k];
+  }
+}
+
+
+/*************************************************************************
+* _Huffman_Hist() - Calculate (sorted) histogram for a block of data, or
+* use a precomputed one (counts != NULL).
 *************************************************************************/
 
 static void _Huffman_Hist( unsigned char *in, huff_sym_t *sym,
-  unsigned int size )
+  unsigned int size, const unsigned int *counts )
 {
-  int k;
+  unsigned int k;
+  unsigned int hist[256];
+
+  if( counts == NULL )
+  {
+    Huffman_Histogram( in, size, hist );
+    counts = hist;
+  }
 
   /* Clear/init histogram */
   for( k = 0; k < 256; ++ k )
   {
     sym[k].Symbol = k;
-    sym[k].Count  = 0;
+    sym[k].Count  = counts[k];
     sym[k].Code   = 0;
     sym[k].Bits   = 0;
   }
-
-  /* Build histogram */
-  for( k = size; k; -- k )
-  {
-    sym[*in ++].Count ++;
-  }
 }
 
 
@@ -576,7 +617,7 @@ int Huffman_Compress_( unsigned char *in, unsigned char *out,
   _Huffman_InitBitstream( &stream, out );
 
   /* Calculate and sort histogram for input data */
-  _Huffman_Hist( in, sym, insize );
+  _Huffman_Hist( in, sym, insize, NULL );
 
   /* Build Huffman tree */
   _Huffman_MakeTree( sym, &stream );
@@ -621,6 +662,19 @@ int Huffman_Compress_( unsigned char *in, unsigned char *out,
 
 int Huffman_Compress( unsigned char *in, unsigned char *out,
                      unsigned int insize )
+{
+    return Huffman_Compress_Counts( in, out, insize, NULL );
+}
+
+
+/*************************************************************************
+* Huffman_Compress_Counts() - As Huffman_Compress(), but with a
+* precomputed histogram of the input (from Huffman_Histogram()), for
+* callers which need the histogram themselves.
+*************************************************************************/
+
+int Huffman_Compress_Counts( unsigned char *in, unsigned char *out,
+                     unsigned int insize, const unsigned int *counts )
 {
     huff_sym_t       sym[256], tmp;
     huff_bitstream_t stream;
@@ -634,14 +688,23 @@ int Huffman_Compress( unsigned char *in, unsigned char *out,
 
 
     
+    PYME_STATS_START(t0);
+
     /* Do we have anything to compress? */
     if( insize < 1 ) return 0;
     
     /* Initialize bitstream */
     _Huffman_InitBitstream( &stream, out );
     
+    /* The bit writers OR into the output, so the region holding the tree (at
+       most 10 bits per symbol) needs to be cleared. Doing it here means callers
+       can pass uninitialised output buffers. */
+    memset( out, 0, (10*(insize < 256 ? insize : 256))/8 + 2 );
+    
     /* Calculate and sort histogram for input data */
-    _Huffman_Hist( in, sym, insize );
+    _Huffman_Hist( in, sym, insize, counts );
+    PYME_STATS_STOP(PYME_STAGE_HISTOGRAM, t0, insize, 0);
+    PYME_STATS_START(t1);
     
     /* Build Huffman tree */
     _Huffman_MakeTree( sym, &stream );
@@ -666,6 +729,8 @@ int Huffman_Compress( unsigned char *in, unsigned char *out,
     /* Get current stream state */
     buf = stream.BytePtr;
     bit = stream.BitPos;
+    PYME_STATS_STOP(PYME_STAGE_TREE, t1, 0, (uint64_t)(buf - out));
+    PYME_STATS_START(t2);
     
     /* Encode input stream */
     for( k = 0; k < insize; ++ k )
@@ -700,6 +765,7 @@ int Huffman_Compress( unsigned char *in, unsigned char *out,
         //++ total_bytes;
         total_bytes += (stream.BitPos/8 + 1);
     }
+    PYME_STATS_STOP(PYME_STAGE_ENCODE, t2, insize, total_bytes);
     
     return total_bytes;
 }
@@ -724,6 +790,8 @@ void Huffman_Uncompress( unsigned char *in, unsigned char *out,
   unsigned int      k, node_count;
   unsigned char     *buf;
 
+  PYME_STATS_START(t0);
+
   /* Do we have anything to decompress? */
   if( insize < 1 ) return;
 
@@ -733,6 +801,8 @@ void Huffman_Uncompress( unsigned char *in, unsigned char *out,
   /* Recover Huffman tree */
   node_count = 0;
   root = _Huffman_RecoverTree( nodes, &stream, &node_count );
+  PYME_STATS_STOP(PYME_STAGE_DECODE_TREE, t0, (uint64_t)(stream.BytePtr - in), 0);
+  PYME_STATS_START(t1);
 
   /* Decode input stream */
   buf = out;
@@ -752,4 +822,545 @@ void Huffman_Uncompress( unsigned char *in, unsigned char *out,
     /* We found the matching leaf node and have the symbol */
     *buf ++ = (unsigned char) node->Symbol;
   }
+  PYME_STATS_STOP(PYME_STAGE_DECODE, t1, insize, outsize);
+}
+
+
+/*************************************************************************
+* _Huffman_CopyItem() - Copy a single (small) item. Constant size memcpy's
+* compile to a single load/store.
+*************************************************************************/
+
+static inline void _Huffman_CopyItem( unsigned char *dst,
+  const unsigned char *src, unsigned int itemsize )
+{
+  switch( itemsize )
+  {
+    case 1: *dst = *src; break;
+    case 2: memcpy( dst, src, 2 ); break;
+    case 4: memcpy( dst, src, 4 ); break;
+    case 8: memcpy( dst, src, 8 ); break;
+    default: memcpy( dst, src, itemsize );
+  }
+}
+
+
+/*************************************************************************
+* Huffman_Uncompress_Strided() - Uncompress directly into a (possibly non
+* contiguous) n-dimensional destination.
+*  in       - Input (compressed) buffer.
+*  out      - Pointer to the first element of the output.
+*  insize   - Number of input bytes.
+*  outsize  - Number of symbols to decode.
+*  ndim     - Number of output dimensions (max 32).
+*  shape    - Output shape. Elements are filled in C order (last index
+*             fastest) - pass reversed shape/strides for Fortran order.
+*  strides  - Output strides, in bytes.
+*  itemsize - Size of one output element, in bytes.
+*  lut      - If NULL, symbols are raw output bytes and itemsize consecutive
+*             symbols make up one element. Otherwise each symbol is one
+*             element, with the value lut[itemsize*symbol:itemsize*(symbol+1)]
+*             (used to fold dequantization into decoding).
+* Symbols are decoded into a small, cache resident, block and then copied
+* to their destination, so the output is only written once.
+*************************************************************************/
+
+#define STRIDED_BLOCK_SIZE 4096
+#define MAX_STRIDED_DIMS 32
+
+void Huffman_Uncompress_Strided( unsigned char *in, unsigned char *out,
+  unsigned int insize, unsigned int outsize, int ndim, const int64_t *shape,
+  const int64_t *strides, unsigned int itemsize, const unsigned char *lut )
+{
+  huff_decodenode_t nodes[MAX_TREE_NODES], *root, *node;
+  huff_bitstream_t  stream;
+  unsigned int      k, node_count, block_size, nsym, j;
+  unsigned char     block[STRIDED_BLOCK_SIZE];
+  int64_t           idx[MAX_STRIDED_DIMS];
+  unsigned char     *dst;
+  unsigned int      sym_per_item;
+  int               d, inner;
+  int64_t           inner_stride, inner_len;
+
+  PYME_STATS_START(t0);
+
+  /* Do we have anything to decompress? */
+  if( (insize < 1) || (ndim < 1) || (ndim > MAX_STRIDED_DIMS) ) return;
+
+  /* Initialize bitstream */
+  _Huffman_InitBitstream( &stream, in );
+
+  /* Recover Huffman tree */
+  node_count = 0;
+  root = _Huffman_RecoverTree( nodes, &stream, &node_count );
+  PYME_STATS_STOP(PYME_STAGE_DECODE_TREE, t0, (uint64_t)(stream.BytePtr - in), 0);
+  PYME_STATS_START(t1);
+
+  sym_per_item = lut ? 1 : itemsize;
+  block_size = STRIDED_BLOCK_SIZE - (STRIDED_BLOCK_SIZE % sym_per_item);
+
+  for( d = 0; d < ndim; ++ d ) idx[d] = 0;
+  inner = ndim - 1;
+  inner_stride = strides[inner];
+  inner_len = shape[inner];
+  dst = out;
+
+  for( k = 0; k < outsize; k += nsym )
+  {
+    nsym = outsize - k;
+    if( nsym > block_size ) nsym = block_size;
+
+    /* Decode a block of symbols */
+    for( j = 0; j < nsym; ++ j )
+    {
+      node = root;
+      while( node->Symbol < 0 )
+      {
+        if( _Huffman_ReadBit( &stream ) )
+          node = node->ChildB;
+        else
+          node = node->ChildA;
+      }
+      block[j] = (unsigned char) node->Symbol;
+    }
+
+    /* Scatter into the destination */
+    for( j = 0; j + sym_per_item <= nsym; j += sym_per_item )
+    {
+      if( lut )
+        _Huffman_CopyItem( dst, lut + itemsize*block[j], itemsize );
+      else
+        _Huffman_CopyItem( dst, block + j, itemsize );
+
+      /* advance to the next element */
+      dst += inner_stride;
+      if( ++ idx[inner] == inner_len )
+      {
+        for( d = inner; (d > 0) && (idx[d] == shape[d]); -- d )
+        {
+          dst -= shape[d]*strides[d];
+          idx[d] = 0;
+          dst += strides[d-1];
+          ++ idx[d-1];
+        }
+      }
+    }
+  }
+  PYME_STATS_STOP(PYME_STAGE_DECODE, t1, insize, outsize);
+}
+
+
+/*************************************************************************
+* Multi-stream Huffman coding.
+*
+* The input is split into nstreams (up to HUFF_MAX_STREAMS) contiguous
+* segments which share a single tree, but are coded as separate bit
+* streams. Decoding all of the streams in lock-step gives the CPU several
+* independent dependency chains to work on, so a single thread can have
+* several symbols in flight at once. The layout of the compressed data is:
+*
+*   [tree][pad to byte][uint8 nstreams][uint32 stream sizes x nstreams]
+*   [stream 0][stream 1]...
+*
+* Stream sizes are little endian. Segment k holds symbols
+* [k*q, min((k+1)*q, insize)) with q = ceil(insize/nstreams).
+*************************************************************************/
+
+#define HUFF_MAX_STREAMS 8
+#define HUFF_TABLE_BITS 11
+
+typedef struct {
+  unsigned char Symbol;
+  unsigned char Bits;    /* > HUFF_TABLE_BITS means "walk the tree from Node" */
+  unsigned short Node;
+} huff_tableentry_t;
+
+typedef struct {
+  uint64_t      Buf;     /* MSB aligned - the next bit is the top bit */
+  unsigned int  Count;   /* number of valid bits in Buf */
+  unsigned char *Ptr;
+  unsigned char *End;
+} huff_bitreader_t;
+
+
+/*************************************************************************
+* _Huffman_EncodeBlock() - Huffman code a block of symbols, starting at a
+* byte boundary. Returns the number of bytes written.
+*************************************************************************/
+
+static unsigned int _Huffman_EncodeBlock( unsigned char *in,
+  unsigned int n, huff_sym_t *sym, unsigned char *out )
+{
+  unsigned int  k, bit, bits_;
+  unsigned char *buf;
+  uint64_t      xi_8;
+  uint8_t       *xi_c = (uint8_t*) &xi_8;
+
+  buf = out;
+  bit = 0;
+  buf[0] = 0;
+
+  for( k = 0; k < n; ++ k )
+  {
+    bits_ = sym[in[k]].Bits + bit;
+    xi_8 = ((uint64_t)sym[in[k]].Code) << (32-bits_);
+
+    buf[0] = buf[0] | xi_c[3];
+    buf[1] = xi_c[2];
+    buf[2] = xi_c[1];
+    buf[3] = xi_c[0];
+
+    bit = bits_ % 8;
+    buf += bits_ / 8;
+  }
+
+  return (unsigned int)(buf - out) + (bit > 0 ? 1 : 0);
+}
+
+
+/*************************************************************************
+* Huffman_Compress_MS() - Compress a block of data as nstreams
+* interleavable Huffman streams (see above).
+*  out    - Output buffer. Must be 384 + 5*nstreams bytes larger than the
+*           input.
+*  counts - Precomputed histogram of the input, or NULL.
+* Returns the size of the compressed data.
+*************************************************************************/
+
+int Huffman_Compress_MS( unsigned char *in, unsigned char *out,
+  unsigned int insize, unsigned int nstreams, const unsigned int *counts )
+{
+  huff_sym_t       sym[256], tmp;
+  huff_bitstream_t stream;
+  unsigned int     k, swaps, q, start, n, nb;
+  unsigned char    *buf, *sizes;
+
+  PYME_STATS_START(t0);
+
+  if( insize < 1 ) return 0;
+  if( nstreams < 1 ) nstreams = 1;
+  if( nstreams > HUFF_MAX_STREAMS ) nstreams = HUFF_MAX_STREAMS;
+
+  _Huffman_InitBitstream( &stream, out );
+  memset( out, 0, (10*(insize < 256 ? insize : 256))/8 + 2 );
+
+  _Huffman_Hist( in, sym, insize, counts );
+  PYME_STATS_STOP(PYME_STAGE_HISTOGRAM, t0, insize, 0);
+  PYME_STATS_START(t1);
+
+  _Huffman_MakeTree( sym, &stream );
+
+  /* Sort histogram - first symbol first (bubble sort) */
+  do
+  {
+    swaps = 0;
+    for( k = 0; k < 255; ++ k )
+    {
+      if( sym[k].Symbol > sym[k+1].Symbol )
+      {
+        tmp      = sym[k];
+        sym[k]   = sym[k+1];
+        sym[k+1] = tmp;
+        swaps    = 1;
+      }
+    }
+  }
+  while( swaps );
+
+  /* stream table, at the next byte boundary */
+  buf = stream.BytePtr + (stream.BitPos > 0 ? 1 : 0);
+  *buf ++ = (unsigned char) nstreams;
+  sizes = buf;
+  buf += 4*nstreams;
+  PYME_STATS_STOP(PYME_STAGE_TREE, t1, 0, (uint64_t)(buf - out));
+  PYME_STATS_START(t2);
+
+  q = (insize + nstreams - 1)/nstreams;
+  for( k = 0; k < nstreams; ++ k )
+  {
+    start = k*q;
+    n = (start < insize) ? ((insize - start < q) ? insize - start : q) : 0;
+    nb = n ? _Huffman_EncodeBlock( in + start, n, sym, buf ) : 0;
+
+    sizes[4*k]   = (unsigned char) (nb & 0xff);
+    sizes[4*k+1] = (unsigned char) ((nb >> 8) & 0xff);
+    sizes[4*k+2] = (unsigned char) ((nb >> 16) & 0xff);
+    sizes[4*k+3] = (unsigned char) ((nb >> 24) & 0xff);
+    buf += nb;
+  }
+  PYME_STATS_STOP(PYME_STAGE_ENCODE, t2, insize, (uint64_t)(buf - out));
+
+  return (int)(buf - out);
+}
+
+
+/*************************************************************************
+* _Huffman_BuildTable() - Fill the decoding look-up-table for all codes
+* below node (which has the given code prefix).
+*************************************************************************/
+
+static void _Huffman_BuildTable( huff_tableentry_t *table,
+  huff_decodenode_t *nodes, huff_decodenode_t *node, unsigned int code,
+  unsigned int bits, unsigned int *maxbits )
+{
+  unsigned int k, first, count;
+
+  if( (node->Symbol >= 0) || (bits == HUFF_TABLE_BITS) )
+  {
+    first = code << (HUFF_TABLE_BITS - bits);
+    count = 1 << (HUFF_TABLE_BITS - bits);
+    for( k = first; k < first + count; ++ k )
+    {
+      if( node->Symbol >= 0 )
+      {
+        table[k].Symbol = (unsigned char) node->Symbol;
+        table[k].Bits = (unsigned char) bits;
+      }
+      else
+      {
+        /* long code - remember where to resume the tree walk */
+        table[k].Symbol = 0;
+        table[k].Bits = HUFF_TABLE_BITS + 1;
+        table[k].Node = (unsigned short) (node - nodes);
+      }
+    }
+    if( node->Symbol < 0 ) *maxbits = 32;
+    else if( bits > *maxbits ) *maxbits = bits;
+    return;
+  }
+
+  _Huffman_BuildTable( table, nodes, node->ChildA, (code<<1)+0, bits+1, maxbits );
+  _Huffman_BuildTable( table, nodes, node->ChildB, (code<<1)+1, bits+1, maxbits );
+}
+
+
+/*************************************************************************
+* Bit reader helpers.
+*************************************************************************/
+
+static inline void _Huffman_Refill( huff_bitreader_t *r )
+{
+  uint64_t v;
+
+  if( r->End - r->Ptr >= 8 )
+  {
+    /* branchless refill - load 8 bytes and keep as many whole bytes as fit */
+    memcpy( &v, r->Ptr, 8 );
+#if defined(__GNUC__)
+    v = __builtin_bswap64( v );
+#else
+    v = ((v & 0xff) << 56) | ((v & 0xff00) << 40) | ((v & 0xff0000) << 24) |
+        ((v & 0xff000000) << 8) | ((v >> 8) & 0xff000000) |
+        ((v >> 24) & 0xff0000) | ((v >> 40) & 0xff00) | (v >> 56);
+#endif
+    r->Buf |= v >> r->Count;
+    r->Ptr += (63 - r->Count) >> 3;
+    r->Count |= 56;
+  }
+  else
+  {
+    /* near the end of the stream - pad with zeros */
+    while( r->Count <= 56 )
+    {
+      if( r->Ptr < r->End )
+        r->Buf |= ((uint64_t) *r->Ptr ++) << (56 - r->Count);
+      r->Count += 8;
+    }
+  }
+}
+
+static inline unsigned char _Huffman_DecodeSymbol( huff_bitreader_t *r,
+  const huff_tableentry_t *table, huff_decodenode_t *nodes )
+{
+  const huff_tableentry_t *e;
+  huff_decodenode_t *node;
+
+  e = &table[r->Buf >> (64 - HUFF_TABLE_BITS)];
+  if( e->Bits <= HUFF_TABLE_BITS )
+  {
+    r->Buf <<= e->Bits;
+    r->Count -= e->Bits;
+    return e->Symbol;
+  }
+
+  /* long code */
+  r->Buf <<= HUFF_TABLE_BITS;
+  r->Count -= HUFF_TABLE_BITS;
+  node = &nodes[e->Node];
+  while( node->Symbol < 0 )
+  {
+    node = (r->Buf >> 63) ? node->ChildB : node->ChildA;
+    r->Buf <<= 1;
+    r->Count -= 1;
+  }
+  return (unsigned char) node->Symbol;
+}
+
+
+/*************************************************************************
+* _Huffman_DecodeStreams() - decode all streams in lock-step. Inlined with
+* a constant nstreams for the common stream counts so that the compiler
+* can keep all the readers in registers and interleave them.
+*************************************************************************/
+
+static inline void _Huffman_DecodeStreams( huff_bitreader_t *r,
+  unsigned char **dst, unsigned int *remaining, unsigned int nstreams,
+  const huff_tableentry_t *table, huff_decodenode_t *nodes,
+  unsigned int per_refill )
+{
+  unsigned int s, j, n;
+
+  /* all streams but the last have the same length, and the last is never longer */
+  n = remaining[nstreams-1];
+
+  for( ; n >= per_refill; n -= per_refill )
+  {
+    for( s = 0; s < nstreams; ++ s ) _Huffman_Refill( &r[s] );
+    for( j = 0; j < per_refill; ++ j )
+    {
+      for( s = 0; s < nstreams; ++ s )
+        *dst[s] ++ = _Huffman_DecodeSymbol( &r[s], table, nodes );
+    }
+  }
+
+  for( s = 0; s < nstreams; ++ s )
+  {
+    remaining[s] -= remaining[nstreams-1] - n;
+    for( j = 0; j < remaining[s]; ++ j )
+    {
+      _Huffman_Refill( &r[s] );
+      *dst[s] ++ = _Huffman_DecodeSymbol( &r[s], table, nodes );
+    }
+  }
+}
+
+
+/*************************************************************************
+* Huffman_Uncompress_MS() - Uncompress data produced by
+* Huffman_Compress_MS().
+*  in      - Input (compressed) buffer.
+*  out     - Output (uncompressed) buffer.
+*  insize  - Number of input bytes.
+*  outsize - Number of output bytes.
+* Returns 0 on success, -1 if the stream table is corrupt.
+*************************************************************************/
+
+int Huffman_Uncompress_MS( unsigned char *in, unsigned char *out,
+  unsigned int insize, unsigned int outsize )
+{
+  huff_decodenode_t nodes[MAX_TREE_NODES], *root;
+  huff_bitstream_t  stream;
+  huff_tableentry_t table[1 << HUFF_TABLE_BITS];
+  huff_bitreader_t  r[HUFF_MAX_STREAMS];
+  unsigned char     *dst[HUFF_MAX_STREAMS], *buf, *end;
+  unsigned int      remaining[HUFF_MAX_STREAMS];
+  unsigned int      k, node_count, nstreams, q, start, nb, maxbits, per_refill;
+
+  PYME_STATS_START(t0);
+
+  if( (insize < 1) || (outsize < 1) ) return 0;
+  end = in + insize;
+
+  /* Recover Huffman tree */
+  _Huffman_InitBitstream( &stream, in );
+  node_count = 0;
+  root = _Huffman_RecoverTree( nodes, &stream, &node_count );
+
+  buf = stream.BytePtr + (stream.BitPos > 0 ? 1 : 0);
+  if( buf >= end ) return -1;
+  nstreams = *buf ++;
+  if( (nstreams < 1) || (nstreams > HUFF_MAX_STREAMS) || (buf + 4*nstreams > end) ) return -1;
+
+  if( root->Symbol >= 0 )
+  {
+    /* Special case: only one symbol */
+    memset( out, root->Symbol, outsize );
+    return 0;
+  }
+
+  maxbits = 0;
+  _Huffman_BuildTable( table, nodes, root, 0, 0, &maxbits );
+  /* a refill leaves at least 56 bits in the reader */
+  per_refill = 56/maxbits;
+  if( per_refill < 1 ) per_refill = 1;
+  if( per_refill > 4 ) per_refill = 4;
+
+  q = (outsize + nstreams - 1)/nstreams;
+  start = 0;
+  for( k = 0; k < nstreams; ++ k )
+  {
+    nb = buf[4*k] | (buf[4*k+1] << 8) | (buf[4*k+2] << 16) | ((unsigned int) buf[4*k+3] << 24);
+    r[k].Buf = 0;
+    r[k].Count = 0;
+    r[k].Ptr = buf + 4*nstreams + start;
+    r[k].End = r[k].Ptr + nb;
+    if( r[k].End > end ) return -1;
+    start += nb;
+
+    dst[k] = out + k*q;
+    remaining[k] = (k*q < outsize) ? ((outsize - k*q < q) ? outsize - k*q : q) : 0;
+  }
+  PYME_STATS_STOP(PYME_STAGE_DECODE_TREE, t0, (uint64_t)(buf - in), 0);
+  PYME_STATS_START(t1);
+
+  switch( nstreams )
+  {
+    case 4:
+      _Huffman_DecodeStreams( r, dst, remaining, 4, table, nodes, per_refill );
+      break;
+    case 8:
+      _Huffman_DecodeStreams( r, dst, remaining, 8, table, nodes, per_refill );
+      break;
+    default:
+      _Huffman_DecodeStreams( r, dst, remaining, nstreams, table, nodes, per_refill );
+  }
+  PYME_STATS_STOP(PYME_STAGE_DECODE, t1, insize, outsize);
+
+  return 0;
+}
+
+
+/*************************************************************************
+* Huffman_Scatter() - Copy decoded symbols to a (possibly non contiguous)
+* n-dimensional destination. Arguments are as for
+* Huffman_Uncompress_Strided(), with in holding outsize decoded symbols.
+* Used for stream formats which can't be decoded block by block.
+*************************************************************************/
+
+void Huffman_Scatter( const unsigned char *in, unsigned char *out,
+  unsigned int outsize, int ndim, const int64_t *shape,
+  const int64_t *strides, unsigned int itemsize, const unsigned char *lut )
+{
+  int64_t       idx[MAX_STRIDED_DIMS];
+  unsigned char *dst;
+  unsigned int  j, sym_per_item;
+  int           d, inner;
+
+  if( (ndim < 1) || (ndim > MAX_STRIDED_DIMS) ) return;
+
+  sym_per_item = lut ? 1 : itemsize;
+  for( d = 0; d < ndim; ++ d ) idx[d] = 0;
+  inner = ndim - 1;
+  dst = out;
+
+  for( j = 0; j + sym_per_item <= outsize; j += sym_per_item )
+  {
+    if( lut )
+      _Huffman_CopyItem( dst, lut + itemsize*in[j], itemsize );
+    else
+      _Huffman_CopyItem( dst, in + j, itemsize );
+
+    /* advance to the next element */
+    dst += strides[inner];
+    if( ++ idx[inner] == shape[inner] )
+    {
+      for( d = inner; (d > 0) && (idx[d] == shape[d]); -- d )
+      {
+        dst -= shape[d]*strides[d];
+        idx[d] = 0;
+        dst += strides[d-1];
+        ++ idx[d-1];
+      }
+    }
+  }
 }
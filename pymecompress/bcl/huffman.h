@@ -36,17 +36,37 @@
 extern "C" {
 #endif
 
+#include <stdint.h>
+
 
 /*************************************************************************
 * Function prototypes
 *************************************************************************/
 
+void Huffman_Histogram( const unsigned char *in, unsigned int size,
+                         unsigned int *hist );
 int Huffman_Compress( unsigned char *in, unsigned char *out,
                       unsigned int insize );
 int Huffman_Compress_( unsigned char *in, unsigned char *out,
                       unsigned int insize );
 void Huffman_Uncompress( unsigned char *in, unsigned char *out,
                          unsigned int insize, unsigned int outsize );
+int Huffman_Compress_Counts( unsigned char *in, unsigned char *out,
+                         unsigned int insize, const unsigned int *counts );
+int Huffman_Compress_MS( unsigned char *in, unsigned char *out,
+                         unsigned int insize, unsigned int nstreams,
+                         const unsigned int *counts );
+int Huffman_Uncompress_MS( unsigned char *in, unsigned char *out,
+                         unsigned int insize, unsigned int outsize );
+void Huffman_Scatter( const unsigned char *in, unsigned char *out,
+                         unsigned int outsize, int ndim, const int64_t *shape,
+                         const int64_t *strides, unsigned int itemsize,
+                         const unsigned char *lut );
+void Huffman_Uncompress_Strided( unsigned char *in, unsigned char *out,
+                         unsigned int insize, unsigned int outsize,
+                         int ndim, const int64_t *shape,
+                         const int64_t *strides, unsigned int itemsize,
+                         const unsigned char *lut );
 
 
 #ifdef __cplusplus
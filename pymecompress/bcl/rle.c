@@ -65,6 +65,8 @@
 * marcus.geelnard at home.se
 *************************************************************************/
 
+#include <string.h>
+#include "rle.h"
 
 
 /*************************************************************************
@@ -321,3 +323,61 @@ void RLE_Uncompress( unsigned char *in, unsigned char *out,
     }
     while( inpos < insize );
 }
+
+
+/*************************************************************************
+* RLE_Uncompress_Checked() - As RLE_Uncompress(), but never reads past
+* the end of the input or writes past the end of the output (pymecompress
+* addition, for data from untrusted sources).
+*  in      - Input (compressed) buffer.
+*  out     - Output (uncompressed) buffer.
+*  insize  - Number of input bytes.
+*  outsize - Size of the output buffer, which must be exactly the size of
+*            the uncompressed data.
+* Returns 0 on success, or -1 if the data is corrupt or the output size
+* does not match.
+*************************************************************************/
+
+int RLE_Uncompress_Checked( unsigned char *in, unsigned char *out,
+    unsigned int insize, unsigned int outsize )
+{
+    unsigned char marker, symbol;
+    unsigned int  inpos, outpos, count;
+
+    if( insize < 1 )
+    {
+        return outsize == 0 ? 0 : -1;
+    }
+
+    inpos = 0;
+    marker = in[ inpos ++ ];
+
+    outpos = 0;
+    while( inpos < insize )
+    {
+        symbol = in[ inpos ++ ];
+        count = 0;
+        if( symbol == marker )
+        {
+            if( inpos >= insize ) return -1;
+            count = in[ inpos ++ ];
+            if( count > 2 )
+            {
+                if( count & 0x80 )
+                {
+                    if( inpos >= insize ) return -1;
+                    count = ((count & 0x7f) << 8) + in[ inpos ++ ];
+                }
+                if( inpos >= insize ) return -1;
+                symbol = in[ inpos ++ ];
+            }
+        }
+
+        /* a run of count + 1 symbols */
+        if( count >= outsize - outpos ) return -1;
+        memset( out + outpos, symbol, count + 1 );
+        outpos += count + 1;
+    }
+
+    return outpos == outsize ? 0 : -1;
+}
@@ -45,6 +45,8 @@ int RLE_Compress( unsigned char *in, unsigned char *out,
                   unsigned int insize );
 void RLE_Uncompress( unsigned char *in, unsigned char *out,
                      unsigned int insize );
+int RLE_Uncompress_Checked( unsigned char *in, unsigned char *out,
+                            unsigned int insize, unsigned int outsize );
 
 
 #ifdef __cplusplus
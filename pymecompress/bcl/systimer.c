@@ -9,6 +9,8 @@
 *
 *  InitTimer() - Initializes the timer.
 *  GetTime()   - Returns the number of seconds since InitTimer was called.
+*  GetCycles() - Returns a free-running cycle/tick counter (reentrant,
+*                does not need InitTimer). Added for pymecompress stats.
 *
 * The code has been tested under Linux, Windows and DOS (DJGPP).
 *
@@ -149,3 +151,39 @@ double GetTime( void )
 
 #endif
 }
+
+
+
+unsigned long long GetCycles( void )
+{
+#if (defined(__x86_64__) || defined(__i386__)) && defined(__GNUC__)
+
+  unsigned int lo, hi;
+  __asm__ __volatile__ ( "rdtsc" : "=a" (lo), "=d" (hi) );
+  return ((unsigned long long) hi << 32) | lo;
+
+#elif defined(__aarch64__) && defined(__GNUC__)
+
+  unsigned long long t;
+  __asm__ __volatile__ ( "mrs %0, cntvct_el0" : "=r" (t) );
+  return t;
+
+#elif defined(WINDOWS_TIMER)
+
+  __int64 t;
+  QueryPerformanceCounter( (LARGE_INTEGER *)&t );
+  return (unsigned long long) t;
+
+#elif defined(GTOD_TIMER)
+
+  struct timeval tv;
+  gettimeofday( &tv, NULL );
+  return 1000000ULL * (unsigned long long) tv.tv_sec +
+         (unsigned long long) tv.tv_usec;
+
+#else
+
+  return 0;
+
+#endif
+}
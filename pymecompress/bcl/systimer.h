@@ -43,6 +43,7 @@ extern "C" {
 
 void InitTimer( void );
 double GetTime( void );
+unsigned long long GetCycles( void );
 
 
 #ifdef __cplusplus
@@ -0,0 +1,138 @@
+"""
+Size bounded LRU cache of decoded chunks, for workloads (e.g. interactive viewers panning and zooming over a zarr
+store) which decode the same chunks over and over.
+
+Entries are keyed by a hash of the compressed bytes plus the codec config, and cached arrays are read-only - lookups
+return views rather than copies. The cache is thread-safe, but does not stop two threads which miss on the same chunk
+at the same time from both decoding it.
+
+Codecs in `pymecompress.codecs` take a `cache` argument. As codecs are usually created from their config (e.g. by
+zarr), a process wide default cache can also be set with `set_default_cache`.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class DecodeCache(object):
+    """
+    LRU cache of decoded arrays holding at most `max_bytes` bytes of data. Arrays larger than `max_bytes` are not
+    cached.
+    """
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def config_key(config):
+        """ canonical form of a codec config, for use in `key` """
+        return json.dumps(config, sort_keys=True)
+
+    @staticmethod
+    def key(buf, config_key=''):
+        """ cache key for compressed data `buf` decoded with a codec with the given `config_key` """
+        # blake2b releases the GIL for large buffers and runs at several GB/s, a small fraction of the decode cost
+        mv = memoryview(buf).cast('B')
+        return hashlib.blake2b(mv, digest_size=16).digest(), len(mv), config_key
+
+    def get(self, key):
+        """ return the (read-only) cached array for `key`, or None """
+        with self._lock:
+            arr = self._entries.get(key, None)
+            if arr is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        return arr.view()
+
+    def put(self, key, arr):
+        """ add `arr` to the cache (as a read-only array, which is returned) """
+        arr = np.asarray(arr)
+        if arr.flags.writeable:
+            # a view could still be written to through its base
+            arr = arr.copy() if arr.base is not None else arr
+            arr.flags.writeable = False
+
+        if arr.nbytes > self.max_bytes:
+            return arr.view()
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+
+            self._entries[key] = arr
+            self._nbytes += arr.nbytes
+
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+        return arr.view()
+
+    def clear(self):
+        """ drop all entries and reset the counters """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def nbytes(self):
+        """ bytes of decoded data currently held """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        """ dict of the cache size and hit / miss counts """
+        with self._lock:
+            return {'entries': len(self._entries), 'nbytes': self._nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+_default_cache = None
+
+def set_default_cache(cache):
+    """
+    Set the cache used by codecs created without an explicit `cache` argument - a `DecodeCache`, a size in bytes
+    (to create one), or None to disable caching. Returns the cache.
+    """
+    global _default_cache
+    if cache is not None and not isinstance(cache, DecodeCache):
+        cache = DecodeCache(cache)
+
+    _default_cache = cache
+    return cache
+
+def get_default_cache():
+    return _default_cache
+
+
+def cached_decode(cache, config_key, buf, out, decode):
+    """
+    Decode `buf` with `decode(buf)`, going through `cache`. Returns a read-only array, or `out` (filled with a copy of
+    the cached data) if given.
+    """
+    key = cache.key(buf, config_key)
+    arr = cache.get(key)
+    if arr is None:
+        arr = cache.put(key, decode(buf))
+
+    if out is None:
+        return arr
+
+    out[...] = arr.reshape(out.shape)
+    return out
@@ -0,0 +1,260 @@
+"""
+Chunk parallel compression of n-dimensional arrays.
+
+Arrays are split into tiles which are compressed concurrently (the bcl kernels release the GIL, so a thread pool
+scales) and stored in a compact container::
+
+    [b'PMCA'][uint32 version][uint32 header length][JSON header]
+    [chunk 0][chunk 1] ... [chunk n-1]
+    [uint64 chunk offsets (n + 1)][uint64 index offset][b'PMCA']
+
+The JSON header records the dtype, shape, chunk shape and codec config. Chunks are stored in C order of the chunk
+grid. The index lives at the end so that containers can be written in a single streaming pass.
+"""
+import itertools
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+MAGIC = b'PMCA'
+VERSION = 1
+
+_PREFIX = struct.Struct('<4sII')
+_FOOTER = struct.Struct('<Q4s')
+
+
+def _get_codec(codec):
+    from . import codecs
+    import numcodecs
+
+    if codec is None:
+        return codecs.Huffman()
+    elif isinstance(codec, dict):
+        return numcodecs.get_codec(dict(codec))
+
+    return codec
+
+
+def _normalize_chunks(chunks, shape):
+    if chunks is None:
+        # default to one chunk per (2D) frame
+        chunks = (1,) * (len(shape) - 2) + tuple(shape[-2:])
+    elif np.isscalar(chunks):
+        chunks = (int(chunks),) * len(shape)
+
+    chunks = tuple(chunks)
+    if len(chunks) != len(shape):
+        raise ValueError('chunks (%s) must have one entry per dimension of the array (%s)' % (chunks, shape))
+
+    return tuple(s if (c is None or c < 0) else max(min(int(c), s), 1) for c, s in zip(chunks, shape))
+
+
+def _chunk_slices(shape, chunks):
+    """ iterate over tile slices, in C order of the chunk grid """
+    grid = [range(0, max(s, 1), c) for s, c in zip(shape, chunks)]
+    for starts in itertools.product(*grid):
+        # indexing a 0-d array with () gives a scalar rather than a view
+        yield tuple(slice(st, min(st + c, s)) for st, c, s in zip(starts, chunks, shape)) or (Ellipsis,)
+
+
+def _bounded_map(pool, fcn, items, window):
+    """ like pool.map, but keeps at most `window` tasks in flight so that out-of-core inputs are not all loaded """
+    pending = []
+    for item in items:
+        pending.append(pool.submit(fcn, item))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+
+    for f in pending:
+        yield f.result()
+
+
+def _is_dask(arr):
+    return hasattr(arr, 'dask') and hasattr(arr, 'chunks')
+
+
+def compress_array(arr, codec=None, chunks=None, workers=None, out=None, progress=None):
+    """
+    Compress an n-D array in tiles, using multiple threads.
+
+    Parameters
+    ----------
+    arr : array-like
+        A numpy array, or anything which can be sliced into numpy arrays (e.g. np.memmap, zarr, h5py or dask arrays).
+        Only the tiles currently being compressed are loaded, so large out-of-core arrays are fine.
+    codec : numcodecs.abc.Codec or dict, optional
+        The codec to compress each tile with (or its config). Defaults to `pymecompress.codecs.Huffman()`.
+    chunks : tuple or int, optional
+        Tile shape. Entries of None or -1 span the whole dimension. Defaults to the chunking of a dask array, or one
+        tile per 2D frame.
+    workers : int, optional
+        Number of threads to use. Defaults to the number of cores.
+    out : file-like, optional
+        If given, the container is streamed to `out` rather than returned.
+    progress : callable, optional
+        Called as `progress(nbytes)` with the (uncompressed) size of each tile once it has been written.
+
+    Returns
+    -------
+    The container as bytes, or the number of bytes written if `out` was given.
+    """
+    codec = _get_codec(codec)
+    shape = tuple(int(s) for s in arr.shape)
+
+    if chunks is None and _is_dask(arr):
+        chunks = tuple(c[0] for c in arr.chunks)
+    chunks = _normalize_chunks(chunks, shape)
+
+    header = json.dumps({'dtype': np.dtype(arr.dtype).str, 'shape': shape, 'chunks': chunks,
+                         'codec': codec.get_config()}).encode('utf-8')
+
+    if out is None:
+        import io
+        f = io.BytesIO()
+    else:
+        f = out
+
+    pos = f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+    pos += f.write(header)
+
+    def _compress(slices):
+        tile = arr[slices]
+        if _is_dask(tile):
+            tile = tile.compute()
+        tile = np.ascontiguousarray(tile)
+        return codec.encode(tile), tile.nbytes
+
+    workers = workers or os.cpu_count() or 1
+    offsets = [pos]
+    with ThreadPoolExecutor(workers) as pool:
+        for compressed, nbytes in _bounded_map(pool, _compress, _chunk_slices(shape, chunks), 2 * workers):
+            pos += f.write(memoryview(compressed).cast('B'))
+            offsets.append(pos)
+            if progress is not None:
+                progress(nbytes)
+
+    index_offset = pos
+    pos += f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+    pos += f.write(_FOOTER.pack(index_offset, MAGIC))
+
+    if out is None:
+        return f.getvalue()
+
+    return pos
+
+
+def container_info(data):
+    """
+    Read the header of a container produced by `compress_array`.
+
+    Returns
+    -------
+    dict with keys 'dtype', 'shape', 'chunks', 'codec' (the codec config) and 'offsets' (the byte offsets of each
+    chunk in the container, with a final entry marking the end of the last chunk).
+    """
+    mv = memoryview(data).cast('B')
+    magic, version, header_len = _PREFIX.unpack_from(mv, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a pymecompress chunked container')
+    if version > VERSION:
+        raise ValueError('Unsupported container version: %d' % version)
+
+    info = json.loads(bytes(mv[_PREFIX.size:(_PREFIX.size + header_len)]).decode('utf-8'))
+    info['dtype'] = np.dtype(info['dtype'])
+    info['shape'] = tuple(info['shape'])
+    info['chunks'] = tuple(info['chunks'])
+
+    index_offset, magic = _FOOTER.unpack_from(mv, len(mv) - _FOOTER.size)
+    if magic != MAGIC:
+        raise ValueError('Truncated pymecompress chunked container')
+    n_offsets = (len(mv) - _FOOTER.size - index_offset) // 8
+    info['offsets'] = struct.unpack_from('<%dQ' % n_offsets, mv, index_offset)
+
+    return info
+
+
+def _decodes_strided(codec):
+    """ whether codec.decode can write straight into a strided `out` (true of the pymecompress codecs) """
+    from . import codecs
+
+    return isinstance(codec, (codecs.Huffman, codecs.HuffmanQuant16, codecs.HuffmanQuant16Channels, codecs.QuantF32,
+                              codecs.LabelRLE))
+
+
+def _decode_chunk(codec, frame, out):
+    """ decode a chunk straight into out (which is usually a strided view of the full array) """
+    if _decodes_strided(codec):
+        codec.decode(frame, out=out)
+        return
+
+    # other codecs mostly only accept contiguous output, if any, and many return bytes which need viewing as an array
+    # of the right dtype
+    from numcodecs.compat import ensure_ndarray
+    out[...] = ensure_ndarray(codec.decode(frame)).view(out.dtype).reshape(out.shape)
+
+
+def decompress_array(data, out=None, workers=None, progress=None):
+    """
+    Decompress a container produced by `compress_array`, using multiple threads.
+
+    Parameters
+    ----------
+    data : buffer
+        The container (bytes, a memory mapped file, ...)
+    out : np.ndarray, optional
+        Array to decompress into. Must have the shape and dtype of the original array, but need not be contiguous.
+    workers : int, optional
+        Number of threads to use. Defaults to the number of cores.
+    progress : callable, optional
+        Called as `progress(nbytes)` with the (uncompressed) size of each tile once it has been decoded (from the
+        worker threads).
+    """
+    mv = memoryview(data).cast('B')
+    info = container_info(mv)
+    codec = _get_codec(info['codec'])
+    offsets = info['offsets']
+
+    if out is None:
+        out = np.empty(info['shape'], info['dtype'])
+    elif (out.shape != info['shape']) or (out.dtype != info['dtype']):
+        raise ValueError('out should have shape %s and dtype %s' % (info['shape'], info['dtype']))
+
+    def _decompress(args):
+        i, slices = args
+        _decode_chunk(codec, mv[offsets[i]:offsets[i + 1]], out[slices])
+        if progress is not None:
+            progress(out[slices].nbytes)
+
+    with ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        list(pool.map(_decompress, enumerate(_chunk_slices(info['shape'], info['chunks']))))
+
+    return out
+
+
+def to_dask(data):
+    """
+    Wrap a container produced by `compress_array` as a dask array, with chunks decoded lazily on demand.
+    """
+    import dask.array as da
+
+    mv = memoryview(data).cast('B')
+    info = container_info(mv)
+    codec = _get_codec(info['codec'])
+    offsets = info['offsets']
+
+    shape, chunks = info['shape'], info['chunks']
+    grid = tuple(max(-(-s // c), 1) for s, c in zip(shape, chunks))
+
+    def _load(block_info=None):
+        loc = block_info[None]['chunk-location']
+        i = int(np.ravel_multi_index(loc, grid))
+        tile_shape = block_info[None]['chunk-shape']
+        out = np.empty(tile_shape, info['dtype'])
+        _decode_chunk(codec, mv[offsets[i]:offsets[i + 1]], out)
+        return out
+
+    dask_chunks = tuple(tuple(min(c, s - st) for st in range(0, max(s, 1), c)) for s, c in zip(shape, chunks))
+    return da.map_blocks(_load, chunks=dask_chunks, dtype=info['dtype'], meta=np.empty((0,) * len(shape), info['dtype']))
@@ -0,0 +1,343 @@
+"""
+Command line tool for bulk compression / decompression of datasets::
+
+    pymecompress compress DATA_DIR -o ARCHIVE_DIR [--codec quant16 --scale 1 ...] [--workers N]
+    pymecompress decompress ARCHIVE_DIR -o DATA_DIR
+    pymecompress info ARCHIVE.pmca
+
+Inputs can be files or directories (searched recursively) of .npy, .mat (v5 needs scipy, v7.3 needs h5py), .tif
+(needs tifffile) or raw (.raw / .bin, with --raw-dtype and --raw-shape) data. Each input becomes a chunked container
+(see `pymecompress.chunked`) with the same relative path and a .pmca extension, and decompresses to .npy.
+
+.npy and raw inputs are memory mapped and read a tile at a time, and decompressed output is written to a memory mapped
+.npy, so files much larger than RAM are fine. Tiles are compressed on a pool of threads.
+
+Completed files are recorded in a manifest (a JSON line per file, in the output directory), and files already in the
+manifest - unchanged since, with the output still in place - are skipped, so interrupted runs can simply be restarted.
+Outputs are written under a temporary name and renamed once complete.
+"""
+import argparse
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+MANIFEST = '.pymecompress-manifest.jsonl'
+
+_INPUT_EXTS = ('.npy', '.mat', '.tif', '.tiff', '.raw', '.bin')
+
+
+def _find_inputs(paths, exts):
+    """ yield (path, path relative to its input root) for each input file """
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                dirs.sort()
+                for fn in sorted(files):
+                    if fn.lower().endswith(exts):
+                        full = os.path.join(root, fn)
+                        yield full, os.path.relpath(full, p)
+        else:
+            yield p, os.path.basename(p)
+
+
+def _load_mat(path, variable=None):
+    """ the named (or largest) array in a .mat file (read into memory) """
+    try:
+        import h5py
+        if h5py.is_hdf5(path):
+            with h5py.File(path, 'r') as f:
+                names = [k for k, v in f.items() if isinstance(v, h5py.Dataset) and not k.startswith('#')]
+                if not names and variable is None:
+                    raise ValueError('No arrays found in %s' % path)
+                name = variable or max(names, key=lambda k: f[k].size)
+                # MATLAB is column major, so h5py sees the dimensions reversed - transpose to match scipy's (v5) arrays
+                return np.ascontiguousarray(f[name][()].T)
+    except ImportError:
+        pass
+
+    import scipy.io
+    mat = scipy.io.loadmat(path)
+    if variable is not None:
+        return mat[variable]
+    arrays = [(k, v) for k, v in mat.items() if not k.startswith('__') and isinstance(v, np.ndarray)]
+    if not arrays:
+        raise ValueError('No arrays found in %s' % path)
+    return max(arrays, key=lambda kv: kv[1].nbytes)[1]
+
+
+def load_input(path, raw_dtype=None, raw_shape=None, mat_variable=None):
+    """ open an input file as an array(-like), memory mapped where possible """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r')
+    elif ext == '.mat':
+        return _load_mat(path, mat_variable)
+    elif ext in ('.tif', '.tiff'):
+        import tifffile
+        try:
+            return tifffile.memmap(path, mode='r')
+        except ValueError:
+            # compressed / non-contiguous tiffs can't be memory mapped
+            return tifffile.imread(path)
+    elif raw_dtype is not None:
+        dtype = np.dtype(raw_dtype)
+        shape = raw_shape or (os.path.getsize(path) // dtype.itemsize,)
+        return np.memmap(path, dtype, 'r', shape=tuple(shape))
+
+    raise ValueError('Don\'t know how to read %s (raw data needs --raw-dtype)' % path)
+
+
+def codec_config(args):
+    """ codec config from the command line options """
+    opts = {'streams': args.streams, 'coder': args.coder}
+    if args.codec == 'huffman':
+        return dict(id='pymecompress-huffman', **opts)
+    elif args.codec == 'quant16':
+        return dict(id='pymecompress-quant16', offset=args.offset, scale=args.scale, **opts)
+    elif args.codec == 'quantf32':
+        return dict(id='pymecompress-quantf32', offset=args.offset, scale=args.scale, mode=args.mode, bits=args.bits,
+                    **opts)
+    elif args.codec == 'labelrle':
+        return {'id': 'pymecompress-labelrle'}
+
+    raise ValueError('Unknown codec: %s' % args.codec)
+
+
+class Manifest(object):
+    """ record of completed files, appended to as each one finishes """
+    def __init__(self, path):
+        self.path = path
+        self._done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # a partly written last line from an interrupted run
+                        continue
+                    self._done[rec['src']] = rec
+
+    @staticmethod
+    def _signature(src):
+        st = os.stat(src)
+        return st.st_size, st.st_mtime_ns
+
+    def is_done(self, src, dst):
+        rec = self._done.get(os.path.abspath(src), None)
+        if rec is None or list(self._signature(src)) != rec['signature']:
+            return False
+        return os.path.exists(dst) and os.path.getsize(dst) == rec['dst_size']
+
+    def add(self, src, dst, **extra):
+        rec = dict(src=os.path.abspath(src), dst=os.path.abspath(dst), signature=list(self._signature(src)),
+                   dst_size=os.path.getsize(dst), **extra)
+        self._done[rec['src']] = rec
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+
+
+class Progress(object):
+    """ throughput reporting, updated from worker threads. `total` is filled in once the input has been opened """
+    def __init__(self, total=0, stream=sys.stderr, interval=0.5):
+        self.total = total
+        self.done = 0
+        self.stream = stream
+        self.interval = interval
+        self._t0 = self._last = time.perf_counter()
+        self._shown = False
+        self._lock = threading.Lock()
+
+    def __call__(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            now = time.perf_counter()
+            if self.stream is not None and (now - self._last) >= self.interval:
+                self._last = now
+                self._shown = True
+                self.stream.write('\r  %5.1f%%  %8.1f MB/s' % (100.*self.done/max(self.total, 1), self.rate()))
+                self.stream.flush()
+
+    def rate(self):
+        return self.done/max(time.perf_counter() - self._t0, 1e-9)/1e6
+
+    def finish(self):
+        if self._shown:
+            self.stream.write('\r' + ' '*40 + '\r')
+
+
+def _report(msg, quiet):
+    if not quiet:
+        print(msg, flush=True)
+
+
+def compress_file(src, dst, config, chunks=None, workers=None, progress=None, **load_kwargs):
+    """ compress one input file into a container at dst. Returns (input bytes, output bytes) """
+    from . import chunked
+
+    arr = load_input(src, **load_kwargs)
+    nbytes = int(np.prod(arr.shape))*np.dtype(arr.dtype).itemsize
+    if progress is not None:
+        progress.total = nbytes
+    tmp = dst + '.partial'
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    try:
+        with open(tmp, 'wb') as f:
+            n = chunked.compress_array(arr, codec=config, chunks=chunks, workers=workers, out=f, progress=progress)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return nbytes, n
+
+
+def decompress_file(src, dst, workers=None, progress=None):
+    """ decompress a container into a .npy file. Returns (input bytes, output bytes) """
+    from . import chunked
+
+    tmp = dst + '.partial'
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    try:
+        with open(src, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            info = chunked.container_info(mm)
+            out = np.lib.format.open_memmap(tmp, 'w+', info['dtype'], info['shape'])
+            if progress is not None:
+                progress.total = out.nbytes
+            chunked.decompress_array(mm, out=out, workers=workers, progress=progress)
+            nbytes = out.nbytes
+            out.flush()
+            del out
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return os.path.getsize(src), nbytes
+
+
+def _run(args):
+    if args.command == 'compress':
+        exts, out_ext = _INPUT_EXTS, '.pmca'
+        config = codec_config(args)
+        load_kwargs = {'raw_dtype': args.raw_dtype, 'raw_shape': args.raw_shape, 'mat_variable': args.mat_variable}
+    else:
+        exts, out_ext = ('.pmca',), '.npy'
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output, MANIFEST))
+
+    inputs = list(_find_inputs(args.inputs, exts))
+    t0 = time.perf_counter()
+    total_in = total_out = 0
+    failed = skipped = 0
+
+    for i, (src, rel) in enumerate(inputs):
+        dst = os.path.join(args.output, os.path.splitext(rel)[0] + out_ext)
+        tag = '[%d/%d] %s' % (i + 1, len(inputs), rel)
+        if not args.force and manifest.is_done(src, dst):
+            skipped += 1
+            _report('%s: already done, skipping' % tag, args.quiet)
+            continue
+
+        t1 = time.perf_counter()
+        try:
+            progress = Progress(stream=None if args.quiet else sys.stderr)
+            if args.command == 'compress':
+                n_in, n_out = compress_file(src, dst, config, args.chunks, args.workers, progress, **load_kwargs)
+            else:
+                n_in, n_out = decompress_file(src, dst, args.workers, progress)
+            progress.finish()
+        except Exception as e:
+            failed += 1
+            print('%s: FAILED - %s: %s' % (tag, type(e).__name__, e), file=sys.stderr, flush=True)
+            continue
+
+        dt = time.perf_counter() - t1
+        manifest.add(src, dst, in_bytes=n_in, out_bytes=n_out, seconds=dt)
+        total_in += n_in
+        total_out += n_out
+        raw, packed = (n_in, n_out) if args.command == 'compress' else (n_out, n_in)
+        _report('%s: %.1f MB -> %.1f MB (ratio %.2f) in %.2f s, %.1f MB/s' %
+                (tag, n_in/1e6, n_out/1e6, raw/max(packed, 1), dt, raw/1e6/max(dt, 1e-9)), args.quiet)
+
+    dt = time.perf_counter() - t0
+    raw = total_in if args.command == 'compress' else total_out
+    _report('%d files (%d skipped, %d failed): %.1f MB -> %.1f MB in %.1f s, %.1f MB/s' %
+            (len(inputs), skipped, failed, total_in/1e6, total_out/1e6, dt, raw/1e6/max(dt, 1e-9)), args.quiet)
+
+    return 1 if failed else 0
+
+
+def _info(args):
+    from . import chunked
+    for path in args.inputs:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            info = chunked.container_info(mm)
+        nbytes = int(np.prod(info['shape']))*info['dtype'].itemsize
+        print('%s: %s %s, chunks %s, %d tiles, codec %s, %.2fx' %
+              (path, info['dtype'].str, tuple(info['shape']), tuple(info['chunks']), len(info['offsets']) - 1,
+               json.dumps(info['codec']), nbytes/max(os.path.getsize(path), 1)))
+    return 0
+
+
+def _shape(s):
+    return tuple(int(v) for v in s.replace('x', ',').split(',') if v)
+
+
+def _chunks(s):
+    return tuple(None if v in ('', 'none', '-1') else int(v) for v in s.split(','))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='pymecompress', description='Bulk compression of image data with '
+                                                                      'pymecompress codecs.')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    for name, help in (('compress', 'compress files / directories into .pmca containers'),
+                       ('decompress', 'decompress .pmca containers to .npy')):
+        p = sub.add_parser(name, help=help)
+        p.add_argument('inputs', nargs='+', help='input files or directories')
+        p.add_argument('-o', '--output', required=True, help='output directory')
+        p.add_argument('-j', '--workers', type=int, default=None, help='worker threads (default: number of cores)')
+        p.add_argument('--manifest', default=None, help='manifest path (default: %s in the output directory)'
+                                                        % MANIFEST)
+        p.add_argument('--force', action='store_true', help='redo files which the manifest records as done')
+        p.add_argument('-q', '--quiet', action='store_true', help='only report failures')
+
+        if name == 'compress':
+            p.add_argument('--codec', choices=('huffman', 'quant16', 'quantf32', 'labelrle'), default='huffman')
+            p.add_argument('--offset', type=float, default=0, help='quantization offset (camera baseline)')
+            p.add_argument('--scale', type=float, default=1, help='quantization scale')
+            p.add_argument('--mode', choices=('sqrt', 'linear'), default='sqrt', help='quantf32 quantization mode')
+            p.add_argument('--bits', type=int, default=8, help='quantf32 bits per pixel')
+            p.add_argument('--coder', choices=('huffman', 'rans'), default='huffman', help='entropy coder')
+            p.add_argument('--streams', type=int, default=1, help='interleaved Huffman streams per tile')
+            p.add_argument('--chunks', type=_chunks, default=None,
+                           help='tile shape, e.g. 1,512,512 (default: one tile per 2D frame)')
+            p.add_argument('--raw-dtype', default=None, help='dtype of raw (.raw / .bin) inputs, e.g. uint16')
+            p.add_argument('--raw-shape', type=_shape, default=None, help='shape of raw inputs, e.g. 100,512,512')
+            p.add_argument('--mat-variable', default=None, help='variable to read from .mat files (default: largest)')
+
+    p = sub.add_parser('info', help='describe .pmca containers')
+    p.add_argument('inputs', nargs='+')
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'info':
+        return _info(args)
+
+    return _run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
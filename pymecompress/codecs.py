@@ -1,57 +1,236 @@
 """
 numcodecs compatible compression and quantization codecs.
+
+The decoding codecs take an optional `cache` - a `cache.DecodeCache` to keep decoded chunks in, False to disable
+caching, or None (the default) to use the process wide default cache set with `cache.set_default_cache` (which is
+itself None, i.e. no caching, unless set). Cached chunks are returned as read-only arrays.
 """
 from . import bcl
+from . import cache as _cache
 import numcodecs
 from numcodecs.abc import Codec
 
 
+def _cached(codec, buf, out, decode):
+    """ decode buf with decode(buf, out), going through the codec's cache if it has one """
+    cache = _cache.get_default_cache() if codec._cache is None else codec._cache
+    if cache is None or cache is False:
+        return decode(buf, out)
+    
+    return _cache.cached_decode(cache, _cache.DecodeCache.config_key(codec.get_config()), buf, out,
+                                lambda b: decode(b, None))
+
+
 class Huffman(Codec):
     codec_id='pymecompress-huffman'
     
+    def __init__(self, streams=1, coder='huffman', stats=None, preview=None, cache=None):
+        # streams > 1 gives interleaved multi-stream frames, which decode faster, and coder='rans' gives smaller
+        # frames for skewed data (both need a recent pymecompress to read). stats='summary' / 'histogram' stores
+        # chunk statistics for bcl.frame_stats, and preview=binning embeds a binned preview for decode_preview
+        self._streams = streams
+        self._coder = coder
+        self._stats = stats
+        self._preview = preview
+        self._cache = cache
+    
     def encode(self, buf):
-        return bcl.huffman_compress_buffer(buf)
+        return bcl.huffman_compress_buffer(buf, streams=self._streams, coder=self._coder, stats=self._stats,
+                                           preview=self._preview)
     
     def decode(self, buf, out=None):
-        return bcl.huffman_decompress_buffer(buf, out)
+        return _cached(self, buf, out, bcl.huffman_decompress_buffer)
+    
+    def decode_preview(self, buf, out=None):
+        """ decode only the binned preview of a chunk encoded with preview=binning """
+        return bcl.decode_preview(buf, out)
         
     def get_config(self):
-        return {'id': self.codec_id}
+        return {'id': self.codec_id, 'streams': self._streams, 'coder': self._coder, 'stats': self._stats,
+                'preview': self._preview}
     
     @classmethod
     def from_config(cls, config):
-        return cls()
+        return cls(streams=config.get('streams', 1), coder=config.get('coder', 'huffman'), stats=config.get('stats'),
+                   preview=config.get('preview'))
 
 numcodecs.register_codec(Huffman)
 
 class HuffmanQuant16(Codec):
     codec_id = 'pymecompress-quant16'
     
-    def __init__(self, offset=0, scale=1):
+    def __init__(self, offset=0, scale=1, streams=1, coder='huffman', stats=None, preview=None, cache=None):
         self._offset = offset
         self._scale = scale
+        self._streams = streams
+        self._coder = coder
+        self._stats = stats
+        self._preview = preview
+        self._cache = cache
     
     def encode(self, buf):
-        return bcl.huffman_compress_quant_buffer(buf, self._offset, self._scale)
+        return bcl.huffman_compress_quant_buffer(buf, self._offset, self._scale, streams=self._streams,
+                                                 coder=self._coder, stats=self._stats, preview=self._preview)
     
     def decode(self, buf, out=None):
-        ret = bcl.huffman_decompress_buffer(buf, None).astype('uint16')
-        
-        ret = (ret*ret)/self._scale + self._offset
-        
-        if out is None:
-            out = ret
-        else:
-           out[:] = ret.reshape(out.shape)
+        return _cached(self, buf, out, self._decode)
+    
+    def _decode(self, buf, out=None):
+        # decoding and dequantization both happen in bcl without the GIL, so this is safe (and scales) when called
+        # from multiple threads, e.g. zarr / dask threaded reads
+        # out can be strided (e.g. a view into a larger array) - we decode straight into it
+        if out is None or getattr(out, 'dtype', None) == 'uint16':
+            return bcl.huffman_decompress_quant_buffer(buf, self._offset, self._scale, out)
         
-        return out.astype('uint16')
+        ret = bcl.huffman_decompress_quant_buffer(buf, self._offset, self._scale)
+        out[:] = ret.reshape(out.shape)
+        return out
+    
+    def decode_preview(self, buf, out=None):
+        """ decode only the binned preview of a chunk encoded with preview=binning """
+        return bcl.decode_preview(buf, out)
     
     def get_config(self):
         return {'id': self.codec_id,
-                'offset': self._offset, 'scale' : self._scale}
+                'offset': self._offset, 'scale' : self._scale, 'streams': self._streams, 'coder': self._coder,
+                'stats': self._stats, 'preview': self._preview}
     
     @classmethod
     def from_config(cls, config):
-        return cls(offset=config.get('offset', 0), scale=config.get('scale', 1))
+        return cls(offset=config.get('offset', 0), scale=config.get('scale', 1), streams=config.get('streams', 1),
+                   coder=config.get('coder', 'huffman'), stats=config.get('stats'), preview=config.get('preview'))
 
 numcodecs.register_codec(HuffmanQuant16)
+
+def _channel_param(v):
+    """ per-channel parameters as a (json serializable) list, scalars as they are """
+    try:
+        return [float(x) for x in v]
+    except TypeError:
+        return v
+
+class HuffmanQuant16Channels(Codec):
+    """
+    Quantization and compression of interleaved multi-channel uint16 data (chunks with the channels along the last
+    axis), with per-channel `offset` / `scale` (scalars, or one value per channel) and Huffman tables. See
+    `bcl.huffman_compress_quant_channels_buffer`.
+    """
+    codec_id = 'pymecompress-quant16-channels'
+
+    def __init__(self, offset=0, scale=1, streams=1, coder='huffman', cache=None):
+        self._offset = _channel_param(offset)
+        self._scale = _channel_param(scale)
+        self._streams = streams
+        self._coder = coder
+        self._cache = cache
+
+    def encode(self, buf):
+        return bcl.huffman_compress_quant_channels_buffer(buf, self._offset, self._scale, streams=self._streams,
+                                                          coder=self._coder)
+
+    def decode(self, buf, out=None):
+        return _cached(self, buf, out, self._decode)
+
+    def _decode(self, buf, out=None):
+        # channels are decoded straight into their (strided) place in out
+        if out is None or getattr(out, 'dtype', None) == 'uint16':
+            return bcl.huffman_decompress_buffer(buf, out)
+
+        ret = bcl.huffman_decompress_buffer(buf)
+        out[:] = ret.reshape(out.shape)
+        return out
+
+    def get_config(self):
+        return {'id': self.codec_id, 'offset': self._offset, 'scale': self._scale, 'streams': self._streams,
+                'coder': self._coder}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(offset=config.get('offset', 0), scale=config.get('scale', 1), streams=config.get('streams', 1),
+                   coder=config.get('coder', 'huffman'))
+
+numcodecs.register_codec(HuffmanQuant16Channels)
+
+class QuantF32(Codec):
+    """
+    Lossy compression for float32 data (e.g. deconvolved stacks or rendered density maps). Data is quantized to
+    `bits` (<= 8) bits per pixel, either linearly (`mode='linear'`, `q = (x - offset)/scale`) or on a square root scale
+    (`mode='sqrt'`, `q = sqrt(x - offset)/scale`), and then entropy coded. See `bcl.huffman_compress_quant_f32_buffer`.
+    """
+    codec_id = 'pymecompress-quantf32'
+    
+    def __init__(self, offset=0, scale=1, mode='sqrt', bits=8, streams=1, coder='huffman', stats=None, preview=None,
+                 cache=None):
+        self._offset = offset
+        self._scale = scale
+        self._mode = mode
+        self._bits = bits
+        self._streams = streams
+        self._coder = coder
+        self._stats = stats
+        self._preview = preview
+        self._cache = cache
+    
+    def encode(self, buf):
+        return bcl.huffman_compress_quant_f32_buffer(buf, self._offset, self._scale, mode=self._mode, bits=self._bits,
+                                                     streams=self._streams, coder=self._coder, stats=self._stats,
+                                                     preview=self._preview)
+    
+    def decode(self, buf, out=None):
+        return _cached(self, buf, out, self._decode)
+    
+    def _decode(self, buf, out=None):
+        # the quantization parameters are in the frame, and dequantization is folded into decoding
+        if out is None or getattr(out, 'dtype', None) == 'float32':
+            return bcl.huffman_decompress_buffer(buf, out)
+        
+        ret = bcl.huffman_decompress_buffer(buf)
+        out[:] = ret.reshape(out.shape)
+        return out
+    
+    def decode_preview(self, buf, out=None):
+        """ decode only the binned preview of a chunk encoded with preview=binning """
+        return bcl.decode_preview(buf, out)
+    
+    def get_config(self):
+        return {'id': self.codec_id, 'offset': self._offset, 'scale': self._scale, 'mode': self._mode,
+                'bits': self._bits, 'streams': self._streams, 'coder': self._coder, 'stats': self._stats,
+                'preview': self._preview}
+    
+    @classmethod
+    def from_config(cls, config):
+        return cls(offset=config.get('offset', 0), scale=config.get('scale', 1), mode=config.get('mode', 'sqrt'),
+                   bits=config.get('bits', 8), streams=config.get('streams', 1), coder=config.get('coder', 'huffman'),
+                   stats=config.get('stats'), preview=config.get('preview'))
+
+numcodecs.register_codec(QuantF32)
+
+
+class LabelRLE(Codec):
+    """
+    Run length coding for label images and segmentation masks (uint8 - uint64), see `bcl.label_compress_buffer`.
+    """
+    codec_id = 'pymecompress-labelrle'
+    
+    def __init__(self, entropy=True, cache=None):
+        self._entropy = entropy
+        self._cache = cache
+    
+    def encode(self, buf):
+        return bcl.label_compress_buffer(buf, entropy=self._entropy)
+    
+    def decode(self, buf, out=None):
+        return _cached(self, buf, out, bcl.huffman_decompress_buffer)
+    
+    def decode_slice(self, buf, index, out=None):
+        """ decode a single 2D (z) slice of an encoded volume, without decoding the rest """
+        return bcl.label_decompress_slice(buf, index, out)
+    
+    def get_config(self):
+        return {'id': self.codec_id, 'entropy': self._entropy}
+    
+    @classmethod
+    def from_config(cls, config):
+        return cls(entropy=config.get('entropy', True))
+
+numcodecs.register_codec(LabelRLE)
@@ -0,0 +1,60 @@
+//
+//  instrument.c
+//
+//  Low overhead per-stage counters for the compression kernels. Counters are
+//  process global and updated atomically so that kernels running on several
+//  threads (with the GIL released) can share them.
+//
+
+#include <string.h>
+
+#include "instrument.h"
+#include "bcl/systimer.h"
+
+volatile int pyme_stats_enabled = 0;
+
+static pyme_stage_stats_t stage_stats[PYME_NUM_STAGES];
+
+unsigned long long pyme_stats_now(void)
+{
+    return GetCycles();
+}
+
+void pyme_stats_record(int stage, uint64_t cycles, uint64_t bytes_in, uint64_t bytes_out)
+{
+    pyme_stage_stats_t *s;
+
+    if ((stage < 0) || (stage >= PYME_NUM_STAGES)) return;
+    s = &stage_stats[stage];
+
+    __atomic_fetch_add(&s->calls, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&s->cycles, cycles, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&s->bytes_in, bytes_in, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&s->bytes_out, bytes_out, __ATOMIC_RELAXED);
+}
+
+void pyme_stats_get(pyme_stage_stats_t *out)
+{
+    int i;
+
+    for (i = 0; i < PYME_NUM_STAGES; i++)
+    {
+        out[i].calls = __atomic_load_n(&stage_stats[i].calls, __ATOMIC_RELAXED);
+        out[i].cycles = __atomic_load_n(&stage_stats[i].cycles, __ATOMIC_RELAXED);
+        out[i].bytes_in = __atomic_load_n(&stage_stats[i].bytes_in, __ATOMIC_RELAXED);
+        out[i].bytes_out = __atomic_load_n(&stage_stats[i].bytes_out, __ATOMIC_RELAXED);
+    }
+}
+
+void pyme_stats_reset(void)
+{
+    int i;
+
+    for (i = 0; i < PYME_NUM_STAGES; i++)
+    {
+        __atomic_store_n(&stage_stats[i].calls, 0, __ATOMIC_RELAXED);
+        __atomic_store_n(&stage_stats[i].cycles, 0, __ATOMIC_RELAXED);
+        __atomic_store_n(&stage_stats[i].bytes_in, 0, __ATOMIC_RELAXED);
+        __atomic_store_n(&stage_stats[i].bytes_out, 0, __ATOMIC_RELAXED);
+    }
+}
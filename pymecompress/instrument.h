@@ -0,0 +1,45 @@
+#ifndef _instrument_h_
+#define _instrument_h_
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include <stdint.h>
+
+/* Pipeline stages we keep counters for. Keep in sync with STAGE_NAMES in bcl.pyx */
+enum {
+    PYME_STAGE_ALLOC = 0,
+    PYME_STAGE_QUANTIZE,
+    PYME_STAGE_HISTOGRAM,
+    PYME_STAGE_TREE,
+    PYME_STAGE_ENCODE,
+    PYME_STAGE_DECODE_TREE,
+    PYME_STAGE_DECODE,  /* dequantization is folded into decoding, via a lookup table */
+    PYME_NUM_STAGES
+};
+
+typedef struct {
+    uint64_t calls;
+    uint64_t cycles;
+    uint64_t bytes_in;
+    uint64_t bytes_out;
+} pyme_stage_stats_t;
+
+/* global on/off switch - checked once per stage so that disabled stats cost a load and a branch */
+extern volatile int pyme_stats_enabled;
+
+unsigned long long pyme_stats_now(void);
+void pyme_stats_record(int stage, uint64_t cycles, uint64_t bytes_in, uint64_t bytes_out);
+void pyme_stats_get(pyme_stage_stats_t *out);
+void pyme_stats_reset(void);
+
+#define PYME_STATS_START(t) unsigned long long t = pyme_stats_enabled ? pyme_stats_now() : 0
+#define PYME_STATS_STOP(stage, t, nin, nout) \
+    if (pyme_stats_enabled) pyme_stats_record((stage), pyme_stats_now() - (t), (nin), (nout))
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* _instrument_h_ */
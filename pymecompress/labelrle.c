@@ -0,0 +1,341 @@
+//
+//  labelrle.c
+//
+//  Run length coding for label images / segmentation masks with 1, 2, 4 or
+//  8 byte integer pixels. Data is treated as a stack of 2D slices (all the
+//  leading dimensions flattened) and runs are found along rows, never
+//  crossing a row boundary. Each slice is coded independently and indexed,
+//  so a single slice can be decoded without touching the rest of the
+//  volume. Run values and run lengths are stored as separate streams,
+//  each of which can optionally be rANS coded.
+//
+//  Layout (all values little endian):
+//
+//    [uint8 itemsize][7 reserved][uint64 n_slices][uint64 n_rows]
+//    [uint64 row_len][uint64 slice offsets x (n_slices + 1)]
+//    [slice 0][slice 1]...
+//
+//  with each slice:
+//
+//    [uint8 flags][3 reserved][uint32 n_runs][uint32 values size]
+//    [uint32 raw lengths size][uint32 lengths size][values][lengths]
+//
+//  Run lengths are stored as LEB128 coded (length - 1). Flag bit 0 marks
+//  the values, and bit 1 the lengths, as rANS coded. Offsets are relative
+//  to the start of the data.
+//
+
+#include <stdlib.h>
+#include <string.h>
+
+#include "labelrle.h"
+#include "rans.h"
+#include "instrument.h"
+
+#define LABELRLE_HEADER 32
+#define LABELRLE_SLICE_HEADER 20
+
+/* only bother with an entropy pass for streams at least this long */
+#define LABELRLE_MIN_ENTROPY 64
+
+#define LABELRLE_VALUES_RANS 1
+#define LABELRLE_LENGTHS_RANS 2
+
+static void _put32(unsigned char *p, uint32_t v)
+{
+    p[0] = (unsigned char)(v & 0xff);
+    p[1] = (unsigned char)((v >> 8) & 0xff);
+    p[2] = (unsigned char)((v >> 16) & 0xff);
+    p[3] = (unsigned char)(v >> 24);
+}
+
+static uint32_t _get32(const unsigned char *p)
+{
+    return (uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+static void _put64(unsigned char *p, uint64_t v)
+{
+    _put32(p, (uint32_t)(v & 0xffffffff));
+    _put32(p + 4, (uint32_t)(v >> 32));
+}
+
+static uint64_t _get64(const unsigned char *p)
+{
+    return (uint64_t)_get32(p) | ((uint64_t)_get32(p + 4) << 32);
+}
+
+/* find the runs in a row of type T, appending values to vals and LEB128 lengths to lens */
+#define SCAN_ROW(T) \
+    { \
+        const T *p_ = (const T *)row; \
+        T v_ = p_[0]; \
+        uint64_t start_ = 0, j_; \
+        for (j_ = 1; j_ <= row_len; j_++) \
+        { \
+            if ((j_ == row_len) || (p_[j_] != v_)) \
+            { \
+                memcpy(vals + n_runs*sizeof(T), &v_, sizeof(T)); \
+                n_runs++; \
+                for (run = j_ - start_ - 1; run >= 0x80; run >>= 7) *lp++ = (unsigned char)(run | 0x80); \
+                *lp++ = (unsigned char)run; \
+                if (j_ < row_len) \
+                { \
+                    v_ = p_[j_]; \
+                    start_ = j_; \
+                } \
+            } \
+        } \
+    }
+
+#define FILL_RUN(T) \
+    { \
+        T v_; \
+        T *d_ = (T *)dst + pos; \
+        memcpy(&v_, vals + i*sizeof(T), sizeof(T)); \
+        for (k = 0; k < run; k++) d_[k] = v_; \
+    }
+
+/*
+ * Upper bound on the compressed size, for allocating output.
+ */
+int64_t LabelRLE_Bound(unsigned int itemsize, uint64_t n_slices, uint64_t n_rows, uint64_t row_len)
+{
+    /* worst case is all runs of length 1 - one value and one length byte per pixel */
+    return LABELRLE_HEADER + 8*(n_slices + 1) + n_slices*(LABELRLE_SLICE_HEADER + n_rows*row_len*(itemsize + 1));
+}
+
+/* store a stream, rANS coding it if that makes it smaller. Returns the stored size */
+static uint32_t _LabelRLE_PutStream(const unsigned char *src, uint32_t size, unsigned char *dst, int entropy, int flag,
+                                    unsigned char *flags)
+{
+    int nb;
+
+    if (entropy && (size >= LABELRLE_MIN_ENTROPY))
+    {
+        nb = Rans_Compress(src, dst, size, size - 1, NULL);
+        if (nb > 0)
+        {
+            *flags |= (unsigned char)flag;
+            return (uint32_t)nb;
+        }
+    }
+
+    memcpy(dst, src, size);
+    return size;
+}
+
+/*
+ * Compress n_slices slices of n_rows x row_len pixels of itemsize bytes
+ * each. out must be at least LabelRLE_Bound() bytes. Returns the
+ * compressed size, or -1 for unsupported item sizes / if out of memory.
+ */
+int64_t LabelRLE_Compress(const unsigned char *in, unsigned char *out, unsigned int itemsize, uint64_t n_slices,
+                          uint64_t n_rows, uint64_t row_len, int entropy)
+{
+    uint64_t slice_elems = n_rows*row_len, slice_bytes = slice_elems*itemsize, s, r, pos, run;
+    unsigned char *vals, *lens, *lp, *block, flags;
+    const unsigned char *row;
+    uint32_t n_runs, vs, ls;
+
+    PYME_STATS_START(t0);
+
+    if ((itemsize != 1) && (itemsize != 2) && (itemsize != 4) && (itemsize != 8)) return -1;
+
+    vals = (unsigned char *)malloc(slice_bytes + 1);
+    lens = (unsigned char *)malloc(slice_elems + 1);
+    if ((vals == NULL) || (lens == NULL))
+    {
+        free(vals);
+        free(lens);
+        return -1;
+    }
+
+    memset(out, 0, LABELRLE_HEADER);
+    out[0] = (unsigned char)itemsize;
+    _put64(out + 8, n_slices);
+    _put64(out + 16, n_rows);
+    _put64(out + 24, row_len);
+    pos = LABELRLE_HEADER + 8*(n_slices + 1);
+
+    for (s = 0; s < n_slices; s++)
+    {
+        _put64(out + LABELRLE_HEADER + 8*s, pos);
+
+        n_runs = 0;
+        lp = lens;
+        for (r = 0; (r < n_rows) && (row_len > 0); r++)
+        {
+            row = in + s*slice_bytes + r*row_len*itemsize;
+            switch (itemsize)
+            {
+                case 1: SCAN_ROW(uint8_t); break;
+                case 2: SCAN_ROW(uint16_t); break;
+                case 4: SCAN_ROW(uint32_t); break;
+                default: SCAN_ROW(uint64_t);
+            }
+        }
+
+        block = out + pos;
+        flags = 0;
+        vs = _LabelRLE_PutStream(vals, n_runs*itemsize, block + LABELRLE_SLICE_HEADER, entropy,
+                                 LABELRLE_VALUES_RANS, &flags);
+        ls = _LabelRLE_PutStream(lens, (uint32_t)(lp - lens), block + LABELRLE_SLICE_HEADER + vs, entropy,
+                                 LABELRLE_LENGTHS_RANS, &flags);
+
+        memset(block, 0, 4);
+        block[0] = flags;
+        _put32(block + 4, n_runs);
+        _put32(block + 8, vs);
+        _put32(block + 12, (uint32_t)(lp - lens));
+        _put32(block + 16, ls);
+        pos += LABELRLE_SLICE_HEADER + vs + ls;
+    }
+    _put64(out + LABELRLE_HEADER + 8*n_slices, pos);
+
+    free(vals);
+    free(lens);
+    PYME_STATS_STOP(PYME_STAGE_ENCODE, t0, n_slices*slice_bytes, pos);
+
+    return (int64_t)pos;
+}
+
+/* decode one slice block into dst. Returns 0 on success, -1 if corrupt, -2 if out of memory */
+static int _LabelRLE_DecodeSlice(const unsigned char *block, uint64_t block_size, unsigned char *dst,
+                                 unsigned int itemsize, uint64_t slice_elems)
+{
+    const unsigned char *vals, *lens, *lp, *lend;
+    unsigned char *vbuf = NULL, *lbuf = NULL;
+    uint32_t n_runs, vs, lraw, ls, i, shift;
+    uint64_t pos = 0, run, k;
+    int err = 0;
+
+    if (block_size < LABELRLE_SLICE_HEADER) return -1;
+    n_runs = _get32(block + 4);
+    vs = _get32(block + 8);
+    lraw = _get32(block + 12);
+    ls = _get32(block + 16);
+    if ((uint64_t)LABELRLE_SLICE_HEADER + vs + ls > block_size) return -1;
+
+    vals = block + LABELRLE_SLICE_HEADER;
+    lens = vals + vs;
+
+    if (block[0] & LABELRLE_VALUES_RANS)
+    {
+        vbuf = (unsigned char *)malloc((uint64_t)n_runs*itemsize + 1);
+        if (vbuf == NULL) return -2;
+        err = Rans_Uncompress(vals, vbuf, vs, n_runs*itemsize);
+        vals = vbuf;
+    }
+    else if ((uint64_t)n_runs*itemsize != vs)
+    {
+        err = -1;
+    }
+
+    if ((err == 0) && (block[0] & LABELRLE_LENGTHS_RANS))
+    {
+        lbuf = (unsigned char *)malloc(lraw + 1);
+        if (lbuf == NULL)
+            err = -2;
+        else
+            err = Rans_Uncompress(lens, lbuf, ls, lraw);
+        lens = lbuf;
+    }
+    else if (lraw != ls)
+    {
+        err = -1;
+    }
+
+    lp = lens;
+    lend = lens + lraw;
+    for (i = 0; (i < n_runs) && (err == 0); i++)
+    {
+        run = 0;
+        shift = 0;
+        do
+        {
+            if ((lp >= lend) || (shift > 63))
+            {
+                err = -1;
+                break;
+            }
+            run |= (uint64_t)(*lp & 0x7f) << shift;
+            shift += 7;
+        } while (*lp++ & 0x80);
+        run += 1;
+
+        if ((err != 0) || (pos + run > slice_elems))
+        {
+            err = -1;
+            break;
+        }
+
+        switch (itemsize)
+        {
+            case 1: memset(dst + pos, vals[i], run); break;
+            case 2: FILL_RUN(uint16_t); break;
+            case 4: FILL_RUN(uint32_t); break;
+            default: FILL_RUN(uint64_t);
+        }
+        pos += run;
+    }
+
+    if ((err == 0) && (pos != slice_elems)) err = -1;
+
+    free(vbuf);
+    free(lbuf);
+    return err;
+}
+
+/*
+ * Decode slices [first, first + count) into out (count*n_rows*row_len
+ * pixels). Returns 0 on success, -1 if the data is corrupt (or the slices
+ * are out of range), -2 if out of memory.
+ */
+int LabelRLE_UncompressSlices(const unsigned char *in, unsigned char *out, uint64_t insize, uint64_t first,
+                              uint64_t count)
+{
+    uint64_t n_slices, slice_bytes, slice_elems, s, start, end;
+    unsigned int itemsize;
+    int err;
+
+    PYME_STATS_START(t0);
+
+    if (insize < LABELRLE_HEADER) return -1;
+    itemsize = in[0];
+    n_slices = _get64(in + 8);
+    slice_elems = _get64(in + 16)*_get64(in + 24);
+    slice_bytes = slice_elems*itemsize;
+
+    if ((itemsize != 1) && (itemsize != 2) && (itemsize != 4) && (itemsize != 8)) return -1;
+    if ((first > n_slices) || (count > n_slices - first)) return -1;
+    if (LABELRLE_HEADER + 8*(n_slices + 1) > insize) return -1;
+
+    for (s = first; s < first + count; s++)
+    {
+        start = _get64(in + LABELRLE_HEADER + 8*s);
+        end = _get64(in + LABELRLE_HEADER + 8*(s + 1));
+        if ((start > end) || (end > insize)) return -1;
+
+        err = _LabelRLE_DecodeSlice(in + start, end - start, out + (s - first)*slice_bytes, itemsize, slice_elems);
+        if (err != 0) return err;
+    }
+    PYME_STATS_STOP(PYME_STAGE_DECODE, t0, insize, count*slice_bytes);
+
+    return 0;
+}
+
+/*
+ * Decode all slices into out, which holds outsize bytes. Returns as for
+ * LabelRLE_UncompressSlices().
+ */
+int LabelRLE_Uncompress(const unsigned char *in, unsigned char *out, uint64_t insize, uint64_t outsize)
+{
+    uint64_t n_slices;
+
+    if (insize < LABELRLE_HEADER) return -1;
+    n_slices = _get64(in + 8);
+    if (n_slices*_get64(in + 16)*_get64(in + 24)*in[0] != outsize) return -1;
+
+    return LabelRLE_UncompressSlices(in, out, insize, 0, n_slices);
+}
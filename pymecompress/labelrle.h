@@ -0,0 +1,21 @@
+#ifndef _labelrle_h_
+#define _labelrle_h_
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include <stdint.h>
+
+int64_t LabelRLE_Bound( unsigned int itemsize, uint64_t n_slices, uint64_t n_rows, uint64_t row_len );
+int64_t LabelRLE_Compress( const unsigned char *in, unsigned char *out, unsigned int itemsize, uint64_t n_slices,
+                           uint64_t n_rows, uint64_t row_len, int entropy );
+int LabelRLE_Uncompress( const unsigned char *in, unsigned char *out, uint64_t insize, uint64_t outsize );
+int LabelRLE_UncompressSlices( const unsigned char *in, unsigned char *out, uint64_t insize, uint64_t first,
+                               uint64_t count );
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* _labelrle_h_ */
@@ -0,0 +1,334 @@
+"""
+Process pool compression backend.
+
+For machines where a single process runs into NUMA / memory bandwidth limits (e.g. dual socket acquisition servers)
+this runs the bcl kernels in a pool of worker processes, optionally pinned to NUMA nodes. Frames and compressed
+results are passed through `multiprocessing.shared_memory` slabs - only small task descriptors go through the
+queues, so there is no pickling of pixel data.
+
+    with ProcessPoolCompressor(codec=codecs.HuffmanQuant16(offset=100, scale=1)) as pool:
+        compressed = pool.compress(frames)
+"""
+import glob
+import os
+import queue
+import sys
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_ALIGN = 64
+
+# seconds between checks that the workers are still alive while waiting for results
+_POLL_INTERVAL = 0.5
+# seconds to wait for workers to exit on close before terminating them
+_JOIN_TIMEOUT = 5
+
+
+def _align(n):
+    return ((n + _ALIGN - 1) // _ALIGN) * _ALIGN
+
+
+def _parse_cpulist(s):
+    cpus = set()
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def numa_nodes():
+    """
+    Return a list of the sets of (available) cpus belonging to each NUMA node. On platforms without NUMA information
+    (anything but Linux) returns a single node with all cpus.
+    """
+    try:
+        available = os.sched_getaffinity(0)
+    except AttributeError:
+        return [set(range(os.cpu_count() or 1))]
+
+    nodes = []
+    for fn in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                     key=lambda f: int(f.split('/')[-2][4:])):
+        with open(fn) as f:
+            cpus = _parse_cpulist(f.read()) & available
+        if cpus:
+            nodes.append(cpus)
+
+    return nodes or [available]
+
+
+def _attach(name):
+    """ attach to an existing shared memory block without handing it to the resource tracker (the parent owns it) """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always registers, which would result in the tracker unlinking the block when the worker exits
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _get_compress_fcn(config):
+    from . import bcl
+
+    codec_id = config.get('id', 'pymecompress-huffman')
+    opts = {'streams': config.get('streams', 1), 'coder': config.get('coder', 'huffman'), 'stats': config.get('stats'),
+            'preview': config.get('preview')}
+    if codec_id == 'pymecompress-huffman':
+        return lambda data, out: bcl.huffman_compress_buffer(data, out, **opts)
+    elif codec_id == 'pymecompress-quant16':
+        offset, scale = config.get('offset', 0), config.get('scale', 1)
+        return lambda data, out: bcl.huffman_compress_quant_buffer(data, offset, scale, out, **opts)
+    elif codec_id == 'pymecompress-quantf32':
+        offset, scale = config.get('offset', 0), config.get('scale', 1)
+        mode, bits = config.get('mode', 'sqrt'), config.get('bits', 8)
+        return lambda data, out: bcl.huffman_compress_quant_f32_buffer(data, offset, scale, mode, bits, out, **opts)
+
+    raise ValueError('Codec %s is not supported by the process pool' % codec_id)
+
+
+def _worker(task_queue, result_queue, codec_config, cpus):
+    from . import bcl
+
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError):
+            pass
+
+    compress = _get_compress_fcn(codec_config)
+    attached = {}
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        kind, idx, in_name, in_offset, in_shape, in_dtype, in_order, out_name, out_offset, out_shape, out_dtype = task
+        try:
+            # slabs are only ever replaced (by larger ones), so we can drop anything the current task doesn't use
+            for name in [k for k in attached.keys() if k not in (in_name, out_name)]:
+                attached.pop(name).close()
+            for name in (in_name, out_name):
+                if name not in attached:
+                    attached[name] = _attach(name)
+
+            # views need to go out of scope before the slabs can be closed
+            data = np.ndarray(in_shape, in_dtype, buffer=attached[in_name].buf, offset=in_offset, order=in_order)
+            out = np.ndarray(out_shape, out_dtype, buffer=attached[out_name].buf, offset=out_offset)
+            if kind == 'c':
+                n = len(compress(data, out=out))
+            else:
+                bcl.huffman_decompress_buffer(data, out=out)
+                n = out.nbytes
+            del data, out
+            result_queue.put((idx, n, None))
+        except Exception as e:
+            result_queue.put((idx, 0, '%s: %s' % (type(e).__name__, e)))
+
+    for shm in attached.values():
+        shm.close()
+
+
+class _Slab(object):
+    """ a growable shared memory block, owned by the parent process """
+    def __init__(self):
+        self._shm = None
+        self._retired = []
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def ensure(self, size):
+        if (self._shm is None) or (self._shm.size < size):
+            self.release()
+            self._shm = shared_memory.SharedMemory(create=True, size=max(_align(size), _ALIGN))
+        return self._shm.buf
+
+    def release(self):
+        if self._shm is not None:
+            self._shm.unlink()
+            try:
+                self._shm.close()
+            except BufferError:
+                # the user still holds views of the old slab - keep the mapping alive until they are done with it
+                self._retired.append(self._shm)
+            self._shm = None
+
+
+class ProcessPoolCompressor(object):
+    """
+    Compress / decompress frames in a pool of worker processes, using shared memory for data transport.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of worker processes. Defaults to the number of available cpus.
+    codec : pymecompress codec or config dict, optional
+        `codecs.Huffman` (the default), `codecs.HuffmanQuant16` or `codecs.QuantF32`.
+    pin_numa : bool
+        Pin workers round robin to the cpus of each NUMA node (Linux only).
+    mp_context : multiprocessing context, optional
+        Context used to start workers.
+
+    Results are numpy views of a shared output slab, which is reused by the next call to `compress` or `decompress`.
+    Pass `copy=True` (or copy the results) if they need to outlive the next call.
+    """
+    def __init__(self, workers=None, codec=None, pin_numa=True, mp_context=None):
+        if codec is None:
+            config = {'id': 'pymecompress-huffman'}
+        elif isinstance(codec, dict):
+            config = dict(codec)
+        else:
+            config = codec.get_config()
+
+        _get_compress_fcn(config) # check the codec is supported before starting any workers
+        self._stats, self._preview = config.get('stats'), config.get('preview')
+
+        ctx = mp_context or multiprocessing.get_context()
+        nodes = numa_nodes() if (pin_numa and sys.platform.startswith('linux')) else [None]
+        if workers is None:
+            workers = sum(len(n) for n in nodes) if nodes[0] is not None else (os.cpu_count() or 1)
+
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._workers = [ctx.Process(target=_worker, args=(self._tasks, self._results, config,
+                                                           nodes[i % len(nodes)] if len(nodes) > 1 else None),
+                                     daemon=True)
+                         for i in range(workers)]
+        for w in self._workers:
+            w.start()
+
+        self._in = _Slab()
+        self._out = _Slab()
+        self._lock = threading.Lock()
+        self._broken = None
+
+    def _check_workers(self):
+        """
+        raise RuntimeError if any worker has died (e.g. killed when out of memory, or crashed on a corrupt frame).
+        Any tasks it had taken are lost, so the pool can't be used after this.
+        """
+        if self._broken is None:
+            for i, w in enumerate(self._workers):
+                if not w.is_alive():
+                    self._broken = 'worker %d (pid %s) died with exit code %s' % (i, w.pid, w.exitcode)
+                    break
+
+        if self._broken is not None:
+            raise RuntimeError('Process pool is broken - %s' % self._broken)
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._results.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+
+    def _run(self, kind, frames, out_specs, copy):
+        self._check_workers()
+
+        in_offsets, pos = [], 0
+        for f in frames:
+            in_offsets.append(pos)
+            pos = _align(pos + f.nbytes)
+        in_buf = self._in.ensure(pos)
+
+        out_offsets, pos = [], 0
+        for shape, dtype in out_specs:
+            out_offsets.append(pos)
+            pos = _align(pos + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        out_buf = self._out.ensure(pos)
+
+        for i, f in enumerate(frames):
+            # the only copy - straight from the caller's frame into shared memory
+            order = 'F' if (f.ndim > 1 and f.flags['F_CONTIGUOUS'] and not f.flags['C_CONTIGUOUS']) else 'C'
+            np.ndarray(f.shape, f.dtype, buffer=in_buf, offset=in_offsets[i], order=order)[...] = f
+            shape, dtype = out_specs[i]
+            self._tasks.put((kind, i, self._in.name, in_offsets[i], f.shape, f.dtype.str, order,
+                             self._out.name, out_offsets[i], shape, np.dtype(dtype).str))
+
+        sizes, errors = [0] * len(frames), []
+        for _ in range(len(frames)):
+            idx, n, err = self._get_result()
+            sizes[idx] = n
+            if err is not None:
+                errors.append('frame %d: %s' % (idx, err))
+
+        if errors:
+            raise RuntimeError('Error(s) in worker processes:\n' + '\n'.join(errors))
+
+        results = []
+        for i, (shape, dtype) in enumerate(out_specs):
+            r = np.ndarray(shape, dtype, buffer=out_buf, offset=out_offsets[i])
+            if kind == 'c':
+                r = r[:sizes[i]]
+            results.append(r.copy() if copy else r)
+
+        return results
+
+    def compress(self, frames, copy=False):
+        """
+        Compress a sequence of (contiguous) arrays. Returns a list of compressed frames (uint8 arrays).
+        """
+        from . import bcl
+
+        frames = [np.asarray(f) if (f.flags['C_CONTIGUOUS'] or f.flags['F_CONTIGUOUS']) else np.ascontiguousarray(f)
+                  for f in map(np.asarray, frames)]
+        with self._lock:
+            return self._run('c', frames, [(bcl.compress_bound(f.nbytes, f.ndim, self._stats, self._preview), 'uint8')
+                                           for f in frames], copy)
+
+    def decompress(self, frames, copy=False):
+        """
+        Decompress a sequence of frames produced by `compress` (or the pymecompress codecs). Returns a list of
+        (C ordered) arrays with the dtype and shape recorded in each frame.
+        """
+        from . import bcl
+
+        frames = [np.frombuffer(f, 'uint8') for f in frames]
+        specs = []
+        for f in frames:
+            info = bcl.frame_info(f)
+            if info['shape'] is None:
+                specs.append(((info['n_symbols'],), 'uint8'))
+            else:
+                # Fortran ordered frames are decoded (via strided decoding) into C ordered output
+                specs.append((info['shape'], info['dtype']))
+
+        with self._lock:
+            return self._run('d', frames, specs, copy)
+
+    def close(self):
+        for w in self._workers:
+            if w.is_alive():
+                self._tasks.put(None)
+        for w in self._workers:
+            w.join(_JOIN_TIMEOUT)
+            if w.is_alive():
+                # wedged (or still busy with tasks from a broken pool)
+                w.terminate()
+                w.join()
+        self._workers = []
+
+        self._in.release()
+        self._out.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
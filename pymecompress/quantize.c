@@ -11,6 +11,7 @@
 //#include <x86intrin.h>
 
 #include "quantize.h"
+#include "instrument.h"
 
 #ifdef __AVX__
 #pragma message "AVX defined"
@@ -27,17 +28,38 @@
 // #define NUMITERS 10
 // #define NUMITERS_1 1000
 
+/* -ffast-math lets gcc replace vectorized sqrtf with an approximate reciprocal square root (rsqrtps + a Newton step),
+which isn't exact even for perfect squares, so vectorized and scalar loops could put the same value into different
+quantization levels. Turning off finite-math-only for the uint16 quantizers keeps the (still vectorized) sqrt exact. */
+#if defined(__GNUC__) && !defined(__clang__)
+#define EXACT_SQRT __attribute__((optimize("no-finite-math-only")))
+#else
+#define EXACT_SQRT
+#endif
+
+/* square root quantize one uint16 value - values below the offset map to 0 and the result is clamped to [0, 255]. All
+the uint16 quantizers go through this (or match it exactly, in the AVX code), so that the same data quantizes the
+same way whichever API and channel layout it is compressed with. */
+EXACT_SQRT static inline uint8_t _quantize_sqrt_u8(uint16_t x, float offset, float qs)
+{
+    float v = (float)x - offset;
+    v = v > 0.0f ? v : 0.0f;
+    v = sqrtf(v)*qs;
+    v = v < 255.0f ? v : 255.0f;
+    return (uint8_t) (int) (v + 0.5f);
+}
+
 //#ifndef __AVX__
 /* use slower code*/
 /* square root quantize data, with a given offset and scale*/
-void quantize_u16_noavx(uint16_t *data, uint8_t * out, int size, float offset, float scale)
+EXACT_SQRT void quantize_u16_noavx(uint16_t *data, uint8_t * out, int size, float offset, float scale)
 {
-    float qs = 1.0/scale;
+    float qs = 1.0f/scale;
     int i = 0;
 
     for (i = 0; i < size; i++)
     {
-        out[i] = (uint8_t) roundf(qs*sqrtf(data[i] - offset));
+        out[i] = _quantize_sqrt_u8(data[i], offset, qs);
     }
 }
 
@@ -49,10 +71,13 @@ uses avx command set to process 16 values in parallel
 */
 void quantize_u16_avx(uint16_t * data, uint8_t * out, int size, float offset, float scale)
 {
-    float qs = 1.0/scale;
+    float qs = 1.0f/scale;
     int i = 0;
 
     __m256 x, x1, xs;
+    __m256 zero = _mm256_setzero_ps();
+    __m256 qmax = _mm256_set1_ps(255.0f);
+    __m256 half = _mm256_set1_ps(0.5f);
     __m128i t2, xlo, xhi, xp1, xp2, xpp;
     __m256i combined, xi, xp;
 
@@ -72,10 +97,10 @@ void quantize_u16_avx(uint16_t * data, uint8_t * out, int size, float offset, fl
         //combined = (__m256i)_mm256_loadu2_m128i (&xhi, &xlo);
         combined = _mm256_insertf128_si256(_mm256_castsi128_si256(_mm_loadu_si128(&xlo)),_mm_loadu_si128(&xhi),1);
         x = (__m256)_mm256_cvtepi32_ps(combined);
-        x1 = (__m256)_mm256_sub_ps(x, offs);
-        xs = (__m256)_mm256_mul_ps(_mm256_mul_ps(_mm256_rsqrt_ps(x1),x1), sc);
-        //xs = _mm256_mul_ps(_mm256_sqrt_ps(x1), sc);
-        xi = (__m256i)_mm256_cvtps_epi32 (xs);
+        x1 = _mm256_max_ps(_mm256_sub_ps(x, offs), zero);
+        /* exact sqrt, clamp, and round half up, as _quantize_sqrt_u8 does (rsqrt isn't exact, and cvtps rounds to even) */
+        xs = _mm256_min_ps(_mm256_mul_ps(_mm256_sqrt_ps(x1), sc), qmax);
+        xi = (__m256i)_mm256_cvttps_epi32 (_mm256_add_ps(xs, half));
         xp = xi;
         //xp = _mm256_packs_epi32 (xi, _mm256_set1_epi32 (0));
         //xp = _mm256_packs_epi16 (xp, _mm256_set1_epi16 (0));
@@ -93,10 +118,10 @@ void quantize_u16_avx(uint16_t * data, uint8_t * out, int size, float offset, fl
         //combined = (__m256i)_mm256_loadu2_m128i (&xhi, &xlo);
         combined = _mm256_insertf128_si256(_mm256_castsi128_si256(_mm_loadu_si128(&xlo)),_mm_loadu_si128(&xhi),1);
         x = (__m256)_mm256_cvtepi32_ps(combined);
-        x1 = (__m256)_mm256_sub_ps(x, offs);
-        xs = (__m256)_mm256_mul_ps(_mm256_mul_ps(_mm256_rsqrt_ps(x1),x1), sc);
-        //xs = _mm256_mul_ps(_mm256_sqrt_ps(x1), sc);
-        xi = (__m256i)_mm256_cvtps_epi32 (xs);
+        x1 = _mm256_max_ps(_mm256_sub_ps(x, offs), zero);
+        /* exact sqrt, clamp, and round half up, as _quantize_sqrt_u8 does (rsqrt isn't exact, and cvtps rounds to even) */
+        xs = _mm256_min_ps(_mm256_mul_ps(_mm256_sqrt_ps(x1), sc), qmax);
+        xi = (__m256i)_mm256_cvttps_epi32 (_mm256_add_ps(xs, half));
         xp = xi;
         //xp = _mm256_packs_epi32 (xi, _mm256_set1_epi32 (0));
         //xp2 = _mm256_extractf128_si256 (xp, 0);
@@ -113,7 +138,7 @@ void quantize_u16_avx(uint16_t * data, uint8_t * out, int size, float offset, fl
     //do the unaligned bit
     for (; i < size; i++)
     {
-        out[i] = (uint8_t) roundf(qs*sqrtf(data[i] - offset));
+        out[i] = _quantize_sqrt_u8(data[i], offset, qs);
     }
 }
 #else
@@ -135,6 +160,7 @@ void quantize_u16_avx(uint16_t * data, uint8_t * out, int size, float offset, fl
 
 void quantize_u16(uint16_t *data, uint8_t * out, int size, float offset, float scale)
 {
+    PYME_STATS_START(t0);
 #ifdef __AVX__
     if (__builtin_cpu_supports("avx"))
     {
@@ -145,6 +171,7 @@ void quantize_u16(uint16_t *data, uint8_t * out, int size, float offset, float s
     {
         quantize_u16_noavx(data, out, size, offset, scale);
     }
+    PYME_STATS_STOP(PYME_STAGE_QUANTIZE, t0, 2*size, size);
 }
 
 #else
@@ -155,14 +182,115 @@ void quantize_u16(uint16_t *data, uint8_t * out, int size, float offset, float s
     #ifndef __AVX__
         void quantize_u16(uint16_t *data, uint8_t * out, int size, float offset, float scale)
         {
+            PYME_STATS_START(t0);
             quantize_u16_noavx(data, out, size, offset, scale);
+            PYME_STATS_STOP(PYME_STAGE_QUANTIZE, t0, 2*size, size);
         }
      #else
         void quantize_u16(uint16_t *data, uint8_t * out, int size, float offset, float scale)
         {
+            PYME_STATS_START(t0);
             quantize_u16_avx(data, out, size, offset, scale);
+            PYME_STATS_STOP(PYME_STAGE_QUANTIZE, t0, 2*size, size);
         }
      #endif
 
 
-#endif
\ No newline at end of file
+#endif
+
+/* tabulate the inverse of the square root quantization - lut[q] = (q*scale)^2 + offset */
+void dequantize_u16_table(float offset, float scale, uint16_t * lut)
+{
+    float v;
+    int i;
+
+    for (i = 0; i < 256; i++)
+    {
+        v = (i*scale)*(i*scale) + offset;
+        if (v < 0) v = 0;
+        if (v > 65535) v = 65535;
+        lut[i] = (uint16_t) roundf(v);
+    }
+}
+
+/* float32 quantization, with either a linear (q = (x - offset)/scale) or square root (q = sqrt(x - offset)/scale)
+mapping, clamped to [0, 2^bits - 1] (bits <= 8). The loops are branchless so that the compiler can vectorize them.
+NaNs map to an unspecified value. */
+void quantize_f32(float *data, uint8_t * out, int size, int mode, int bits, float offset, float scale)
+{
+    float qs = 1.0f/scale;
+    float qmax = (float)((1 << bits) - 1);
+    float v;
+    int i;
+    PYME_STATS_START(t0);
+
+    if (mode == QUANT_MODE_LINEAR)
+    {
+        for (i = 0; i < size; i++)
+        {
+            v = (data[i] - offset)*qs;
+            v = fminf(fmaxf(v, 0.0f), qmax);
+            out[i] = (uint8_t) (int) (v + 0.5f);
+        }
+    }
+    else
+    {
+        for (i = 0; i < size; i++)
+        {
+            v = sqrtf(fmaxf(data[i] - offset, 0.0f))*qs;
+            v = fminf(v, qmax);
+            out[i] = (uint8_t) (int) (v + 0.5f);
+        }
+    }
+    PYME_STATS_STOP(PYME_STAGE_QUANTIZE, t0, 4*size, size);
+}
+
+/* tabulate the inverse of quantize_f32 */
+void dequantize_f32_table(int mode, float offset, float scale, float * lut)
+{
+    int i;
+
+    for (i = 0; i < 256; i++)
+    {
+        if (mode == QUANT_MODE_LINEAR)
+            lut[i] = i*scale + offset;
+        else
+            lut[i] = (i*scale)*(i*scale) + offset;
+    }
+}
+
+#define QUANTIZE_CHANNELS(NC) \
+    for (i = 0; i < n_pixels; i++) \
+    { \
+        for (c = 0; c < NC; c++) \
+            out[c*n_pixels + i] = _quantize_sqrt_u8(data[i*NC + c], offs[c], qs[c]); \
+    }
+
+/* square root quantize interleaved multi-channel data (n_pixels x n_channels, channel fastest varying), with per
+channel offsets and scales, into planar output (channel c at out + c*n_pixels) - i.e. deinterleave in the same pass
+as the quantization. The common channel counts get loops with the channel count fixed at compile time, which the
+compiler can vectorize using interleaved loads. */
+EXACT_SQRT void quantize_u16_channels(const uint16_t *data, uint8_t * out, int n_pixels, int n_channels,
+                                      const float *offsets, const float *scales)
+{
+    float offs[QUANT_MAX_CHANNELS], qs[QUANT_MAX_CHANNELS];
+    int i, c;
+    PYME_STATS_START(t0);
+
+    /* local copies, so the compiler knows that writing out doesn't change them */
+    for (c = 0; c < n_channels; c++)
+    {
+        offs[c] = offsets[c];
+        qs[c] = 1.0f/scales[c];
+    }
+
+    switch (n_channels)
+    {
+        case 1: QUANTIZE_CHANNELS(1); break;
+        case 2: QUANTIZE_CHANNELS(2); break;
+        case 3: QUANTIZE_CHANNELS(3); break;
+        case 4: QUANTIZE_CHANNELS(4); break;
+        default: QUANTIZE_CHANNELS(n_channels);
+    }
+    PYME_STATS_STOP(PYME_STAGE_QUANTIZE, t0, 2*(int64_t)n_pixels*n_channels, (int64_t)n_pixels*n_channels);
+}
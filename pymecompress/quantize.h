@@ -8,9 +8,21 @@ extern "C" {
 //#include <x86intrin.h>
 #include <stdint.h>
 
+/* quantization modes - these are stored in compressed frames, so don't renumber */
+#define QUANT_MODE_SQRT 0
+#define QUANT_MODE_LINEAR 1
+
+/* maximum number of channels for quantize_u16_channels */
+#define QUANT_MAX_CHANNELS 256
+
 void quantize_u16(uint16_t *data, uint8_t * out, int size, float offset, float scale);
 void quantize_u16_noavx(uint16_t *data, uint8_t * out, int size, float offset, float scale);
 void quantize_u16_avx( uint16_t * data, uint8_t * out, int size, float offset, float scale);
+void dequantize_u16_table(float offset, float scale, uint16_t * lut);
+void quantize_u16_channels(const uint16_t *data, uint8_t * out, int n_pixels, int n_channels, const float *offsets,
+                           const float *scales);
+void quantize_f32(float *data, uint8_t * out, int size, int mode, int bits, float offset, float scale);
+void dequantize_f32_table(int mode, float offset, float scale, float * lut);
 
 #ifdef __cplusplus
 }
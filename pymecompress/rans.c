@@ -0,0 +1,312 @@
+//
+//  rans.c
+//
+//  Byte oriented rANS entropy coder, as an alternative to the Huffman coder
+//  for skewed distributions (e.g. sqrt quantized background), where Huffman
+//  loses up to a bit per symbol. Follows Fabian Giesen's rans_byte: 32 bit
+//  states, byte-wise renormalisation and reciprocal multiplication instead
+//  of division in the encoder. RANS_NSTATES states are interleaved (symbol i
+//  uses state i % RANS_NSTATES) so that the decoder has independent
+//  dependency chains to work on.
+//
+//  Compressed layout:
+//
+//    [uint8 scale bits][uint8 symbol bitmap x 32]
+//    [LEB128 (frequency - 1) for each symbol present, in symbol order]
+//    [uint32 initial decoder states x RANS_NSTATES][renormalisation bytes]
+//
+//  States are little endian. If only one symbol is present its frequency is
+//  the full scale and there are no states or bytes.
+//
+
+#include <stdlib.h>
+#include <string.h>
+
+#include "rans.h"
+#include "instrument.h"
+#include "bcl/huffman.h"
+
+#define RANS_SCALE_BITS 12
+#define RANS_SCALE (1u << RANS_SCALE_BITS)
+#define RANS_L (1u << 23)  /* lower bound of the normalisation interval */
+
+typedef struct {
+    uint32_t x_max;     /* renormalisation threshold */
+    uint32_t rcp_freq;  /* fixed point reciprocal of the frequency */
+    uint32_t bias;
+    uint16_t cmpl_freq; /* RANS_SCALE - frequency */
+    uint16_t rcp_shift;
+} rans_encsym_t;
+
+
+/* scale counts to frequencies which sum to RANS_SCALE, keeping every symbol
+   which occurs at a frequency of at least 1 */
+static void _Rans_Normalize(const unsigned int *counts, unsigned int total, unsigned int *freq)
+{
+    unsigned int k, largest = 0, sum = 0, d;
+
+    for (k = 0; k < 256; k++)
+    {
+        freq[k] = 0;
+        if (counts[k] == 0) continue;
+
+        freq[k] = (unsigned int)(((uint64_t)counts[k]*RANS_SCALE + total/2)/total);
+        if (freq[k] < 1) freq[k] = 1;
+        sum += freq[k];
+        if (counts[k] > counts[largest]) largest = k;
+    }
+
+    /* absorb rounding errors in the most frequent symbols, where the relative change (and so the cost) is smallest */
+    while (sum != RANS_SCALE)
+    {
+        if (sum < RANS_SCALE)
+        {
+            freq[largest] += RANS_SCALE - sum;
+            sum = RANS_SCALE;
+        }
+        else
+        {
+            largest = 0;
+            for (k = 1; k < 256; k++)
+                if (freq[k] > freq[largest]) largest = k;
+
+            d = sum - RANS_SCALE;
+            if (d > freq[largest] - 1) d = freq[largest] - 1;
+            freq[largest] -= d;
+            sum -= d;
+        }
+    }
+}
+
+static void _Rans_EncSymbolInit(rans_encsym_t *s, unsigned int start, unsigned int freq)
+{
+    unsigned int shift = 0;
+
+    s->x_max = ((RANS_L >> RANS_SCALE_BITS) << 8)*freq;
+    s->cmpl_freq = (uint16_t)(RANS_SCALE - freq);
+    if (freq < 2)
+    {
+        /* x/1 can't be done with a 32 bit reciprocal - x*~0 >> 32 is x - 1, which the bias corrects for */
+        s->rcp_freq = ~0u;
+        s->rcp_shift = 0;
+        s->bias = start + RANS_SCALE - 1;
+    }
+    else
+    {
+        while (freq > (1u << shift)) shift++;
+
+        s->rcp_freq = (uint32_t)(((1ull << (shift + 31)) + freq - 1)/freq);
+        s->rcp_shift = shift - 1;
+        s->bias = start;
+    }
+    s->rcp_shift += 32;
+}
+
+/*
+ * Compress insize bytes from in to out, which has room for outsize bytes.
+ * counts is a precomputed histogram of the input, or NULL. Returns the
+ * compressed size, or -1 if the compressed data would not fit (in which
+ * case the caller should fall back to another coder).
+ */
+int Rans_Compress(const unsigned char *in, unsigned char *out, unsigned int insize, unsigned int outsize,
+                  const unsigned int *counts)
+{
+    unsigned int hist[256], freq[256];
+    rans_encsym_t esym[256];
+    const rans_encsym_t *s;
+    uint32_t state[RANS_NSTATES], x, q;
+    unsigned char *hdr, *ptr, *limit;
+    unsigned int k, cum, v, nsym;
+    int i;
+
+    PYME_STATS_START(t0);
+
+    if (insize < 1) return 0;
+
+    if (counts == NULL)
+    {
+        Huffman_Histogram(in, insize, hist);
+        counts = hist;
+    }
+    PYME_STATS_STOP(PYME_STAGE_HISTOGRAM, t0, insize, 0);
+    PYME_STATS_START(t1);
+
+    _Rans_Normalize(counts, insize, freq);
+
+    /* header */
+    k = 1 + 32 + 4*RANS_NSTATES;
+    for (v = 0; v < 256; v++)
+        k += (freq[v] > 0x80) ? 2 : (freq[v] ? 1 : 0);
+    if (k > outsize) return -1;
+
+    hdr = out;
+    *hdr++ = RANS_SCALE_BITS;
+    memset(hdr, 0, 32);
+    nsym = 0;
+    for (k = 0; k < 256; k++)
+    {
+        if (freq[k])
+        {
+            hdr[k >> 3] |= (unsigned char)(1 << (k & 7));
+            nsym++;
+        }
+    }
+    hdr += 32;
+
+    cum = 0;
+    for (k = 0; k < 256; k++)
+    {
+        if (!freq[k]) continue;
+
+        for (v = freq[k] - 1; v >= 0x80; v >>= 7) *hdr++ = (unsigned char)(v | 0x80);
+        *hdr++ = (unsigned char)v;
+
+        _Rans_EncSymbolInit(&esym[k], cum, freq[k]);
+        cum += freq[k];
+    }
+    PYME_STATS_STOP(PYME_STAGE_TREE, t1, 0, (uint64_t)(hdr - out));
+
+    if (nsym == 1) return (int)(hdr - out);
+
+    PYME_STATS_START(t2);
+
+    /* rANS is LIFO - encode backwards from the end of the output, and move the result into place afterwards */
+    for (k = 0; k < RANS_NSTATES; k++) state[k] = RANS_L;
+    ptr = out + outsize;
+    limit = hdr + 4*RANS_NSTATES;
+
+    for (i = (int)insize - 1; i >= 0; i--)
+    {
+        s = &esym[in[i]];
+        x = state[i % RANS_NSTATES];
+
+        while (x >= s->x_max)
+        {
+            if (ptr <= limit) return -1;
+            *--ptr = (unsigned char)(x & 0xff);
+            x >>= 8;
+        }
+
+        q = (uint32_t)(((uint64_t)x*s->rcp_freq) >> s->rcp_shift);
+        state[i % RANS_NSTATES] = x + s->bias + q*s->cmpl_freq;
+    }
+
+    /* final states, which the decoder starts from */
+    for (k = RANS_NSTATES; k-- > 0;)
+    {
+        x = state[k];
+        ptr -= 4;
+        ptr[0] = (unsigned char)(x & 0xff);
+        ptr[1] = (unsigned char)((x >> 8) & 0xff);
+        ptr[2] = (unsigned char)((x >> 16) & 0xff);
+        ptr[3] = (unsigned char)(x >> 24);
+    }
+
+    k = (unsigned int)(out + outsize - ptr);
+    memmove(hdr, ptr, k);
+    PYME_STATS_STOP(PYME_STAGE_ENCODE, t2, insize, (uint64_t)(hdr - out) + k);
+
+    return (int)(hdr - out) + (int)k;
+}
+
+#define RANS_DECODE(x, slots, dst) \
+    { \
+        uint32_t e_ = slots[(x) & (RANS_SCALE - 1)]; \
+        dst = (unsigned char)(e_ & 0xff); \
+        x = ((e_ >> 8) & (RANS_SCALE - 1))*((x) >> RANS_SCALE_BITS) + (e_ >> (8 + RANS_SCALE_BITS)); \
+    }
+
+/*
+ * Decompress data produced by Rans_Compress into outsize bytes of output.
+ * Returns 0 on success, or -1 if the header is corrupt.
+ */
+int Rans_Uncompress(const unsigned char *in, unsigned char *out, unsigned int insize, unsigned int outsize)
+{
+    /* slot table entries are symbol | frequency << 8 | (slot - start) << 20 */
+    uint32_t slots[RANS_SCALE];
+    uint32_t state[RANS_NSTATES];
+    unsigned int freq[256];
+    const unsigned char *ptr, *end, *bitmap;
+    unsigned int k, j, cum, v, shift, i;
+
+    PYME_STATS_START(t0);
+
+    if ((insize < 1) || (outsize < 1)) return 0;
+    if (insize < 33) return -1;
+    end = in + insize;
+
+    if (in[0] != RANS_SCALE_BITS) return -1;
+    bitmap = in + 1;
+    ptr = in + 33;
+
+    cum = 0;
+    for (k = 0; k < 256; k++)
+    {
+        freq[k] = 0;
+        if (!(bitmap[k >> 3] & (1 << (k & 7)))) continue;
+
+        v = 0;
+        shift = 0;
+        do
+        {
+            if ((ptr >= end) || (shift > 14)) return -1;
+            v |= (unsigned int)(*ptr & 0x7f) << shift;
+            shift += 7;
+        } while (*ptr++ & 0x80);
+
+        freq[k] = v + 1;
+        if (freq[k] == RANS_SCALE)
+        {
+            /* only one symbol */
+            memset(out, (int)k, outsize);
+            return 0;
+        }
+        if (cum + freq[k] > RANS_SCALE) return -1;
+
+        for (j = 0; j < freq[k]; j++)
+            slots[cum + j] = k | (freq[k] << 8) | (j << (8 + RANS_SCALE_BITS));
+        cum += freq[k];
+    }
+    if ((cum != RANS_SCALE) || (ptr + 4*RANS_NSTATES > end)) return -1;
+
+    for (k = 0; k < RANS_NSTATES; k++)
+    {
+        state[k] = (uint32_t)ptr[0] | ((uint32_t)ptr[1] << 8) | ((uint32_t)ptr[2] << 16) | ((uint32_t)ptr[3] << 24);
+        ptr += 4;
+    }
+    PYME_STATS_STOP(PYME_STAGE_DECODE_TREE, t0, (uint64_t)(ptr - in), 0);
+    PYME_STATS_START(t1);
+
+    i = 0;
+
+    /* each state needs at most 2 bytes to renormalise (x >= L >> (scale bits - 8) after decoding) */
+    while ((i + RANS_NSTATES <= outsize) && (end - ptr >= 2*RANS_NSTATES))
+    {
+        RANS_DECODE(state[0], slots, out[i]);
+        RANS_DECODE(state[1], slots, out[i + 1]);
+        RANS_DECODE(state[2], slots, out[i + 2]);
+        RANS_DECODE(state[3], slots, out[i + 3]);
+
+        for (k = 0; k < RANS_NSTATES; k++)
+        {
+            if (state[k] < RANS_L)
+            {
+                state[k] = (state[k] << 8) | *ptr++;
+                if (state[k] < RANS_L) state[k] = (state[k] << 8) | *ptr++;
+            }
+        }
+        i += RANS_NSTATES;
+    }
+
+    /* tail - bounds checked, as corrupt data could otherwise make us read past the end */
+    for (; i < outsize; i++)
+    {
+        k = i % RANS_NSTATES;
+        RANS_DECODE(state[k], slots, out[i]);
+        while ((state[k] < RANS_L) && (ptr < end))
+            state[k] = (state[k] << 8) | *ptr++;
+    }
+    PYME_STATS_STOP(PYME_STAGE_DECODE, t1, insize, outsize);
+
+    return 0;
+}
@@ -0,0 +1,21 @@
+#ifndef _rans_h_
+#define _rans_h_
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/* number of interleaved coder states */
+#define RANS_NSTATES 4
+
+int Rans_Compress( const unsigned char *in, unsigned char *out,
+                   unsigned int insize, unsigned int outsize,
+                   const unsigned int *counts );
+int Rans_Uncompress( const unsigned char *in, unsigned char *out,
+                     unsigned int insize, unsigned int outsize );
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* _rans_h_ */
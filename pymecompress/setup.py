@@ -185,7 +185,7 @@ def configuration(parent_package = '', top_path = None):
     
     config.add_extension(name='bcl',
                     #sources=[os.path.join(cur_dir, 'bcl.pyx'), os.path.join(cur_dir, 'bcl/huffman.c'), os.path.join(cur_dir, 'quantize.c')],
-                    sources=['bcl.c', 'bcl/huffman.c','quantize.dispatch.c', 'quantize.c'],
+                    sources=['bcl.c', 'bcl/huffman.c', 'bcl/systimer.c', 'quantize.dispatch.c', 'quantize.c', 'instrument.c', 'rans.c', 'labelrle.c', 'summary.c', 'bcl/rle.c'],
                     include_dirs=['bcl',] + get_numpy_include_dirs() + extra_include_dirs,
                     extra_compile_args=['-O3', '-fno-exceptions', '-ffast-math',],
                     extra_link_args=linkArgs)
@@ -0,0 +1,287 @@
+"""
+Streaming compressed frames over sockets (e.g. from acquisition PCs to a cluster).
+
+Each frame is sent as a length prefixed message::
+
+    [b'PMCS'][uint32 tag][uint64 frame length][frame]
+
+with the header little endian. `tag` is free for the application to use (e.g. a frame index or channel). Frames are
+the self-describing frames produced by the `bcl.*_buffer` functions, so the receiver needs no other metadata to decode
+them. Receivers reject frames longer than `max_frame_size` (default `MAX_FRAME_SIZE`) before allocating anything, and
+the connection can't be used after that.
+
+Nothing is copied between the encoder and the wire - the header and the compressed buffer go out in a single
+scatter-gather `sendmsg` call (or two `sendall` calls on platforms without `sendmsg`, i.e. Windows). On the receiving
+side frames are read with `recv_into` into a reused buffer and decoded straight into (optionally preallocated) arrays.
+"""
+import asyncio
+import socket
+import socketserver
+import struct
+
+MAGIC = b'PMCS'
+
+# frames are limited to 2 GB by the codecs anyway
+MAX_FRAME_SIZE = 2**31
+
+_HEADER = struct.Struct('<4sIQ')
+
+
+def _header(frame, tag):
+    mv = memoryview(frame).cast('B')
+    return _HEADER.pack(MAGIC, tag, len(mv)), mv
+
+
+def _advance(buffers, sent):
+    """ drop the first `sent` bytes from a list of memoryviews """
+    while buffers and sent >= len(buffers[0]):
+        sent -= len(buffers.pop(0))
+    if buffers and sent:
+        buffers[0] = buffers[0][sent:]
+    return buffers
+
+
+def _parse_header(header):
+    magic, tag, length = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Bad frame header - not a pymecompress frame stream')
+    return tag, length
+
+
+def connect(host, port):
+    """ open a client connection to a `FrameServer` """
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def send_frame(sock, frame, tag=0):
+    """ send a compressed frame (any buffer) over a connected socket, without copying it """
+    header, mv = _header(frame, tag)
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header)
+        sock.sendall(mv)
+        return
+
+    buffers = [memoryview(header), mv]
+    while buffers:
+        buffers = _advance(buffers, sock.sendmsg(buffers))
+
+
+class FrameReceiver(object):
+    """
+    Receives frames from a connected socket into a single, reused, buffer (which grows to the largest frame seen).
+    Frames longer than `max_frame_size` raise ValueError.
+    """
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE):
+        self._sock = sock
+        self.max_frame_size = max_frame_size
+        self._header = bytearray(_HEADER.size)
+        self._buf = bytearray(0)
+
+    def _recv_into(self, mv):
+        """ fill mv. Returns False if the connection was closed before anything was read """
+        pos = 0
+        while pos < len(mv):
+            n = self._sock.recv_into(mv[pos:])
+            if n == 0:
+                if pos == 0:
+                    return False
+                raise ConnectionError('Connection closed part way through a frame')
+            pos += n
+        return True
+
+    def _parse_header(self):
+        tag, length = _parse_header(self._header)
+        if length > self.max_frame_size:
+            raise ValueError('Frame of %d bytes is larger than max_frame_size (%d)' % (length, self.max_frame_size))
+        return tag, length
+
+    def recv_frame(self):
+        """
+        Receive the next frame. Returns (tag, frame), where frame is a memoryview which is only valid until the next
+        call, or None if the connection has been closed.
+        """
+        if not self._recv_into(memoryview(self._header)):
+            return None
+        tag, length = self._parse_header()
+
+        if len(self._buf) < length:
+            self._buf = bytearray(max(length, 2*len(self._buf)))
+        frame = memoryview(self._buf)[:length]
+        if length and not self._recv_into(frame):
+            raise ConnectionError('Connection closed part way through a frame')
+
+        return tag, frame
+
+    def recv(self, out=None):
+        """
+        Receive and decode the next frame, into `out` if given (see `bcl.huffman_decompress_buffer`). Returns
+        (tag, array), or None if the connection has been closed.
+        """
+        from . import bcl
+
+        msg = self.recv_frame()
+        if msg is None:
+            return None
+
+        tag, frame = msg
+        return tag, bcl.huffman_decompress_buffer(frame, out)
+
+    def __iter__(self):
+        while True:
+            msg = self.recv_frame()
+            if msg is None:
+                return
+            yield msg
+
+
+class FrameServer(socketserver.ThreadingTCPServer):
+    """
+    TCP server which calls `handler(tag, frame)` for each frame received, on one thread per connection. With
+    `decode=True`, `frame` is the decoded array, otherwise it is a memoryview of the compressed frame which is only
+    valid for the duration of the call. Connections sending frames larger than `max_frame_size` are dropped.
+
+    Use `server_address` to find the port when binding to port 0, and `serve_forever()` / `shutdown()` as for any
+    `socketserver` server.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, handler, decode=True, max_frame_size=MAX_FRAME_SIZE):
+        self.frame_handler = handler
+        self.decode = decode
+        self.max_frame_size = max_frame_size
+        socketserver.ThreadingTCPServer.__init__(self, address, _FrameRequestHandler)
+
+
+class _FrameRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        receiver = FrameReceiver(self.request, self.server.max_frame_size)
+        while True:
+            msg = receiver.recv() if self.server.decode else receiver.recv_frame()
+            if msg is None:
+                return
+            self.server.frame_handler(*msg)
+
+
+# asyncio
+# -------
+# These work on non-blocking sockets with the event loop's sock_* methods rather than on asyncio streams, which would
+# copy data into and out of their own buffers.
+
+async def async_connect(host, port):
+    """ open a non-blocking client connection for use with `async_send_frame` """
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    await loop.sock_connect(sock, (host, port))
+    return sock
+
+
+async def async_send_frame(sock, frame, tag=0):
+    """ asyncio version of `send_frame`, for a non-blocking socket """
+    loop = asyncio.get_running_loop()
+    header, mv = _header(frame, tag)
+    buffers = [memoryview(header), mv]
+    if hasattr(sock, 'sendmsg'):
+        try:
+            # usually goes out in one go
+            buffers = _advance(buffers, sock.sendmsg(buffers))
+        except BlockingIOError:
+            pass
+
+    for b in buffers:
+        await loop.sock_sendall(sock, b)
+
+
+class AsyncFrameReceiver(FrameReceiver):
+    """ asyncio version of `FrameReceiver`, for a non-blocking socket """
+    async def _recv_into(self, mv):
+        loop = asyncio.get_running_loop()
+        pos = 0
+        while pos < len(mv):
+            n = await loop.sock_recv_into(self._sock, mv[pos:])
+            if n == 0:
+                if pos == 0:
+                    return False
+                raise ConnectionError('Connection closed part way through a frame')
+            pos += n
+        return True
+
+    async def recv_frame(self):
+        if not await self._recv_into(memoryview(self._header)):
+            return None
+        tag, length = self._parse_header()
+
+        if len(self._buf) < length:
+            self._buf = bytearray(max(length, 2*len(self._buf)))
+        frame = memoryview(self._buf)[:length]
+        if length and not await self._recv_into(frame):
+            raise ConnectionError('Connection closed part way through a frame')
+
+        return tag, frame
+
+    async def recv(self, out=None):
+        from . import bcl
+
+        msg = await self.recv_frame()
+        if msg is None:
+            return None
+
+        # decoding releases the GIL, so run it on a thread rather than blocking the event loop
+        tag, frame = msg
+        return tag, await asyncio.get_running_loop().run_in_executor(None, bcl.huffman_decompress_buffer, frame, out)
+
+    def __iter__(self):
+        raise TypeError('use "async for" with AsyncFrameReceiver')
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.recv_frame()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+
+async def async_serve(host, port, handler, decode=True, started=None, max_frame_size=MAX_FRAME_SIZE):
+    """
+    Serve frames until cancelled, awaiting `handler(tag, frame)` (a coroutine function) for each frame received.
+    `decode` and `max_frame_size` are as for `FrameServer`. If given, `started` (an asyncio.Future) is set to the bound
+    (host, port) once the server is listening.
+    """
+    loop = asyncio.get_running_loop()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen()
+    listener.setblocking(False)
+
+    async def _connection(sock):
+        with sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            receiver = AsyncFrameReceiver(sock, max_frame_size)
+            while True:
+                msg = await (receiver.recv() if decode else receiver.recv_frame())
+                if msg is None:
+                    return
+                await handler(*msg)
+
+    tasks = set()
+    try:
+        if started is not None:
+            started.set_result(listener.getsockname())
+        while True:
+            sock, _ = await loop.sock_accept(listener)
+            sock.setblocking(False)
+            task = loop.create_task(_connection(sock))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+        listener.close()
@@ -0,0 +1,104 @@
+//
+//  summary.c
+//
+//  Summary statistics (min, max, mean and an optional histogram of equal
+//  width bins spanning [min, max]) of numeric data, for storing in frame
+//  headers. Quantized and single byte data use the entropy coder's symbol
+//  histogram instead, so this is only needed for wider lossless data.
+//
+
+#include <string.h>
+
+#include "summary.h"
+
+/* finite check on the bit pattern, as -ffast-math lets the compiler assume NaN/inf never happen */
+static inline int _finite_f32(const float *v)
+{
+    uint32_t b;
+    memcpy(&b, v, 4);
+    return (b & 0x7f800000) != 0x7f800000;
+}
+
+static inline int _finite_f64(const double *v)
+{
+    uint64_t b;
+    memcpy(&b, v, 8);
+    return (b & 0x7ff0000000000000ull) != 0x7ff0000000000000ull;
+}
+
+#define _FINITE_INT(p) 1
+
+#define SUMMARY_PASS(T, FINITE) \
+    { \
+        const T *d_ = (const T *)data; \
+        double v_, lo_ = 0, hi_ = 0, sum_ = 0, bs_; \
+        uint64_t i_, n_ = 0; \
+        int b_; \
+        for (i_ = 0; i_ < size; i_++) \
+        { \
+            if (!FINITE(&d_[i_])) continue; \
+            v_ = (double)d_[i_]; \
+            if (n_ == 0) lo_ = hi_ = v_; \
+            lo_ = (v_ < lo_) ? v_ : lo_; \
+            hi_ = (v_ > hi_) ? v_ : hi_; \
+            sum_ += v_; \
+            n_++; \
+        } \
+        summary->count = n_; \
+        summary->min = lo_; \
+        summary->max = hi_; \
+        summary->mean = n_ ? sum_/n_ : 0; \
+        if (hist != NULL) \
+        { \
+            memset(hist, 0, n_bins*sizeof(uint32_t)); \
+            bs_ = (hi_ > lo_) ? n_bins/(hi_ - lo_) : 0; \
+            for (i_ = 0; i_ < size; i_++) \
+            { \
+                if (!FINITE(&d_[i_])) continue; \
+                b_ = (int)(((double)d_[i_] - lo_)*bs_); \
+                hist[(b_ < (int)n_bins) ? b_ : (int)n_bins - 1]++; \
+            } \
+        } \
+    }
+
+/*
+ * Compute summary statistics of size values of the given numpy kind ('u', 'i', 'f' or 'b') and itemsize.
+ * Non-finite floats are ignored. If hist is not NULL, it receives a histogram with n_bins equal width bins between
+ * min and max. Returns 0 on success, -1 for unsupported types.
+ */
+int summary_stats(const void *data, uint64_t size, char kind, unsigned int itemsize, pyme_summary_t *summary,
+                  uint32_t *hist, unsigned int n_bins)
+{
+    if ((hist != NULL) && (n_bins < 1)) return -1;
+
+    if ((kind == 'u') || (kind == 'b'))
+    {
+        switch (itemsize)
+        {
+            case 1: SUMMARY_PASS(uint8_t, _FINITE_INT); return 0;
+            case 2: SUMMARY_PASS(uint16_t, _FINITE_INT); return 0;
+            case 4: SUMMARY_PASS(uint32_t, _FINITE_INT); return 0;
+            case 8: SUMMARY_PASS(uint64_t, _FINITE_INT); return 0;
+        }
+    }
+    else if (kind == 'i')
+    {
+        switch (itemsize)
+        {
+            case 1: SUMMARY_PASS(int8_t, _FINITE_INT); return 0;
+            case 2: SUMMARY_PASS(int16_t, _FINITE_INT); return 0;
+            case 4: SUMMARY_PASS(int32_t, _FINITE_INT); return 0;
+            case 8: SUMMARY_PASS(int64_t, _FINITE_INT); return 0;
+        }
+    }
+    else if (kind == 'f')
+    {
+        switch (itemsize)
+        {
+            case 4: SUMMARY_PASS(float, _finite_f32); return 0;
+            case 8: SUMMARY_PASS(double, _finite_f64); return 0;
+        }
+    }
+
+    return -1;
+}
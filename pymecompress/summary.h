@@ -0,0 +1,24 @@
+#ifndef _summary_h_
+#define _summary_h_
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include <stdint.h>
+
+typedef struct {
+    uint64_t count;  /* number of (finite) values */
+    double min;
+    double max;
+    double mean;
+} pyme_summary_t;
+
+int summary_stats(const void *data, uint64_t size, char kind, unsigned int itemsize, pyme_summary_t *summary,
+                  uint32_t *hist, unsigned int n_bins);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* _summary_h_ */
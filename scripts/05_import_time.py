@@ -0,0 +1,46 @@
+import csv
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Each statement is timed in a fresh interpreter (imports are cached within a process), relative to an empty one
+RESULTS_FILE = "results/05/results_import_time.csv"
+N_RUNS = 15
+
+STATEMENTS = [
+    ("import pymecompress", "import pymecompress"),
+    ("eager import (previous behaviour)", "import pymecompress.bcl, pymecompress.chunked"),
+    ("first use of HuffmanCompress", "import pymecompress; pymecompress.HuffmanCompress"),
+    ("import pymecompress.codecs", "import pymecompress.codecs"),
+]
+
+def time_statement(stmt):
+    times = []
+    for _ in range(N_RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", stmt], check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def run_tests():
+    baseline = time_statement("pass")
+    print(f"Interpreter startup: {baseline*1e3:.1f} ms")
+
+    results = []
+    for name, stmt in STATEMENTS:
+        t = time_statement(stmt) - baseline
+        print(f"{name}: {t*1e3:.1f} ms")
+        results.append({"case": name, "statement": stmt, "import_ms": t*1e3})
+
+    os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+    with open(RESULTS_FILE, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=["case", "statement", "import_ms"])
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f"Results saved to {RESULTS_FILE}")
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,73 @@
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pymecompress import codecs
+
+# Encode / decode throughput with a thread pool, relative to a single thread. The bcl kernels release the GIL, so
+# this should scale near linearly with the number of cores (up to memory bandwidth)
+RESULTS_FILE = "results/06/results_threaded_scaling.csv"
+FRAME_SIZE = 2048*2048
+FRAMES_PER_THREAD = 4
+N_RUNS = 3
+
+CODECS = [
+    ("Huffman", codecs.Huffman()),
+    ("HuffmanQuant16", codecs.HuffmanQuant16(offset=0, scale=1)),
+    ("HuffmanQuant16_rans_4streams", codecs.HuffmanQuant16(offset=0, scale=1, streams=4, coder='rans')),
+]
+
+def thread_counts(n_cores):
+    counts = [1]
+    while counts[-1]*2 <= n_cores:
+        counts.append(counts[-1]*2)
+    if counts[-1] != n_cores:
+        counts.append(n_cores)
+    return counts
+
+def time_threaded(fcn, items, n_threads):
+    """ best of N_RUNS wall clock time for fcn over all items, using n_threads threads """
+    times = []
+    with ThreadPoolExecutor(n_threads) as pool:
+        for _ in range(N_RUNS):
+            start = time.perf_counter()
+            list(pool.map(fcn, items))
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+def run_tests():
+    n_cores = os.cpu_count() or 1
+    counts = thread_counts(n_cores)
+    # the same amount of work for every thread count, so that times are directly comparable
+    frames = [np.random.poisson(100, FRAME_SIZE).astype('uint16') for _ in range(FRAMES_PER_THREAD*counts[-1])]
+    mb = sum(f.nbytes for f in frames)/1024**2
+    print(f"{n_cores} cores, {len(frames)} frames ({mb:.0f} MB)")
+
+    results = []
+    for name, codec in CODECS:
+        compressed = [codec.encode(f) for f in frames]
+        t_enc_1 = t_dec_1 = None
+        for n_threads in counts:
+            t_enc = time_threaded(codec.encode, frames, n_threads)
+            t_dec = time_threaded(codec.decode, compressed, n_threads)
+            if n_threads == 1:
+                t_enc_1, t_dec_1 = t_enc, t_dec
+
+            print(f"{name}, {n_threads} threads: encode {mb/t_enc:.0f} MB/s (x{t_enc_1/t_enc:.2f}), "
+                  f"decode {mb/t_dec:.0f} MB/s (x{t_dec_1/t_dec:.2f})")
+            results.append({"codec": name, "n_cores": n_cores, "n_threads": n_threads,
+                            "comp_speed_mb_s": mb/t_enc, "decomp_speed_mb_s": mb/t_dec,
+                            "comp_speedup": t_enc_1/t_enc, "decomp_speedup": t_dec_1/t_dec})
+
+    os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+    with open(RESULTS_FILE, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f"Results saved to {RESULTS_FILE}")
+
+if __name__ == "__main__":
+    run_tests()
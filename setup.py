@@ -59,6 +59,13 @@ if __name__ == '__main__':
         long_description_content_type="text/markdown",
         license="BSD",
         install_requires=['numpy'],
+        entry_points={'console_scripts': ['pymecompress = pymecompress.cli:main'],
+                      # lets numcodecs find (and import) our codecs on first use, see pyproject.toml
+                      'numcodecs.codecs': ['pymecompress-huffman = pymecompress.codecs:Huffman',
+                                           'pymecompress-quant16 = pymecompress.codecs:HuffmanQuant16',
+                                           'pymecompress-quant16-channels = pymecompress.codecs:HuffmanQuant16Channels',
+                                           'pymecompress-quantf32 = pymecompress.codecs:QuantF32',
+                                           'pymecompress-labelrle = pymecompress.codecs:LabelRLE']},
         classifiers=[
             'Development Status :: 3 - Alpha',
             # Chose either "3 - Alpha", "4 - Beta" or "5 - Production/Stable" as the current state of your package
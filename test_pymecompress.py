@@ -33,3 +33,595 @@ def test_loss_within_sigma():
         np.less_equal(np.abs(ground.astype(float) - quantized.squeeze().astype(float)),
                       np.sqrt(np.sqrt(scale) * (ground.astype(float) - float(offset))))
     )
+
+def test_stats():
+    from pymecompress import bcl
+    test_data = np.random.poisson(100, 10000).astype('uint16')
+
+    calls = []
+    bcl.reset_stats()
+    bcl.enable_stats(True)
+    bcl.set_stats_hook(lambda op, stats: calls.append(op))
+    try:
+        bcl.huffman_decompress_buffer(bcl.huffman_compress_quant_buffer(test_data, 0, 1), None)
+        stats = bcl.get_stats()
+    finally:
+        bcl.enable_stats(False)
+        bcl.set_stats_hook(None)
+
+    assert calls == ['huffman_compress_quant_buffer', 'huffman_decompress_buffer']
+    assert stats['quantize']['bytes_in'] == test_data.nbytes
+    assert stats['encode']['bytes_in'] == test_data.size
+    assert stats['decode']['bytes_out'] == test_data.size
+
+    bcl.reset_stats()
+    bcl.huffman_compress_buffer(test_data)
+    assert bcl.get_stats()['encode']['calls'] == 0
+
+def test_quant16_codec():
+    from pymecompress import codecs
+    codec = codecs.HuffmanQuant16(offset=100, scale=2)
+    ground = np.random.poisson(400, 10000).reshape(100, 100).astype('uint16')
+
+    result = codec.decode(codec.encode(ground)).reshape(ground.shape)
+    assert np.all(np.abs(result.astype(float) - ground) <= 2*np.sqrt(2*(ground - 100.)) + 1)
+
+    out = np.zeros_like(ground)
+    codec.decode(codec.encode(ground), out=out)
+    assert np.all(out == result)
+
+def _progress_during(fcn, arg):
+    """ iterations a python loop on another thread manages while fcn(arg) runs - 0 if fcn holds the GIL """
+    import sys
+    import threading
+    import time
+    counts = []
+    done = threading.Event()
+    progress = [0]
+
+    def _run():
+        c0 = progress[0]
+        fcn(arg)
+        counts.append(progress[0] - c0)
+        done.set()
+
+    # with a long switch interval the GIL only changes hands when it is released - by fcn, or by the loop's sleep(0) -
+    # and not when fcn returns and the interpreter asks for it back (which would give the loop a whole interval)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(100)
+    try:
+        t = threading.Thread(target=_run)
+        t.start()
+        while not done.is_set():
+            progress[0] += 1
+            time.sleep(0)
+        t.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    return counts[0]
+
+def test_releases_gil():
+    from pymecompress import codecs
+
+    # rather than timing threaded speedups (flaky on shared machines, see scripts/06_threaded_scaling.py for those),
+    # check that the kernels release the GIL, by seeing whether another thread gets to run during a long (10s of ms)
+    # call, compared to a call of similar length which holds the GIL. This works on a single core too
+    codec = codecs.HuffmanQuant16(offset=0, scale=1)
+    frame = np.random.poisson(100, 4096*2048).astype('uint16')
+    compressed = codec.encode(frame)
+
+    holding = _progress_during(lambda n: sum(range(n)), 5000000)
+    assert _progress_during(codec.encode, frame) > 10*holding + 100
+    assert _progress_during(codec.decode, compressed) > 10*holding + 100
+
+def test_frame_metadata():
+    from pymecompress import bcl
+    test_data = np.random.poisson(100, (10, 20, 30)).astype('uint16')
+
+    for data in [test_data, np.asfortranarray(test_data), test_data.astype('float32')]:
+        result = bcl.huffman_decompress_buffer(bcl.huffman_compress_buffer(data))
+        assert result.dtype == data.dtype
+        assert result.shape == data.shape
+        assert result.flags['F_CONTIGUOUS'] == data.flags['F_CONTIGUOUS']
+        assert np.all(result == data)
+
+    info = bcl.frame_info(bcl.huffman_compress_quant_buffer(test_data, 0, 1))
+    assert info['shape'] == test_data.shape
+    assert info['quant']['scale'] == 1
+
+def test_decompress_strided():
+    from pymecompress import bcl
+    test_data = np.random.poisson(100, (10, 20, 30)).astype('uint16')
+
+    stack = np.zeros((4,) + test_data.shape, 'uint16')
+    bcl.huffman_decompress_buffer(bcl.huffman_compress_buffer(test_data), out=stack[1])
+    assert np.all(stack[1] == test_data)
+    assert np.all(stack[[0, 2, 3]] == 0)
+
+    volume = np.zeros((40, 40, 40), 'uint16', order='F')
+    region = volume[5:15, 10:30, 3:33]
+    bcl.huffman_decompress_buffer(bcl.huffman_compress_buffer(np.asfortranarray(test_data)), out=region)
+    assert np.all(region == test_data)
+
+    compressed = bcl.huffman_compress_quant_buffer(test_data, 0, 1)
+    expected = bcl.huffman_decompress_quant_buffer(compressed, 0, 1)
+    strided = np.zeros((10, 20, 60), 'uint16')[:, :, ::2]
+    bcl.huffman_decompress_quant_buffer(compressed, 0, 1, out=strided)
+    assert np.all(strided == expected)
+
+def test_multistream():
+    from pymecompress import bcl, codecs
+    test_data = np.random.poisson(100, (10, 20, 30)).astype('uint16')
+
+    for streams in [4, 8]:
+        compressed = bcl.huffman_compress_buffer(test_data, streams=streams)
+        assert bcl.frame_info(compressed)['streams'] == streams
+        assert np.all(bcl.huffman_decompress_buffer(compressed) == test_data)
+
+        strided = np.zeros((10, 20, 60), 'uint16')[:, :, ::2]
+        bcl.huffman_decompress_buffer(compressed, out=strided)
+        assert np.all(strided == test_data)
+
+        # short and single symbol inputs
+        for data in [np.arange(3, dtype='uint8'), np.full(1000, 7, 'uint8')]:
+            assert np.all(bcl.huffman_decompress_buffer(bcl.huffman_compress_buffer(data, streams=streams)) == data)
+
+    codec = codecs.HuffmanQuant16(0, 1, streams=4)
+    expected = codecs.HuffmanQuant16(0, 1).decode(codecs.HuffmanQuant16(0, 1).encode(test_data))
+    assert np.all(codec.decode(codec.encode(test_data)) == expected)
+
+def test_rans():
+    from pymecompress import bcl, codecs
+    test_data = np.random.poisson(100, (10, 20, 30)).astype('uint16')
+
+    compressed = bcl.huffman_compress_buffer(test_data, coder='rans')
+    assert bcl.frame_info(compressed)['coder'] == bcl.CODER_RANS
+    assert np.all(bcl.huffman_decompress_buffer(compressed) == test_data)
+
+    for data in [np.arange(3, dtype='uint8'), np.full(1000, 7, 'uint8'), (np.random.rand(1000) < 0.01).astype('uint8')]:
+        assert np.all(bcl.huffman_decompress_buffer(bcl.huffman_compress_buffer(data, coder='rans')) == data)
+
+    # low signal data - rANS should beat Huffman, which needs at least a bit per pixel
+    background = np.random.poisson(2, (256, 256)).astype('uint16') + 100
+    huffman = codecs.HuffmanQuant16(100, 1)
+    rans = codecs.HuffmanQuant16(100, 1, coder='rans')
+    compressed = rans.encode(background)
+    assert len(compressed) < 0.95*len(huffman.encode(background))
+    assert np.all(rans.decode(compressed) == huffman.decode(huffman.encode(background)))
+
+    strided = np.zeros((256, 512), 'uint16')[:, ::2]
+    rans.decode(compressed, out=strided)
+    assert np.all(strided == rans.decode(compressed))
+
+def test_quant_f32():
+    import numcodecs
+    from pymecompress import bcl, codecs
+    test_data = (np.random.poisson(50, (100, 120)) + np.random.normal(0, 1, (100, 120))).astype('float32')
+
+    codec = numcodecs.get_codec({'id': 'pymecompress-quantf32', 'offset': 0, 'scale': 0.5, 'mode': 'sqrt'})
+    compressed = codec.encode(test_data)
+    assert len(compressed) < 0.5*test_data.size
+    result = codec.decode(compressed)
+    assert result.dtype == 'float32'
+    # the quantization step is 2*sqrt(x)*scale, so the error is at most half that
+    assert np.all(np.abs(result - test_data) <= 0.5*np.sqrt(np.maximum(test_data, 0)) + 0.5)
+
+    compressed = bcl.huffman_compress_quant_f32_buffer(test_data, -10, 0.5, mode='linear', bits=8)
+    assert bcl.frame_info(compressed)['quant']['mode'] == bcl.QUANT_LINEAR
+    result = bcl.huffman_decompress_buffer(compressed)
+    assert np.all(np.abs(result - test_data) <= 0.25 + 1e-4)
+
+    strided = np.zeros((100, 240), 'float32')[:, ::2]
+    bcl.huffman_decompress_buffer(compressed, out=strided)
+    assert np.all(strided == result)
+
+    # out of range values are clipped
+    clipped = bcl.huffman_decompress_buffer(bcl.huffman_compress_quant_f32_buffer(test_data, 40, 1, mode='linear', bits=4))
+    assert np.all(clipped == np.clip(np.floor(test_data - 40 + 0.5), 0, 15) + 40)
+
+def test_label_rle():
+    import numcodecs
+    from pymecompress import bcl, codecs
+    labels = np.zeros((8, 60, 70), 'uint32')
+    labels[2:5, 10:30, 20:50] = 7
+    labels[:, 40:, :35] = 2**31 + 5
+    labels[6, 55, 3] = 1
+
+    for entropy in [True, False]:
+        codec = numcodecs.get_codec({'id': 'pymecompress-labelrle', 'entropy': entropy})
+        compressed = codec.encode(labels)
+        assert len(compressed) < 0.05*labels.nbytes
+        assert np.all(codec.decode(compressed) == labels)
+        assert np.all(codec.decode_slice(compressed, 6) == labels[6])
+        assert np.all(codec.decode_slice(compressed, -5) == labels[3])
+
+    for data in [np.random.randint(0, 3, (3, 4, 5, 6)).astype('uint16'), np.arange(10, dtype='uint64'),
+                 np.zeros(0, 'uint8')]:
+        assert np.all(codecs.LabelRLE().decode(codecs.LabelRLE().encode(data)) == data)
+
+    out = np.zeros((8, 60, 140), 'uint32')[:, :, ::2]
+    bcl.huffman_decompress_buffer(bcl.label_compress_buffer(labels), out=out)
+    assert np.all(out == labels)
+
+    raw = np.random.randint(0, 2, 1000).astype('uint8').repeat(10)
+    compressed = bcl.RLECompress(raw)
+    assert np.all(bcl.RLEDecompress(compressed, raw.size) == raw)
+    # wrong sizes and truncated data are caught rather than overrunning the output
+    import pytest
+    for data, size in [(compressed, raw.size - 1), (compressed, raw.size + 1), (compressed[:-1], raw.size)]:
+        with pytest.raises(ValueError):
+            bcl.RLEDecompress(data, size)
+
+def test_frame_stats():
+    import numcodecs
+    from pymecompress import bcl, codecs
+    test_data = np.random.poisson(100, (100, 120)).astype('uint16')
+
+    codec = numcodecs.get_codec({'id': 'pymecompress-quant16', 'offset': 0, 'scale': 1, 'stats': 'histogram'})
+    chunks = [codec.encode(np.ascontiguousarray(test_data[i:(i + 25)])) for i in range(0, 100, 25)]
+    decoded = np.concatenate([codec.decode(c) for c in chunks])
+    stats = bcl.frame_stats(chunks[0])
+    assert stats['count'] == 25*120
+    assert stats['min'] == decoded[:25].min() and stats['max'] == decoded[:25].max()
+    assert np.isclose(stats['mean'], decoded[:25].mean())
+    # percentiles of quantized data are exact
+    assert np.all(bcl.frame_percentiles(chunks, [0, 10, 50, 90, 100]) ==
+                  np.percentile(decoded, [0, 10, 50, 90, 100], method='inverted_cdf'))
+
+    float_data = np.random.normal(0, 10, 1000).astype('float32')
+    float_data[3] = np.nan
+    stats = bcl.frame_stats(bcl.huffman_compress_buffer(float_data, stats='histogram', coder='rans'))
+    assert stats['count'] == 999 and stats['hist'].sum() == 999
+    assert stats['min'] == np.nanmin(float_data) and stats['max'] == np.nanmax(float_data)
+    assert abs(bcl.frame_percentiles(bcl.huffman_compress_buffer(float_data, stats='histogram'), 50) -
+               np.nanmedian(float_data)) <= (stats['max'] - stats['min'])/256
+
+    assert bcl.frame_stats(bcl.huffman_compress_buffer(test_data, stats='summary'))['hist'] is None
+    assert bcl.frame_stats(bcl.huffman_compress_buffer(test_data)) is None
+
+def test_preview():
+    import numcodecs
+    from pymecompress import bcl, codecs
+    test_data = np.random.poisson(100, (100, 120)).astype('uint16')
+
+    compressed = bcl.huffman_compress_buffer(test_data, preview=8)
+    assert bcl.frame_info(compressed)['preview'] == 8
+    assert np.all(bcl.huffman_decompress_buffer(compressed) == test_data)
+    preview = bcl.decode_preview(compressed)
+    assert preview.shape == (13, 15) and preview.dtype == 'uint16'
+    assert np.all(np.abs(preview[:12] - test_data[:96].reshape(12, 8, 15, 8).mean((1, 3))) <= 0.5)
+    # partial blocks at the edges
+    assert abs(int(preview[12, 0]) - test_data[96:, :8].mean()) <= 0.5
+
+    codec = numcodecs.get_codec({'id': 'pymecompress-quant16', 'offset': 0, 'scale': 1, 'preview': 4})
+    preview = codec.decode_preview(codec.encode(test_data))
+    assert preview.shape == (25, 30)
+    assert np.all(np.abs(preview - test_data.reshape(25, 4, 30, 4).mean((1, 3))) <= np.sqrt(preview) + 1)
+
+    assert np.all(bcl.decode_preview(bcl.huffman_compress_buffer(np.arange(10, dtype='int32'), preview=3)) ==
+                  [1, 4, 7, 9])
+
+def test_decode_cache():
+    import threading
+    from pymecompress import codecs, cache
+    test_data = np.random.poisson(100, (6, 50, 70)).astype('uint16')
+
+    c = cache.DecodeCache(max_bytes=3*test_data[0].nbytes)
+    codec = codecs.HuffmanQuant16(offset=0, scale=1, cache=c)
+    frames = [codec.encode(np.ascontiguousarray(f)) for f in test_data]
+    first = [codec.decode(f) for f in frames[:3]]
+    assert c.info()['misses'] == 3 and c.info()['hits'] == 0
+
+    again = codec.decode(frames[0])
+    assert c.hits == 1 and np.all(again == first[0])
+    assert not again.flags.writeable
+
+    out = np.zeros((50, 140), 'uint16')[:, ::2]
+    codec.decode(frames[1], out=out)
+    assert c.hits == 2 and np.all(out == first[1])
+
+    # a different config doesn't hit
+    codecs.HuffmanQuant16(offset=0, scale=2, cache=c).decode(frames[0])
+    assert c.misses == 4
+
+    # least recently used entries are evicted first (frames 2 then 0), keeping within max_bytes
+    codec.decode(frames[3])
+    assert len(c) == 3 and c.nbytes <= c.max_bytes
+    codec.decode(frames[1])
+    assert c.hits == 3
+    codec.decode(frames[0])
+    assert c.misses == 6
+
+    c.clear()
+    threads = [threading.Thread(target=lambda: [codec.decode(f) for f in frames]) for i in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert c.hits + c.misses == 4*len(frames)
+
+    # codecs created from a config use the default cache, if set
+    try:
+        default = cache.set_default_cache(2**20)
+        codec = codecs.Huffman()
+        compressed = codec.encode(test_data)
+        codec.decode(compressed)
+        assert np.all(codec.decode(compressed) == test_data) and default.hits == 1
+        codecs.Huffman(cache=False).decode(compressed)
+        assert default.hits == 1
+    finally:
+        cache.set_default_cache(None)
+
+def test_stream():
+    import asyncio
+    import threading
+    from pymecompress import bcl, stream
+    frames = [np.random.poisson(100, (50, 70)).astype('uint16') for i in range(4)]
+
+    received = []
+    server = stream.FrameServer(('127.0.0.1', 0), lambda tag, data: received.append((tag, data)))
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    try:
+        with stream.connect(*server.server_address) as sock:
+            for i, f in enumerate(frames):
+                stream.send_frame(sock, bcl.huffman_compress_buffer(f), tag=i)
+            stream.send_frame(sock, bcl.huffman_compress_quant_buffer(frames[0], 0, 1), tag=99)
+    finally:
+        # the handler thread finishes once the client disconnects
+        for i in range(100):
+            if len(received) == 5:
+                break
+            threading.Event().wait(0.05)
+        server.shutdown()
+        server.server_close()
+        t.join()
+
+    assert [tag for tag, _ in received] == [0, 1, 2, 3, 99]
+    assert all(np.all(data == f) for (_, data), f in zip(received, frames))
+    assert np.all(np.abs(received[4][1].astype('f') - frames[0]) <= np.sqrt(frames[0]) + 1)
+
+    async def _roundtrip():
+        received = []
+        out = np.zeros((50, 140), 'uint16')[:, ::2]
+
+        async def handler(tag, frame):
+            received.append((tag, bcl.huffman_decompress_buffer(frame, out=out).copy()))
+
+        started = asyncio.get_running_loop().create_future()
+        server = asyncio.ensure_future(stream.async_serve('127.0.0.1', 0, handler, decode=False, started=started))
+        sock = await stream.async_connect(*(await started))
+        with sock:
+            for i, f in enumerate(frames):
+                await stream.async_send_frame(sock, bcl.huffman_compress_buffer(f), tag=i)
+        while len(received) < len(frames):
+            await asyncio.sleep(0.01)
+        server.cancel()
+        return received
+
+    received = asyncio.run(asyncio.wait_for(_roundtrip(), 10))
+    assert [tag for tag, _ in received] == [0, 1, 2, 3]
+    assert all(np.all(data == f) for (_, data), f in zip(received, frames))
+
+    # sockets without sendmsg (Windows), and oversized frames
+    import pytest
+    import socket
+    import struct
+
+    class _NoSendmsg(object):
+        def __init__(self, sock):
+            self.sendall = sock.sendall
+
+    a, b = socket.socketpair()
+    with a, b:
+        stream.send_frame(_NoSendmsg(a), bcl.huffman_compress_buffer(frames[0]), tag=7)
+        tag, data = stream.FrameReceiver(b).recv()
+        assert tag == 7 and np.all(data == frames[0])
+
+        a.sendall(struct.pack('<4sIQ', stream.MAGIC, 0, 2**40))
+        with pytest.raises(ValueError, match='max_frame_size'):
+            stream.FrameReceiver(b).recv_frame()
+
+def test_cli(tmp_path):
+    import os
+    from pymecompress import cli
+    test_data = np.random.poisson(100, (4, 50, 70)).astype('uint16')
+    os.makedirs(str(tmp_path / 'in' / 'sub'))
+    np.save(str(tmp_path / 'in' / 'a.npy'), test_data)
+    test_data[1].tofile(str(tmp_path / 'in' / 'sub' / 'b.raw'))
+
+    args = ['compress', str(tmp_path / 'in'), '-o', str(tmp_path / 'archive'), '--raw-dtype', 'uint16',
+            '--raw-shape', '50,70', '-j', '2', '--streams', '4', '-q']
+    assert cli.main(args) == 0
+    assert os.path.exists(str(tmp_path / 'archive' / 'sub' / 'b.pmca'))
+
+    # already done files are skipped
+    manifest = cli.Manifest(str(tmp_path / 'archive' / cli.MANIFEST))
+    assert manifest.is_done(str(tmp_path / 'in' / 'a.npy'), str(tmp_path / 'archive' / 'a.pmca'))
+    mtime = os.path.getmtime(str(tmp_path / 'archive' / 'a.pmca'))
+    assert cli.main(args) == 0
+    assert os.path.getmtime(str(tmp_path / 'archive' / 'a.pmca')) == mtime
+
+    assert cli.main(['decompress', str(tmp_path / 'archive'), '-o', str(tmp_path / 'out'), '-q']) == 0
+    assert np.all(np.load(str(tmp_path / 'out' / 'a.npy')) == test_data)
+    assert np.all(np.load(str(tmp_path / 'out' / 'sub' / 'b.npy')) == test_data[1])
+
+    # quant16 needs uint16 data, so the float input fails but the rest go through
+    np.save(str(tmp_path / 'in' / 'c.npy'), test_data.astype('float32'))
+    assert cli.main(args + ['--codec', 'quant16', '--force']) == 1
+
+def test_cli_mat(tmp_path):
+    import pytest
+    h5py = pytest.importorskip('h5py')
+    from pymecompress import cli
+    test_data = np.random.poisson(100, (4, 50, 70)).astype('uint16')
+
+    # v7.3 files are HDF5, with the array stored column major (so the dimensions reversed when read as C order)
+    with h5py.File(str(tmp_path / 'v73.mat'), 'w') as f:
+        f['small'] = np.zeros((2, 2))
+        f['data'] = test_data.T
+    assert np.all(cli.load_input(str(tmp_path / 'v73.mat')) == test_data)
+
+    scipy_io = pytest.importorskip('scipy.io')
+    scipy_io.savemat(str(tmp_path / 'v5.mat'), {'data': test_data})
+    assert np.all(cli.load_input(str(tmp_path / 'v5.mat')) == cli.load_input(str(tmp_path / 'v73.mat')))
+
+def test_estimate_compressed_size():
+    from pymecompress import bcl
+    test_data = (np.random.poisson(np.linspace(5, 500, 1024)[:, None]*np.ones(1024)) + 100).astype('uint16')
+
+    for coder in ['huffman', 'rans']:
+        estimate = bcl.estimate_compressed_size(test_data, coder=coder)
+        assert estimate['sampled'] < test_data.nbytes
+        assert abs(estimate['size'] - len(bcl.huffman_compress_buffer(test_data, coder=coder))) <= estimate['error']
+
+        estimate = bcl.estimate_compressed_size(test_data, 'sqrt', 100, 1, coder=coder, streams=4)
+        actual = len(bcl.huffman_compress_quant_buffer(test_data, 100, 1, coder=coder, streams=4))
+        assert abs(estimate['size'] - actual) <= estimate['error']
+
+    # sampling everything gives the exact Huffman size
+    assert (bcl.estimate_compressed_size(test_data, sample=1)['size'] ==
+            len(bcl.huffman_compress_buffer(test_data)))
+
+    float_data = test_data.astype('float32')
+    estimate = bcl.estimate_compressed_size(float_data, 'linear', 0, 4)
+    actual = len(bcl.huffman_compress_quant_f32_buffer(float_data, 0, 4, mode='linear'))
+    assert abs(estimate['size'] - actual) <= estimate['error']
+
+def test_quant_channels():
+    import numcodecs
+    from pymecompress import bcl, codecs
+    test_data = np.stack([np.random.poisson(5, (60, 70)), np.random.poisson(5000, (60, 70)) + 100,
+                          np.random.poisson(200, (60, 70))], -1).astype('uint16')
+    offset, scale = [0, 100, 0], [1, 4, 0.5]
+
+    for coder, streams in [('huffman', 1), ('huffman', 4), ('rans', 1)]:
+        compressed = bcl.huffman_compress_quant_channels_buffer(test_data, offset, scale, streams=streams, coder=coder)
+        assert [c['scale'] for c in bcl.frame_info(compressed)['channels']] == scale
+        decompressed = bcl.huffman_decompress_buffer(compressed)
+        assert decompressed.shape == test_data.shape and decompressed.dtype == 'uint16'
+        for c in range(3):
+            single = bcl.huffman_compress_quant_buffer(np.ascontiguousarray(test_data[..., c]), offset[c], scale[c])
+            assert np.all(decompressed[..., c] == bcl.huffman_decompress_buffer(single))
+
+    # per-channel tables beat a single global quantization
+    assert len(compressed) < len(bcl.huffman_compress_quant_buffer(test_data, 0, 1, coder='rans'))
+
+    # decoding into a strided destination
+    out = np.zeros((2,) + test_data.shape, 'uint16')
+    bcl.huffman_decompress_buffer(compressed, out[1])
+    assert np.all(out[1] == decompressed) and np.all(out[0] == 0)
+
+    # single channel with scalar parameters, and Fortran ordered input
+    compressed = bcl.huffman_compress_quant_channels_buffer(np.ascontiguousarray(test_data[..., 1:2]), 100, 4)
+    assert np.all(bcl.huffman_decompress_buffer(compressed) == decompressed[..., 1:2])
+    compressed = bcl.huffman_compress_quant_channels_buffer(np.asfortranarray(test_data), offset, scale)
+    assert np.all(bcl.huffman_decompress_buffer(compressed) == decompressed)
+
+    # both APIs quantize the same way for any channel count, vectorized or not - including exact .5 ties (x - offset =
+    # (4k + 2)**2 with scale 4), values below the offset (-> 0) and values past the top level (clamped to 255)
+    edge = np.arange(65536, dtype='uint16')
+    for sc in [4, 0.5]:
+        single = bcl.huffman_decompress_buffer(bcl.huffman_compress_quant_buffer(edge, 100, sc))
+        for nc in [1, 2, 3, 4, 5]:
+            compressed = bcl.huffman_compress_quant_channels_buffer(np.stack([edge]*nc, -1), 100, sc)
+            assert np.all(bcl.huffman_decompress_buffer(compressed) == single[:, None])
+    assert np.all(single[:101] == 100) and np.all(single[(100 + 16193):] == round((255*0.5)**2 + 100))
+
+    codec = numcodecs.get_codec({'id': 'pymecompress-quant16-channels', 'offset': offset, 'scale': 4})
+    assert np.all(codec.decode(codec.encode(test_data)) ==
+                  bcl.huffman_decompress_buffer(bcl.huffman_compress_quant_channels_buffer(test_data, offset, 4)))
+
+def test_compress_array():
+    import pymecompress
+    from pymecompress import codecs
+    test_data = np.random.poisson(100, (6, 50, 70)).astype('uint16')
+
+    compressed = pymecompress.compress_array(test_data, chunks=(2, 16, None), workers=3)
+    assert np.all(pymecompress.decompress_array(compressed, workers=3) == test_data)
+
+    out = np.zeros((6, 50, 70), 'uint16', order='F')
+    pymecompress.decompress_array(pymecompress.compress_array(test_data, codec=codecs.HuffmanQuant16(0, 1)), out=out)
+    assert np.all(np.abs(out.astype(float) - test_data) <= np.sqrt(test_data) + 1)
+
+    # other numcodecs codecs, which return bytes
+    import numcodecs
+    compressed = pymecompress.compress_array(test_data, chunks=(2, 16, None), codec=numcodecs.Zlib())
+    assert np.all(pymecompress.decompress_array(compressed) == test_data)
+    out = np.zeros((6, 50, 70), 'uint16', order='F')
+    assert np.all(pymecompress.decompress_array(compressed, out=out) == test_data)
+    assert np.all(pymecompress.decompress_array(pymecompress.compress_array(np.float32(3), codec=numcodecs.Zlib())) == 3)
+
+    # errors from the pymecompress codecs propagate, rather than the chunk being decoded again without out
+    import pytest
+    from pymecompress import chunked
+    calls = []
+
+    class _Counting(codecs.Huffman):
+        def decode(self, buf, out=None):
+            calls.append(out)
+            return super().decode(buf, out)
+
+    frame = bytearray(codecs.Huffman().encode(test_data))
+    frame[-8:] = b'\xff' * 8
+    with pytest.raises(ValueError):
+        chunked._decode_chunk(_Counting(), bytes(frame), np.zeros_like(test_data))
+    assert len(calls) == 1 and calls[0] is not None
+
+def test_compress_array_dask():
+    import pytest
+    da = pytest.importorskip('dask.array')
+    import pymecompress
+    from pymecompress import chunked
+    test_data = np.random.poisson(100, (6, 50, 70)).astype('uint16')
+
+    compressed = pymecompress.compress_array(da.from_array(test_data, chunks=(3, 25, 35)))
+    assert chunked.container_info(compressed)['chunks'] == (3, 25, 35)
+    assert np.all(chunked.to_dask(compressed).compute() == test_data)
+
+def test_process_pool():
+    from pymecompress import procpool, codecs
+    frames = [np.random.poisson(100, (64, 64)).astype('uint16') for i in range(6)]
+    frames.append(np.asfortranarray(frames[0]))
+
+    with procpool.ProcessPoolCompressor(workers=2) as pool:
+        compressed = pool.compress(frames, copy=True)
+        for f, r in zip(frames, pool.decompress(compressed)):
+            assert np.all(f == r)
+
+    with procpool.ProcessPoolCompressor(workers=2, codec=codecs.HuffmanQuant16(0, 1)) as pool:
+        result = pool.decompress(pool.compress(frames[:2]))
+        assert np.all(np.abs(result[0].astype(float) - frames[0]) <= np.sqrt(frames[0]) + 1)
+
+    # a dead worker is reported rather than hanging
+    import pytest
+    pool = procpool.ProcessPoolCompressor(workers=2)
+    pool._workers[1].kill()
+    pool._workers[1].join()
+    with pytest.raises(RuntimeError, match='worker 1'):
+        pool.compress(frames)
+    pool.close()
+
+def test_lazy_import():
+    import os
+    import subprocess
+    import sys
+    import pytest
+
+    # in a fresh interpreter, as the other tests have already imported everything
+    code = ("import sys, pymecompress\n"
+            "assert 'pymecompress.bcl' not in sys.modules and 'numpy' not in sys.modules\n"
+            "assert pymecompress.HuffmanDecompress is pymecompress.bcl.HuffmanDecompress\n"
+            "assert 'pymecompress.bcl' in sys.modules and 'pymecompress.codecs' not in sys.modules\n"
+            "assert 'compress_array' in dir(pymecompress)\n")
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    # every codec is registered as a numcodecs entry point
+    tomllib = pytest.importorskip('tomllib')
+    import numcodecs
+    from pymecompress import codecs
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyproject.toml'), 'rb') as f:
+        entry_points = tomllib.load(f)['project']['entry-points']['numcodecs.codecs']
+    registered = {k: v for k, v in numcodecs.registry.codec_registry.items() if k.startswith('pymecompress')}
+    assert set(entry_points) == set(registered)
+    for codec_id, target in entry_points.items():
+        assert target == 'pymecompress.codecs:' + registered[codec_id].__name__